@@ -52,6 +52,7 @@ class HttpReplySuggestionsApi(
             .url(url)
             .addHeader("Content-Type", "application/json")
             .addHeader("X-Install-Id", installId)
+            .addHeader("X-Deadline-Ms", REQUEST_DEADLINE_MS.toString())
             .post(body)
             .build()
 
@@ -84,4 +85,9 @@ class HttpReplySuggestionsApi(
             suggestions = out,
         )
     }
+
+    private companion object {
+        // Stays under readTimeout so the backend answers (with rules if needed) before the client gives up.
+        const val REQUEST_DEADLINE_MS = 18_000L
+    }
 }
@@ -0,0 +1,353 @@
+"""Load-testing benchmark for reply_backend against a local mock of OpenAI.
+
+Starts `mock_openai` in-process and `reply_backend.py` as a subprocess pointed at it, drives
+/v1/reply-suggestions at a fixed concurrency with a configurable payload mix, and prints a JSON
+report (throughput, latency percentiles, status/source breakdown, error and fallback rates).
+
+    python backend/bench_backend.py --server-mode asyncio --concurrency 64 --requests 2000 \\
+        --mix chat=0.3,comment=0.7 --hinglish 0.4 --desired-counts 3,5 --error-rate 0.02
+
+Use `--env NAME=VALUE` to pass extra backend configuration and `--output` to keep the report for
+comparing commits or server modes. `--endpoint-latency-ms 150,400` starts one mock per value (on
+consecutive ports from --mock-port) and routes across them via OPENAI_ENDPOINTS; the report then
+includes the backend's per-endpoint router stats. `--accept-encoding` / `--request-encoding` set the
+wire format; the report's `wire` section has body sizes, client decode time and the backend's
+compression metrics.
+"""
+
+import argparse
+import gzip
+import http.client
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Any
+
+from mock_openai import add_mock_arguments, settings_from_args, start_mock_server
+
+BACKEND_SCRIPT = Path(__file__).with_name("reply_backend.py")
+
+CHAT_TEXTS = [
+    "hey are we still on for tonight",
+    "cant make it tmrw, something came up at work",
+    "thanks for the help yesterday, really saved me",
+    "did you see the match last night",
+]
+COMMENT_TEXTS = [
+    "Just shipped my first app after 6 months of late nights",
+    "Hot take: pineapple belongs on pizza",
+    "Our team finally hit 10k users this week",
+    "Anyone else think this update made things worse?",
+]
+INTENTS = ["asking", "praising", "criticizing", "disagreeing", "joking", "neutral"]
+TONE_BIASES = ["funny", "polite", "serious", "neutral"]
+ENCODERS = {"identity": lambda raw: raw, "gzip": gzip.compress, "deflate": zlib.compress}
+DECODERS = {"gzip": gzip.decompress, "deflate": zlib.decompress}
+
+
+def parse_mix(raw: str) -> dict[str, float]:
+    mix: dict[str, float] = {}
+    for part in raw.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in {"chat", "comment"}:
+            raise SystemExit(f"--mix: unknown reply type {name!r}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def build_payload(rng: random.Random, args: argparse.Namespace, mix: dict[str, float], seq: int) -> dict[str, Any]:
+    reply_type = rng.choices(list(mix), weights=list(mix.values()))[0]
+    texts = CHAT_TEXTS if reply_type == "chat" else COMMENT_TEXTS
+    primary_text = rng.choice(texts)
+    if rng.random() >= args.repeat_ratio:
+        # Unique text so response caches and coalescing do not flatter the numbers.
+        primary_text = f"{primary_text} #{seq}"
+    return {
+        "context": {
+            "reply_type": reply_type,
+            "primary_text": primary_text,
+            "secondary_texts": [],
+            "intent": rng.choice(INTENTS),
+            "user_style": "Hinglish" if rng.random() < args.hinglish else "English",
+        },
+        "controls": {
+            "tone_bias": rng.choice(TONE_BIASES),
+            "length": rng.choice(["short", "medium"]),
+            "emoji_level": rng.randint(0, 2),
+            "slang_level": rng.randint(0, 2),
+        },
+        "user_draft": "",
+        "desired_count": rng.choice(args.desired_counts),
+    }
+
+
+def percentile(ordered: list[float], q: float) -> float | None:
+    if not ordered:
+        return None
+    return round(ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)], 2)
+
+
+class LoadRun:
+    def __init__(self, args: argparse.Namespace, port: int):
+        self.args = args
+        self.port = port
+        self.mix = parse_mix(args.mix)
+        self._lock = threading.Lock()
+        self._next = 0
+        # (latency_ms, status, source, X-Cache, request wire bytes, response wire bytes, response bytes, decode_ms)
+        self.samples: list[tuple[float, int, str, str, int, int, int, float]] = []
+
+    def _take(self) -> int | None:
+        with self._lock:
+            if self._next >= self.args.requests:
+                return None
+            self._next += 1
+            return self._next
+
+    def _worker(self, worker_id: int) -> None:
+        rng = random.Random(self.args.seed * 1000 + worker_id)
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.args.timeout)
+        headers = {"Content-Type": "application/json", "X-Install-Id": f"bench-{worker_id}"}
+        if self.args.accept_encoding:
+            headers["Accept-Encoding"] = self.args.accept_encoding
+        if self.args.request_encoding != "identity":
+            headers["Content-Encoding"] = self.args.request_encoding
+        encode = ENCODERS[self.args.request_encoding]
+        while (seq := self._take()) is not None:
+            body = encode(json.dumps(build_payload(rng, self.args, self.mix, seq)).encode("utf-8"))
+            started = time.perf_counter()
+            status, source, cache, wire_bytes, raw_bytes, decode_ms = 0, "", "", 0, 0, 0.0
+            try:
+                conn.request("POST", self.args.path, body=body, headers=headers)
+                resp = conn.getresponse()
+                raw = resp.read()
+                status = resp.status
+                cache = resp.getheader("X-Cache", "")
+                wire_bytes = len(raw)
+                decoder = DECODERS.get(resp.getheader("Content-Encoding", ""))
+                if decoder is not None:
+                    decode_started = time.perf_counter()
+                    raw = decoder(raw)
+                    decode_ms = (time.perf_counter() - decode_started) * 1000
+                raw_bytes = len(raw)
+                if status == 200:
+                    source = str(json.loads(raw).get("source", ""))
+            except (OSError, http.client.HTTPException, ValueError, zlib.error):
+                conn.close()
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=self.args.timeout)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.samples.append((elapsed_ms, status, source, cache, len(body), wire_bytes, raw_bytes, decode_ms))
+        conn.close()
+
+    def run(self) -> dict[str, Any]:
+        started = time.perf_counter()
+        threads = [threading.Thread(target=self._worker, args=(i,)) for i in range(self.args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_sec = time.perf_counter() - started
+
+        latencies = sorted(sample[0] for sample in self.samples)
+        statuses = Counter(str(sample[1]) for sample in self.samples)
+        sources = Counter(sample[2] for sample in self.samples if sample[1] == 200)
+        caches = Counter(sample[3] for sample in self.samples if sample[3])
+        total = len(self.samples)
+        ok = statuses.get("200", 0)
+        fallbacks = sum(count for source, count in sources.items() if source.startswith("rules_") and source != "rules_primary")
+        return {
+            "requests": total,
+            "wall_sec": round(wall_sec, 3),
+            "throughput_rps": round(total / wall_sec, 1) if wall_sec else None,
+            "latency_ms": {
+                "p50": percentile(latencies, 0.50),
+                "p95": percentile(latencies, 0.95),
+                "p99": percentile(latencies, 0.99),
+                "max": round(latencies[-1], 2) if latencies else None,
+                "mean": round(sum(latencies) / total, 2) if total else None,
+            },
+            "status": dict(statuses),
+            "source": dict(sources),
+            "cache": dict(caches),
+            "error_rate": round((total - ok) / total, 4) if total else None,
+            "fallback_rate": round(fallbacks / ok, 4) if ok else None,
+            "wire": self._wire_summary(),
+        }
+
+    def _wire_summary(self) -> dict[str, Any]:
+        answered = [sample for sample in self.samples if sample[1]]
+        if not answered:
+            return {}
+        response_wire = sum(sample[5] for sample in answered)
+        response_raw = sum(sample[6] for sample in answered)
+        return {
+            "request_bytes_mean": round(sum(sample[4] for sample in answered) / len(answered), 1),
+            "response_wire_bytes_mean": round(response_wire / len(answered), 1),
+            "response_bytes_mean": round(response_raw / len(answered), 1),
+            "response_wire_ratio": round(response_wire / response_raw, 4) if response_raw else None,
+            "client_decode_ms_mean": round(sum(sample[7] for sample in answered) / len(answered), 4),
+        }
+
+
+def wait_for_health(port: int, proc: subprocess.Popen, timeout_sec: float) -> dict[str, Any]:
+    deadline = time.monotonic() + timeout_sec
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise SystemExit(f"reply_backend exited early with status {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            health = json.loads(conn.getresponse().read())
+            conn.close()
+            return health
+        except (OSError, ValueError):
+            time.sleep(0.1)
+    raise SystemExit("reply_backend did not become healthy")
+
+
+def backend_wire_metrics(port: int) -> dict[str, Any]:
+    """Backend compression cost and byte counts, read from its Prometheus metrics."""
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+    conn.request("GET", "/metrics")
+    text = conn.getresponse().read().decode("utf-8")
+    conn.close()
+    values: dict[str, float] = {}
+    for line in text.splitlines():
+        if line.startswith(("reply_compression_seconds_sum", "reply_compression_seconds_count", "reply_encoded_body")):
+            name, _, value = line.rpartition(" ")
+            values[name] = float(value)
+    out: dict[str, Any] = {}
+    for direction in ("response", "request"):
+        count = values.get(f'reply_compression_seconds_count{{direction="{direction}"}}', 0.0)
+        total = values.get(f'reply_compression_seconds_sum{{direction="{direction}"}}', 0.0)
+        raw = values.get(f'reply_encoded_body_bytes_total{{direction="{direction}",form="raw"}}', 0.0)
+        wire = values.get(f'reply_encoded_body_bytes_total{{direction="{direction}",form="wire"}}', 0.0)
+        out[direction] = {
+            "encoded_bodies": int(count),
+            "codec_ms_mean": round(total / count * 1000, 4) if count else None,
+            "codec_ms_total": round(total * 1000, 2),
+            "wire_ratio": round(wire / raw, 4) if raw else None,
+        }
+    return out
+
+
+def mock_ports(args: argparse.Namespace) -> list[int]:
+    return [args.mock_port + index for index in range(max(1, len(args.endpoint_latency_ms)))]
+
+
+def backend_env(args: argparse.Namespace, log_dir: str) -> dict[str, str]:
+    env = dict(os.environ)
+    env.update(
+        {
+            "BACKEND_HOST": "127.0.0.1",
+            "BACKEND_PORT": str(args.backend_port),
+            "SERVER_MODE": args.server_mode,
+            "PRIMARY_MODE": args.primary_mode,
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{args.mock_port}",
+            "SHADOW_LOG_PATH": os.path.join(log_dir, "shadow.jsonl"),
+        }
+    )
+    if len(args.endpoint_latency_ms) > 1:
+        env["OPENAI_ENDPOINTS"] = ",".join(
+            f"http://127.0.0.1:{port}|bench-{index}" for index, port in enumerate(mock_ports(args))
+        )
+    for item in args.env:
+        name, _, value = item.partition("=")
+        env[name] = value
+    return env
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server-mode", choices=("threading", "asyncio"), default="threading")
+    parser.add_argument("--primary-mode", choices=("openai", "rules", "race"), default="openai")
+    parser.add_argument("--path", default="/v1/reply-suggestions")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--mix", default="chat=0.5,comment=0.5", help="reply_type weights")
+    parser.add_argument("--hinglish", type=float, default=0.3, help="fraction of Hinglish requests")
+    parser.add_argument(
+        "--desired-counts", type=lambda raw: [int(x) for x in raw.split(",")], default=[5], help="e.g. 3,5"
+    )
+    parser.add_argument("--repeat-ratio", type=float, default=0.0, help="fraction of requests reusing a pooled text")
+    parser.add_argument("--timeout", type=float, default=30.0, help="client timeout per request (sec)")
+    parser.add_argument("--accept-encoding", default="gzip", help="Accept-Encoding header ('' to omit)")
+    parser.add_argument("--request-encoding", choices=tuple(ENCODERS), default="identity")
+    parser.add_argument("--backend-port", type=int, default=5401)
+    parser.add_argument("--mock-port", type=int, default=5402)
+    parser.add_argument(
+        "--endpoint-latency-ms",
+        type=lambda raw: [float(x) for x in raw.split(",")],
+        default=[],
+        help="one mock upstream per latency (overrides --latency-ms), e.g. 150,400",
+    )
+    parser.add_argument("--env", action="append", default=[], metavar="NAME=VALUE", help="extra backend env")
+    parser.add_argument("--output", help="also write the JSON report to this file")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    latencies = args.endpoint_latency_ms or [args.latency_ms]
+    settings = [settings_from_args(args, latency_ms, seed_offset=index) for index, latency_ms in enumerate(latencies)]
+    mocks = [start_mock_server("127.0.0.1", port, s) for port, s in zip(mock_ports(args), settings)]
+    with tempfile.TemporaryDirectory(prefix="bench_backend_") as log_dir:
+        proc = subprocess.Popen(
+            [sys.executable, str(BACKEND_SCRIPT)],
+            env=backend_env(args, log_dir),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        try:
+            wait_for_health(args.backend_port, proc, timeout_sec=15)
+            result = LoadRun(args, args.backend_port).run()
+            router = wait_for_health(args.backend_port, proc, timeout_sec=5).get("upstream_router")
+            result["wire"]["backend"] = backend_wire_metrics(args.backend_port)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=10)
+            for mock in mocks:
+                mock.shutdown()
+
+    report = {
+        "config": {
+            "server_mode": args.server_mode,
+            "primary_mode": args.primary_mode,
+            "path": args.path,
+            "concurrency": args.concurrency,
+            "mix": parse_mix(args.mix),
+            "hinglish": args.hinglish,
+            "desired_counts": args.desired_counts,
+            "repeat_ratio": args.repeat_ratio,
+            "accept_encoding": args.accept_encoding,
+            "request_encoding": args.request_encoding,
+            "env": args.env,
+            "mock": {
+                "latency": args.latency,
+                "latency_ms": latencies if len(latencies) > 1 else args.latency_ms,
+                "error_rate": args.error_rate,
+                "malformed_rate": args.malformed_rate,
+            },
+        },
+        "result": result,
+        "mock_stats": settings[0].stats() if len(settings) == 1 else [s.stats() for s in settings],
+    }
+    if len(settings) > 1:
+        report["router"] = router
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    print(text)
+    if args.output:
+        Path(args.output).write_text(text + "\n", encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""Rules engine regression check and micro-benchmark.
+
+Verifies that the memoized `generate_rules_suggestions` returns byte-identical output to the
+reference `build_rules_suggestions` for every input combination (plus noisy spellings of the same
+inputs), then reports the per-request cost of both paths as JSON.
+
+    python backend/bench_rules.py [--fuzz 20000] [--iterations 20000]
+
+Exits with status 1 if any payload differs.
+"""
+
+import argparse
+import json
+import random
+import sys
+import time
+from typing import Any
+
+from reply_backend import (
+    RULES_INTENTS,
+    RULES_TONE_BIASES,
+    all_rules_keys,
+    build_rules_suggestions,
+    generate_rules_suggestions,
+    precompute_rules_table,
+)
+
+INTENT_SPELLINGS = [*RULES_INTENTS, " ASKING ", "Joking", "sarcastic", "", None]
+STYLE_SPELLINGS = ["English", "Hinglish", " hinglish ", "HINGLISH", "english", "Spanish", "", None]
+LENGTH_SPELLINGS = ["short", "medium", "long", "SHORT", " short", "", None]
+LEVEL_SPELLINGS = [-1, 0, 1, 2, 3, 7, "2", "0", None, 1.9]
+TONE_BIAS_SPELLINGS = [*RULES_TONE_BIASES, " Funny ", "POLITE", "weird", "", None]
+COUNT_SPELLINGS = [0, 1, 2, 3, 4, 5, 9, "3", None, "x"]
+
+
+def payload_for(intent: Any, style: Any, length: Any, emoji: Any, slang: Any, tone_bias: Any, count: Any) -> dict[str, Any]:
+    context: dict[str, Any] = {"reply_type": "comment", "primary_text": "benchmark post"}
+    controls: dict[str, Any] = {}
+    payload: dict[str, Any] = {"context": context, "controls": controls, "user_draft": ""}
+    for target, name, value in (
+        (context, "intent", intent),
+        (context, "user_style", style),
+        (controls, "length", length),
+        (controls, "emoji_level", emoji),
+        (controls, "slang_level", slang),
+        (controls, "tone_bias", tone_bias),
+        (payload, "desired_count", count),
+    ):
+        if value is not None:
+            target[name] = value
+    return payload
+
+
+def encoded(suggestions: list[dict[str, str]]) -> bytes:
+    return json.dumps(suggestions, ensure_ascii=False).encode("utf-8")
+
+
+def check_payload(payload: dict[str, Any]) -> bool:
+    return encoded(generate_rules_suggestions(payload)) == encoded(build_rules_suggestions(payload))
+
+
+def run_regression(fuzz: int, seed: int) -> dict[str, Any]:
+    checked = 0
+    mismatches: list[dict[str, Any]] = []
+
+    for key in all_rules_keys():
+        checked += 1
+        payload = payload_for(*key)
+        if not check_payload(payload):
+            mismatches.append(payload)
+
+    rng = random.Random(seed)
+    for _ in range(fuzz):
+        payload = payload_for(
+            rng.choice(INTENT_SPELLINGS),
+            rng.choice(STYLE_SPELLINGS),
+            rng.choice(LENGTH_SPELLINGS),
+            rng.choice(LEVEL_SPELLINGS),
+            rng.choice(LEVEL_SPELLINGS),
+            rng.choice(TONE_BIAS_SPELLINGS),
+            rng.choice(COUNT_SPELLINGS),
+        )
+        checked += 1
+        if not check_payload(payload):
+            mismatches.append(payload)
+
+    return {"checked": checked, "mismatches": len(mismatches), "first_mismatches": mismatches[:5]}
+
+
+def time_per_call(fn: Any, payloads: list[dict[str, Any]], iterations: int) -> float:
+    started = time.perf_counter()
+    for i in range(iterations):
+        fn(payloads[i % len(payloads)])
+    return (time.perf_counter() - started) / iterations * 1e6
+
+
+def run_benchmark(iterations: int, seed: int) -> dict[str, Any]:
+    rng = random.Random(seed)
+    keys = list(all_rules_keys())
+    payloads = [payload_for(*rng.choice(keys)) for _ in range(512)]
+
+    started = time.perf_counter()
+    entries = precompute_rules_table()
+    precompute_ms = (time.perf_counter() - started) * 1000
+
+    reference_us = time_per_call(build_rules_suggestions, payloads, iterations)
+    memoized_us = time_per_call(generate_rules_suggestions, payloads, iterations)
+    return {
+        "iterations": iterations,
+        "table_entries": entries,
+        "precompute_ms": round(precompute_ms, 2),
+        "reference_us_per_call": round(reference_us, 3),
+        "memoized_us_per_call": round(memoized_us, 3),
+        "speedup": round(reference_us / memoized_us, 1) if memoized_us else None,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--fuzz", type=int, default=20000, help="random noisy payloads to check")
+    parser.add_argument("--iterations", type=int, default=20000, help="calls per benchmark path")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    # Benchmark first so precompute_ms measures a cold table.
+    benchmark = run_benchmark(args.iterations, args.seed)
+    regression = run_regression(args.fuzz, args.seed)
+    report = {"regression": regression, "benchmark": benchmark}
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if regression["mismatches"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
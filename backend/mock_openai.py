@@ -0,0 +1,249 @@
+"""Local mock of the OpenAI `/v1/chat/completions` endpoint for benchmarks.
+
+Answers the prompts built by `reply_backend.OpenAIClient` (single, batched `items` and streamed
+requests) with the requested number of suggestions, after a latency drawn from a configurable
+distribution. A fraction of requests can fail with HTTP 500 or return malformed model JSON, and
+single requests can get extra suggestions beyond desired_count.
+
+    python backend/mock_openai.py --port 5101 --latency lognormal --latency-ms 400 --error-rate 0.01
+
+`GET /stats` returns request counters.
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any
+
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "lognormal")
+
+
+class MockSettings:
+    def __init__(
+        self,
+        latency: str = "fixed",
+        latency_ms: float = 300.0,
+        jitter_ms: float = 100.0,
+        sigma: float = 0.5,
+        error_rate: float = 0.0,
+        malformed_rate: float = 0.0,
+        stream_chunk_chars: int = 16,
+        extra_items: int = 0,
+        seed: int | None = None,
+    ):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency}")
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+        self.malformed_rate = malformed_rate
+        self.stream_chunk_chars = max(1, stream_chunk_chars)
+        self.extra_items = max(0, extra_items)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0, "malformed": 0, "streamed": 0, "batched": 0, "disconnected": 0}
+
+    def draw_latency_sec(self) -> float:
+        with self._lock:
+            if self.latency == "uniform":
+                value = self._rng.uniform(self.latency_ms - self.jitter_ms, self.latency_ms + self.jitter_ms)
+            elif self.latency == "lognormal":
+                # latency_ms is the median.
+                value = self.latency_ms * self._rng.lognormvariate(0.0, self.sigma)
+            else:
+                value = self.latency_ms
+        return max(0.0, value) / 1000.0
+
+    def draw_outcome(self) -> str:
+        with self._lock:
+            roll = self._rng.random()
+        if roll < self.error_rate:
+            return "error"
+        if roll < self.error_rate + self.malformed_rate:
+            return "malformed"
+        return "ok"
+
+    def count(self, name: str) -> None:
+        with self._lock:
+            self.counters[name] += 1
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return dict(self.counters)
+
+
+def suggestion_list(count: int, label: str) -> list[dict[str, str]]:
+    archetypes = ("witty", "supportive", "short", "curious", "direct")
+    return [
+        {"text": f"{label} reply {index + 1}", "archetype": archetypes[index % len(archetypes)], "tone": "neutral"}
+        for index in range(count)
+    ]
+
+
+def requested_count(system_prompt: str, user: dict[str, Any]) -> int:
+    """Prompts carry desired_count in the user message; older ones stated it only in the system prompt."""
+    if user.get("desired_count"):
+        return int(user["desired_count"])
+    match = re.search(r"exactly (\d+)", system_prompt)
+    return int(match.group(1)) if match else 5
+
+
+def model_content(system_prompt: str, user: dict[str, Any], request_no: int, extra_items: int = 0) -> str:
+    items = user.get("items")
+    if isinstance(items, list):
+        results = [
+            {
+                "id": item.get("id"),
+                "suggestions": suggestion_list(int(item.get("desired_count") or 5), f"mock {request_no}.{item.get('id')}"),
+            }
+            for item in items
+            if isinstance(item, dict)
+        ]
+        return json.dumps({"results": results})
+    count = requested_count(system_prompt, user) + extra_items
+    return json.dumps({"suggestions": suggestion_list(count, f"mock {request_no}")})
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are separate writes; without TCP_NODELAY the body waits on a delayed ACK.
+    disable_nagle_algorithm = True
+    settings = MockSettings()
+
+    def do_GET(self) -> None:
+        if self.path == "/stats":
+            self._write_json(200, self.settings.stats())
+            return
+        self._write_json(404, {"error": "Not found"})
+
+    def do_POST(self) -> None:
+        content_len = int(self.headers.get("Content-Length", "0"))
+        raw = self.rfile.read(content_len) if content_len > 0 else b""
+        if self.path != "/v1/chat/completions":
+            self._write_json(404, {"error": "Not found"})
+            return
+        try:
+            body = json.loads(raw.decode("utf-8"))
+            system_prompt = str(body["messages"][0]["content"])
+            user = json.loads(body["messages"][-1]["content"])
+        except (ValueError, KeyError, IndexError, TypeError):
+            self._write_json(400, {"error": "Invalid request"})
+            return
+
+        settings = self.settings
+        settings.count("requests")
+        if isinstance(user.get("items"), list):
+            settings.count("batched")
+        time.sleep(settings.draw_latency_sec())
+        outcome = settings.draw_outcome()
+        if outcome == "error":
+            settings.count("errors")
+            self._write_json(500, {"error": {"message": "mock upstream failure"}})
+            return
+
+        content = model_content(system_prompt, user, settings.stats()["requests"], settings.extra_items)
+        if outcome == "malformed":
+            settings.count("malformed")
+            content = content[: len(content) // 2]
+        try:
+            if body.get("stream"):
+                settings.count("streamed")
+                self._write_stream(content)
+                return
+            self._write_json(200, {"choices": [{"message": {"role": "assistant", "content": content}}]})
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up, e.g. the cancelled side of a hedged request.
+            settings.count("disconnected")
+            self.close_connection = True
+
+    def _write_stream(self, content: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        step = self.settings.stream_chunk_chars
+        for start in range(0, len(content), step):
+            delta = {"choices": [{"delta": {"content": content[start : start + step]}}]}
+            self._write_chunk(f"data: {json.dumps(delta)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    def _write_json(self, status: int, payload: dict[str, Any]) -> None:
+        raw = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(raw)))
+        self.end_headers()
+        self.wfile.write(raw)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        pass
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    # The stdlib default backlog of 5 turns bursts into 1s SYN retries that would dominate the tail.
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def start_mock_server(host: str, port: int, settings: MockSettings) -> ThreadingHTTPServer:
+    """Serves the mock on a daemon thread; call `shutdown()` on the result to stop it."""
+    handler = type("BoundMockOpenAIHandler", (MockOpenAIHandler,), {"settings": settings})
+    server = MockOpenAIServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name="mock-openai", daemon=True).start()
+    return server
+
+
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--latency", choices=LATENCY_DISTRIBUTIONS, default="lognormal")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="fixed value, uniform centre or lognormal median")
+    parser.add_argument("--jitter-ms", type=float, default=100.0, help="uniform half-width")
+    parser.add_argument("--sigma", type=float, default=0.5, help="lognormal shape")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction answered with HTTP 500")
+    parser.add_argument("--malformed-rate", type=float, default=0.0, help="fraction answered with truncated model JSON")
+    parser.add_argument("--extra-items", type=int, default=0, help="suggestions beyond desired_count per answer")
+    parser.add_argument("--seed", type=int, default=7)
+
+
+def settings_from_args(
+    args: argparse.Namespace, latency_ms: float | None = None, seed_offset: int = 0
+) -> MockSettings:
+    return MockSettings(
+        latency=args.latency,
+        latency_ms=args.latency_ms if latency_ms is None else latency_ms,
+        jitter_ms=args.jitter_ms,
+        sigma=args.sigma,
+        error_rate=args.error_rate,
+        malformed_rate=args.malformed_rate,
+        extra_items=args.extra_items,
+        seed=args.seed + seed_offset,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5101)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(args.host, args.port, settings_from_args(args))
+    print(json.dumps({"event": "mock_openai_start", "host": args.host, "port": args.port}))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
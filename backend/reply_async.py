@@ -0,0 +1,693 @@
+"""asyncio serving engine: non-blocking upstream client and the event-loop HTTP server."""
+
+import asyncio
+import signal
+import socket
+import time
+from contextlib import aclosing, asynccontextmanager, nullcontext
+from email.utils import formatdate
+from http import HTTPStatus
+from typing import Any, AsyncIterator
+from urllib.parse import urlsplit
+
+from reply_backend import (
+    ADMIN_PROFILE_PATH,
+    ADMISSION,
+    BREAKER,
+    JSON_CONTENT_TYPE,
+    LEADER_ONLY_ERRORS,
+    OPENAI,
+    PREFETCH_PATH,
+    PRIORITIES,
+    SUPERSESSION,
+    TRACER,
+    BodyRejectedError,
+    ChatCompletionStreamDecoder,
+    DeadlineExpiredError,
+    IncrementalSuggestionParser,
+    OpenAIClient,
+    PriorityGate,
+    RequestBodyDecoder,
+    SuggestionJob,
+    SupersededError,
+    admin_profile,
+    admission_key,
+    check_content_length,
+    encode_response,
+    health_payload,
+    job_response_body,
+    json_bytes,
+    metrics_text,
+    negotiate_encoding,
+    parse_batch_items,
+    parse_suggestions_body,
+    remember_output,
+    request_cost,
+    request_schedule,
+    retry_after_header,
+    sse_event,
+    start_prefetch,
+)
+from reply_cache import SingleFlight
+from reply_config import Config
+from reply_metrics import METRICS, METRICS_CONTENT_TYPE, trace_annotate, trace_span
+from reply_prompts import desired_count_from_payload
+from reply_upstream import AsyncUpstreamClient, UpstreamEndpoint
+
+
+class AsyncOpenAIClient:
+    """Non-blocking counterpart of OpenAIClient; shares its prompt construction, routing and response parsing."""
+
+    def __init__(self, config: Config, openai_client: OpenAIClient):
+        self.config = config
+        self.openai_client = openai_client
+        self.router = openai_client.router
+        self.http = AsyncUpstreamClient(config)
+
+    async def generate(
+        self, payload: dict[str, Any], timeout_sec: float, route: dict[str, Any] | None = None
+    ) -> list[dict[str, str]]:
+        if not self.config.openai_api_key:
+            raise RuntimeError("OPENAI_API_KEY missing")
+
+        prompts = self.openai_client.prompts
+        kind, user_content = prompts.user_message(payload)
+        desired_count = desired_count_from_payload(payload)
+
+        async def attempt(endpoint: UpstreamEndpoint, attempt_timeout_sec: float) -> list[dict[str, str]]:
+            started = time.perf_counter()
+            status, reason, raw_bytes = await self.http.request(
+                endpoint.base_url,
+                "POST",
+                "/v1/chat/completions",
+                body=prompts.body(endpoint.model, kind, user_content),
+                headers=self.openai_client.request_headers(),
+                timeout_sec=attempt_timeout_sec,
+            )
+            METRICS.openai_network.observe(time.perf_counter() - started)
+            if status >= 400:
+                raise RuntimeError(f"HTTP Error {status}: {reason}")
+            with METRICS.openai_parse.time():
+                raw = raw_bytes.decode("utf-8", errors="replace")
+                return self.openai_client.parse_completion(raw, desired_count)
+
+        return await self.router.call_async(attempt, timeout_sec, route)
+
+    async def generate_stream(
+        self, payload: dict[str, Any], timeout_sec: float, route: dict[str, Any] | None = None
+    ) -> AsyncIterator[dict[str, str]]:
+        if not self.config.openai_api_key:
+            raise RuntimeError("OPENAI_API_KEY missing")
+
+        prompts = self.openai_client.prompts
+        kind, user_content = prompts.user_message(payload)
+        decoder = ChatCompletionStreamDecoder()
+        parser = IncrementalSuggestionParser(desired_count_from_payload(payload))
+        endpoint = self.router.pick()
+        if route is not None:
+            route["endpoint"] = endpoint.name
+        started = time.monotonic()
+        outcome = "error"
+        chunks = self.http.stream(
+            endpoint.base_url,
+            "POST",
+            "/v1/chat/completions",
+            body=prompts.body(endpoint.model, kind, user_content, stream=True),
+            headers=self.openai_client.request_headers(),
+            timeout_sec=timeout_sec,
+        )
+        try:
+            async with aclosing(chunks):
+                async for data in chunks:
+                    for delta in decoder.feed(data):
+                        for item in parser.feed(delta):
+                            yield item
+            parser.finish()
+            outcome = "ok"
+        except (GeneratorExit, asyncio.CancelledError):
+            outcome = "cancelled"
+            raise
+        finally:
+            self.router.record(endpoint, time.monotonic() - started, outcome)
+
+
+class AsyncReplyServer:
+    """asyncio serving engine for the same HTTP contract as ReplyHandler."""
+
+    server_version = "AIReplyBackend/1.1"
+    max_header_bytes = 64 * 1024
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.openai = AsyncOpenAIClient(config, OPENAI)
+        self._gate = PriorityGate(config.async_max_concurrency, config.async_queue_depth)
+        self._calls: dict[str, asyncio.Future] = {}
+        self._tasks: set[asyncio.Task] = set()
+        self._rejected = 0
+        self._leaders = 0
+        self._coalesced = 0
+        self._rejoined = 0
+        self._handling = 0
+        self._draining = False
+
+    async def serve(self, sock: socket.socket | None = None, drain_sec: float = 0.0) -> None:
+        """Serves until cancelled or, with `drain_sec`, until SIGTERM, then drains in-flight requests."""
+        if sock is not None:
+            server = await asyncio.start_server(self._handle_connection, sock=sock)
+        else:
+            server = await asyncio.start_server(
+                self._handle_connection,
+                self.config.host,
+                self.config.port,
+                backlog=self.config.listen_backlog,
+            )
+        async with server:
+            if not drain_sec:
+                await server.serve_forever()
+                return
+            stop = asyncio.Event()
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+            await stop.wait()
+            server.close()
+            self._draining = True
+            deadline = time.monotonic() + drain_sec
+            while self._handling and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+    def stats(self) -> dict[str, Any]:
+        gate = self._gate.stats()
+        return {
+            "max_concurrency": self.config.async_max_concurrency,
+            "queue_depth": self.config.async_queue_depth,
+            "active": gate["active"],
+            "queued": gate["queued"],
+            "expired": gate["expired"],
+            "rejected": self._rejected,
+            "single_flight": {
+                "enabled": self.config.single_flight_enabled,
+                "in_flight": len(self._calls),
+                "leaders": self._leaders,
+                "coalesced": self._coalesced,
+                "rejoined": self._rejoined,
+            },
+            "upstream": self.openai.http.stats(),
+        }
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        peer = writer.get_extra_info("peername")
+        client = peer[0] if isinstance(peer, tuple) else "-"
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                keep_alive = keep_alive and not self._draining
+                self._handling += 1
+                try:
+                    status, keep_alive = await self._serve_request(writer, request, client, keep_alive)
+                finally:
+                    self._handling -= 1
+                print(f'{client} - - [{time.strftime("%d/%b/%Y %H:%M:%S")}] "{method} {path} {version}" {status} -')
+                if not keep_alive:
+                    break
+        except BodyRejectedError as exc:
+            # Refused before the body was (fully) read: answer and drop the connection.
+            self._write_json(writer, exc.status, {"error": str(exc)}, {}, keep_alive=False)
+            print(f'{client} - - [{time.strftime("%d/%b/%Y %H:%M:%S")}] "- - -" {exc.status} -')
+            try:
+                await writer.drain()
+            except ConnectionError:
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _serve_request(
+        self,
+        writer: asyncio.StreamWriter,
+        request: tuple[str, str, str, dict[str, str], bytes],
+        client: str,
+        keep_alive: bool,
+    ) -> tuple[int, bool]:
+        """Writes the response for one parsed request. Returns (status, keep_alive)."""
+        method, path, _, headers, body = request
+        encoding = negotiate_encoding(headers.get("accept-encoding"))
+        if method == "GET" and path == "/metrics":
+            raw, encoding_headers = encode_response(metrics_text().encode("utf-8"), encoding)
+            self._write_body(writer, 200, raw, METRICS_CONTENT_TYPE, encoding_headers, keep_alive)
+            await writer.drain()
+            return 200, keep_alive
+        METRICS.requests_in_flight.inc()
+        try:
+            with TRACER.request(f"{method} {path}") if method == "POST" else nullcontext():
+                if method == "POST" and path == "/v1/reply-suggestions:stream":
+                    status = await self._stream_suggestions(writer, headers, body, client)
+                    trace_annotate(status=status)
+                    return status, False
+                # Jobs are finished (metrics, shadow hand-off) only once their response is written.
+                finished: list[SuggestionJob] = []
+                status, payload, extra_headers = await self._dispatch(method, path, headers, body, client, finished)
+                trace_annotate(status=status)
+                try:
+                    self._write_json(writer, status, payload, extra_headers, keep_alive, encoding)
+                    with trace_span("write"):
+                        await writer.drain()
+                finally:
+                    for job in finished:
+                        job.finish()
+                return status, keep_alive
+        finally:
+            METRICS.requests_in_flight.dec()
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> tuple[str, str, str, dict[str, str], bytes] | None:
+        request_line = await reader.readline()
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").strip().split()
+        if len(parts) != 3:
+            raise ValueError("Malformed request line")
+        method, path, version = parts
+        headers: dict[str, str] = {}
+        header_bytes = 0
+        while True:
+            line = await reader.readline()
+            header_bytes += len(line)
+            if header_bytes > self.max_header_bytes:
+                raise ValueError("Request headers too large")
+            if line in {b"\r\n", b"\n", b""}:
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        content_len = check_content_length(headers.get("content-length"))
+        if content_len <= 0:
+            return method, path, version, headers, b""
+        decoder = RequestBodyDecoder(headers.get("content-encoding"))
+        remaining = content_len
+        while remaining > 0:
+            chunk = await reader.readexactly(min(remaining, 64 * 1024))
+            remaining -= len(chunk)
+            decoder.feed(chunk)
+        return method, path, version, headers, decoder.finish()
+
+    async def _dispatch(
+        self, method: str, path: str, headers: dict[str, str], body: bytes, client: str, finished: list[SuggestionJob]
+    ) -> tuple[int, dict[str, Any] | SuggestionJob, dict[str, str]]:
+        if method == "GET" and path == "/health":
+            return 200, {**health_payload(), "scheduler": self._gate.stats(), "async_server": self.stats()}, {}
+        if method == "POST" and path == "/v1/reply-suggestions":
+            return await self._handle_suggestions(headers, body, client, finished)
+        if method == "POST" and path == "/v1/reply-suggestions:batch":
+            return await self._handle_batch(headers, body, client, finished)
+        if method == "POST" and path == PREFETCH_PATH and self.config.prefetch_enabled:
+            return await self._handle_prefetch(headers, body, client)
+        url = urlsplit(path)
+        if method == "GET" and url.path == ADMIN_PROFILE_PATH:
+            return await asyncio.to_thread(admin_profile, url.query, headers.get("authorization", ""))
+        if method not in {"GET", "POST"}:
+            return 501, {"error": "Unsupported method"}, {}
+        return 404, {"error": "Not found"}, {}
+
+    async def _handle_suggestions(
+        self, headers: dict[str, str], body: bytes, client: str, finished: list[SuggestionJob]
+    ) -> tuple[int, dict[str, Any] | SuggestionJob, dict[str, str]]:
+        if not body:
+            return 400, {"error": "Empty body"}, {}
+        payload, error = parse_suggestions_body(body)
+        if payload is None:
+            return 400, {"error": error}, {}
+
+        install_id = headers.get("x-install-id", "").strip()
+        decision, retry_after = ADMISSION.check(admission_key(install_id, client))
+        if decision == "reject":
+            return 429, {"error": "Rate limited"}, retry_after_header(retry_after)
+        job = SuggestionJob(
+            payload,
+            install_id=install_id,
+            rate_limited=decision == "downgrade",
+            prefetch_token=headers.get("x-prefetch-token", "").strip(),
+            **request_schedule(headers.get),
+        )
+        status, error_headers = await self._resolve_job(job)
+        if status != 200:
+            return status, {"error": "Server busy"}, error_headers
+        finished.append(job)
+        return 200, job, job.response_headers
+
+    async def _handle_prefetch(
+        self, headers: dict[str, str], body: bytes, client: str
+    ) -> tuple[int, dict[str, Any], dict[str, str]]:
+        if not body:
+            return 400, {"error": "Empty body"}, {}
+        payload, error = parse_suggestions_body(body)
+        if payload is None:
+            return 400, {"error": error}, {}
+        install_id = headers.get("x-install-id", "").strip()
+        decision, retry_after = ADMISSION.check(admission_key(install_id, client))
+        if decision == "reject":
+            return 429, {"error": "Rate limited"}, retry_after_header(retry_after)
+        if not self._has_capacity():
+            self._rejected += 1
+            return 503, {"error": "Server busy"}, {"Retry-After": "1"}
+        job = SuggestionJob(
+            payload, install_id=install_id, rate_limited=decision == "downgrade", priority=PRIORITIES["low"]
+        )
+
+        def start() -> asyncio.Future:
+            future = self._calls.get(job.cache_key) if self.config.single_flight_enabled else None
+            return future if future is not None else self._start_generation(job)
+
+        if not job.rate_limited and job.wants_store():
+            await asyncio.to_thread(job.load_stored)
+        status, payload = start_prefetch(job, start)
+        return status, payload, {}
+
+    async def _handle_batch(
+        self, headers: dict[str, str], body: bytes, client: str, finished: list[SuggestionJob]
+    ) -> tuple[int, dict[str, Any], dict[str, str]]:
+        if not body:
+            return 400, {"error": "Empty body"}, {}
+        payload, error = parse_suggestions_body(body)
+        if payload is None:
+            return 400, {"error": error}, {}
+        items, error = parse_batch_items(payload)
+        if items is None:
+            return 400, {"error": error}, {}
+
+        install_id = headers.get("x-install-id", "").strip()
+        decision, retry_after = ADMISSION.check(admission_key(install_id, client), request_cost(payload, True))
+        if decision == "reject":
+            return 429, {"error": "Rate limited"}, retry_after_header(retry_after)
+        rate_limited = decision == "downgrade"
+        schedule = request_schedule(headers.get)
+        results: list[dict[str, Any]] = [{"status": 400, "error": "Invalid request"} for _ in items]
+        jobs: list[tuple[int, SuggestionJob]] = []
+        for index, item in enumerate(items):
+            if isinstance(item, dict):
+                job = SuggestionJob(
+                    item, install_id=install_id, rate_limited=rate_limited, batch_index=index, **schedule
+                )
+                jobs.append((index, job))
+        statuses = await asyncio.gather(*(self._resolve_job(job) for _, job in jobs))
+        for (index, job), (status, _) in zip(jobs, statuses):
+            if status == 200:
+                results[index] = {"status": 200, **job.response_payload()}
+                finished.append(job)
+            else:
+                results[index] = {"status": status, "error": "Server busy"}
+        return 200, {"results": results}, {}
+
+    async def _resolve_job(self, job: SuggestionJob) -> tuple[int, dict[str, str]]:
+        """Runs the model step for `job`. Returns (status, headers); 503 when over capacity."""
+        if job.wants_store():
+            await asyncio.to_thread(job.load_stored)
+        if not job.needs_model():
+            return 200, {}
+        # Followers of an identical in-flight call (or a pending prefetch) wait on it without taking a
+        # concurrency slot.
+        # A claimed prefetch already counts this request as a waiter.
+        future = job.prefetch_call
+        race = self.config.primary_mode == "race"
+        for attempt in range(SingleFlight.MAX_ATTEMPTS):
+            if future is None and self.config.single_flight_enabled:
+                future = self._calls.get(job.cache_key)
+                if future is not None:
+                    self._coalesced += 1
+                    future.waiters += 1  # type: ignore[attr-defined]
+            leader = future is None
+            if leader:
+                if not self._has_capacity():
+                    self._rejected += 1
+                    return 503, {"Retry-After": "1"}
+                future = self._start_generation(job)
+
+            superseded = asyncio.get_running_loop().create_future()
+
+            def supersede(future: Any = future, leader: bool = leader, superseded: Any = superseded) -> None:
+                if not superseded.done():
+                    superseded.set_result(None)
+                if leader and not future.waiters:
+                    job.cancel.cancel()
+                    future.task.cancel()
+
+            SUPERSESSION.register(job, supersede)
+            # Race mode keeps its soft deadline instead: a follower serves rules rather than waiting again.
+            rejoin = not leader and not race and attempt < SingleFlight.MAX_ATTEMPTS - 1
+            with trace_span("model_call"):
+                if not await self._await_generation(job, future, superseded, rejoin):
+                    break
+            self._rejoined += 1
+            future = None
+        return 200, {}
+
+    async def _await_generation(
+        self,
+        job: SuggestionJob,
+        future: asyncio.Future,
+        superseded: asyncio.Future | None = None,
+        rejoin: bool = False,
+    ) -> bool:
+        """Waits until the soft deadline (race) or request deadline; True asks to retry (leader-only error)."""
+        race = self.config.primary_mode == "race"
+        await asyncio.wait(
+            [future] if superseded is None else [future, superseded],
+            timeout=job.wait_sec(self.config.race_soft_deadline_ms / 1000.0 if race else None),
+            return_when=asyncio.FIRST_COMPLETED,
+        )
+        if job.superseded and not (future.done() and future.exception() is None):
+            job.resolve_superseded()
+        elif rejoin and future.done() and isinstance(future.exception(), LEADER_ONLY_ERRORS):
+            return True
+        elif not future.done() and not race:
+            job.resolve_fallback(DeadlineExpiredError("Deadline expired waiting for the model"))
+        elif not future.done():
+            job.resolve_deadline()
+        elif future.exception() is not None:
+            job.resolve_fallback(future.exception())
+        else:
+            job.resolve_model(future.result(), future.waiters)  # type: ignore[attr-defined]
+        return False
+
+    def _has_capacity(self) -> bool:
+        return self._gate.has_capacity()
+
+    def _start_generation(self, job: SuggestionJob) -> asyncio.Future:
+        """Starts a shared future for `job.cache_key` that outlives the starting request."""
+        future = asyncio.get_running_loop().create_future()
+        future.waiters = 0  # type: ignore[attr-defined]
+        if self.config.single_flight_enabled:
+            self._calls[job.cache_key] = future
+            self._leaders += 1
+        task = asyncio.ensure_future(self._run_generation(job, future))
+        future.task = task  # type: ignore[attr-defined]
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return future
+
+    @asynccontextmanager
+    async def _slot(self, job: SuggestionJob) -> AsyncIterator[None]:
+        """Holds a model-call slot; queued jobs whose deadline passes raise DeadlineExpiredError."""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def supersede() -> None:
+            if not granted.done():
+                granted.set_exception(SupersededError("Superseded waiting for a model slot"))
+
+        def wake() -> None:
+            loop.call_soon_threadsafe(supersede)
+
+        waiter = self._gate.enter(job.priority, job.deadline, lambda: granted.done() or granted.set_result(None))
+        if waiter is not None:
+            job.cancel.add_callback(wake)
+            try:
+                with trace_span("gate_wait"):
+                    await asyncio.wait_for(granted, job.wait_sec(None))
+            except TimeoutError:
+                if self._gate.abandon(waiter, expired=True):
+                    raise DeadlineExpiredError("Deadline expired waiting for a model slot") from None
+            except SupersededError:
+                if self._gate.abandon(waiter, expired=False):
+                    raise
+            except asyncio.CancelledError:
+                if not self._gate.abandon(waiter, expired=False):
+                    self._gate.release()
+                raise
+            finally:
+                job.cancel.remove_callback(wake)
+        try:
+            yield
+        finally:
+            self._gate.release()
+
+    async def _run_generation(self, job: SuggestionJob, future: asyncio.Future) -> None:
+        try:
+            BREAKER.allow()
+            async with self._slot(job):
+                output = await self._generate_and_cache(job)
+        except asyncio.CancelledError:
+            future.set_exception(RuntimeError("Upstream call was cancelled"))
+            future.exception()
+            raise
+        except Exception as exc:
+            future.set_exception(exc)
+            # Mark retrieved: in race mode nobody may be left to await a late failure.
+            future.exception()
+        else:
+            future.set_result(output)
+        finally:
+            if self._calls.get(job.cache_key) is future:
+                del self._calls[job.cache_key]
+
+    async def _stream_suggestions(
+        self, writer: asyncio.StreamWriter, headers: dict[str, str], body: bytes, client: str
+    ) -> int:
+        """Same event sequence as ReplyHandler._stream_suggestions; returns the HTTP status sent."""
+        if not body:
+            self._write_json(writer, 400, {"error": "Empty body"}, {}, keep_alive=False)
+            return 400
+        payload, error = parse_suggestions_body(body)
+        if payload is None:
+            self._write_json(writer, 400, {"error": error}, {}, keep_alive=False)
+            return 400
+        install_id = headers.get("x-install-id", "").strip()
+        decision, retry_after = ADMISSION.check(admission_key(install_id, client))
+        if decision == "reject":
+            self._write_json(writer, 429, {"error": "Rate limited"}, retry_after_header(retry_after), keep_alive=False)
+            return 429
+        job = SuggestionJob(
+            payload,
+            install_id=install_id,
+            rate_limited=decision == "downgrade",
+            prefetch_token=headers.get("x-prefetch-token", "").strip(),
+            **request_schedule(headers.get),
+        )
+        if job.wants_store():
+            await asyncio.to_thread(job.load_stored)
+        needs_model = job.needs_model()
+        if needs_model and job.prefetch_call is not None:
+            # A pending prefetch answers this stream; its suggestions go out as soon as it finishes.
+            await self._await_generation(job, job.prefetch_call)
+            needs_model = False
+        if needs_model and not self._has_capacity():
+            self._rejected += 1
+            self._write_json(writer, 503, {"error": "Server busy"}, {"Retry-After": "1"}, keep_alive=False)
+            return 503
+        if needs_model:
+            # The stream checks `superseded` between items and closes the upstream response.
+            SUPERSESSION.register(job, job.cancel.cancel)
+
+        started = time.monotonic()
+        head = [
+            "HTTP/1.1 200 OK",
+            f"Server: {self.server_version}",
+            f"Date: {formatdate(usegmt=True)}",
+            "Content-Type: text/event-stream; charset=utf-8",
+            "Cache-Control: no-cache",
+            "Connection: close",
+        ]
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+        job.request_meta["stream"] = True
+
+        client_ok = True
+        if needs_model:
+            if self.config.stream_rules_first:
+                client_ok = await self._write_event(
+                    writer, "rules", {"source": "rules", "suggestions": job.rules_output[: job.desired_count]}
+                )
+            streamed: list[dict[str, str]] = []
+            try:
+                BREAKER.allow()
+                async with self._slot(job):
+                    with (
+                        BREAKER.call() as timeout_sec,
+                        job.upstream_budget(timeout_sec) as budget_sec,
+                        trace_span("upstream"),
+                    ):
+                        items = self.openai.generate_stream(job.payload, timeout_sec=budget_sec, route=job.route)
+                        async with aclosing(items):
+                            async for item in items:
+                                if not client_ok or job.superseded:
+                                    break
+                                streamed.append(item)
+                                elapsed_ms = int((time.monotonic() - started) * 1000)
+                                job.request_meta.setdefault("first_suggestion_ms", elapsed_ms)
+                                client_ok = await self._write_event(
+                                    writer,
+                                    "suggestion",
+                                    {"index": len(streamed) - 1, "suggestion": item, "elapsed_ms": elapsed_ms},
+                                )
+                if job.superseded:
+                    job.resolve_superseded()
+                elif client_ok:
+                    remember_output(job, streamed)
+                    job.resolve_model(streamed, 0)
+                else:
+                    job.resolve_fallback(RuntimeError("Client disconnected during stream"))
+            except Exception as exc:
+                job.resolve_fallback(exc)
+        else:
+            for index, item in enumerate(job.primary_output[: job.desired_count]):
+                client_ok = client_ok and await self._write_event(
+                    writer, "suggestion", {"index": index, "suggestion": item, "elapsed_ms": 0}
+                )
+
+        if client_ok:
+            await self._write_event(writer, "done", job.response_payload())
+        else:
+            job.request_meta["client_disconnected"] = True
+        job.finish()
+        return 200
+
+    async def _write_event(self, writer: asyncio.StreamWriter, event: str, data: dict[str, Any]) -> bool:
+        try:
+            writer.write(sse_event(event, data))
+            await writer.drain()
+        except ConnectionError:
+            return False
+        return True
+
+    async def _generate_and_cache(self, job: SuggestionJob) -> list[dict[str, str]]:
+        with BREAKER.call() as timeout_sec, job.upstream_budget(timeout_sec) as budget_sec, trace_span("upstream"):
+            output = await self.openai.generate(job.payload, timeout_sec=budget_sec, route=job.route)
+        remember_output(job, output)
+        return output
+
+    def _write_json(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        payload: dict[str, Any] | SuggestionJob,
+        headers: dict[str, str],
+        keep_alive: bool,
+        encoding: str = "identity",
+    ) -> None:
+        if isinstance(payload, SuggestionJob):
+            raw, encoding_headers = job_response_body(payload, encoding)
+        else:
+            raw, encoding_headers = encode_response(json_bytes(payload), encoding)
+        self._write_body(writer, status, raw, JSON_CONTENT_TYPE, {**encoding_headers, **headers}, keep_alive)
+
+    def _write_body(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        raw: bytes,
+        content_type: str,
+        headers: dict[str, str],
+        keep_alive: bool,
+    ) -> None:
+        lines = [
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}",
+            f"Server: {self.server_version}",
+            f"Date: {formatdate(usegmt=True)}",
+            f"Content-Type: {content_type}",
+            f"Content-Length: {len(raw)}",
+            f"Connection: {'keep-alive' if keep_alive else 'close'}",
+        ]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + raw)
@@ -1,74 +1,60 @@
+import asyncio
+import contextvars
+import gzip
+import heapq
+import hmac
+import http.client
 import json
+import math
 import os
+import queue
 import random
 import re
+import shutil
+import signal
+import socket
+import sys
+import tempfile
 import threading
 import time
+import traceback
 import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from typing import Any
-from urllib import request as urlrequest
-
-
-def env_bool(name: str, default: bool) -> bool:
-    raw = os.getenv(name)
-    if raw is None:
-        return default
-    return raw.strip().lower() in {"1", "true", "yes", "on"}
-
-
-def env_float(name: str, default: float) -> float:
-    raw = os.getenv(name)
-    if raw is None:
-        return default
-    try:
-        return float(raw)
-    except ValueError:
-        return default
-
-
-def env_int(name: str, default: int) -> int:
-    raw = os.getenv(name)
-    if raw is None:
-        return default
-    try:
-        return int(raw)
-    except ValueError:
-        return default
-
-
-class Config:
-    host: str = os.getenv("BACKEND_HOST", "0.0.0.0")
-    port: int = env_int("BACKEND_PORT", 4000)
-
-    # Primary generation mode:
-    # - "openai" => GPT-4.1-nano primary, rules fallback
-    # - "rules" => rules primary, OpenAI shadow optional
-    primary_mode: str = os.getenv("PRIMARY_MODE", "openai").strip().lower()
-    primary_timeout_sec: int = max(3, env_int("PRIMARY_TIMEOUT_SEC", 12))
-
-    # Shadow calibration mode. In openai primary mode, shadow compares against rules baseline (no extra model cost).
-    # In rules primary mode, shadow optionally calls OpenAI for comparison.
-    shadow_mode: bool = env_bool("SHADOW_MODE", True)
-    shadow_sample_rate: float = max(0.0, min(1.0, env_float("SHADOW_SAMPLE_RATE", 1.0)))
-    shadow_timeout_sec: int = max(3, env_int("SHADOW_TIMEOUT_SEC", 12))
-
-    openai_api_key: str = os.getenv("OPENAI_API_KEY", "").strip()
-    openai_model: str = os.getenv("OPENAI_MODEL", "gpt-4.1-nano").strip()
-    openai_base_url: str = os.getenv("OPENAI_BASE_URL", "https://api.openai.com").rstrip("/")
-
-    shadow_log_path: str = os.getenv("SHADOW_LOG_PATH", "backend/shadow_logs.jsonl")
+from typing import Any, Callable, Iterator
+from urllib.parse import parse_qs, urlsplit
+
+from reply_cache import (
+    InFlightCall,
+    NearDuplicateIndex,
+    PrefetchStore,
+    ResponseCache,
+    SingleFlight,
+    SuggestionStore,
+    call_state,
+)
+from reply_config import CONFIG, Config
+from reply_logs import ShadowLogWriter, Tracer
+from reply_metrics import METRICS, METRICS_CONTENT_TYPE, LatencyWindow, trace_annotate, trace_span
+from reply_prompts import (
+    PromptBuilder,
+    canonical_text,
+    desired_count_from_payload,
+    generation_inputs,
+    generation_key,
+    prompt_kind_for,
+)
+from reply_upstream import EndpointRouter, UpstreamCancel, UpstreamEndpoint, UpstreamPools
 
 
 def now_iso() -> str:
     return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
 
 
-def canonical_text(text: str) -> str:
-    return re.sub(r"[^a-z0-9\s]+", "", text.lower()).strip()
-
-
 VALID_ARCHETYPES = {"witty", "supportive", "short", "curious", "direct"}
 VALID_TONES = {"playful", "friendly", "neutral", "serious"}
 
@@ -84,34 +70,26 @@ def normalize_tone(raw: str) -> str:
 
 
 def dedupe_suggestions(suggestions: list[dict[str, str]]) -> list[dict[str, str]]:
-    out: list[dict[str, str]] = []
-    seen: set[str] = set()
-    for item in suggestions:
-        text = str(item.get("text", "")).replace("\n", " ").strip()
-        text = re.sub(r"\s+", " ", text)
-        if not text:
-            continue
-        key = canonical_text(text)
-        if not key or key in seen:
-            continue
-        seen.add(key)
-        out.append(
-            {
-                "text": text,
-                "archetype": normalize_archetype(str(item.get("archetype", "direct"))),
-                "tone": normalize_tone(str(item.get("tone", "neutral"))),
-            }
-        )
-    return out
-
-
-def desired_count_from_payload(payload: dict[str, Any]) -> int:
-    raw = payload.get("desired_count", 5)
-    try:
-        value = int(raw)
-    except (TypeError, ValueError):
-        value = 5
-    return max(1, min(5, value))
+    with trace_span("dedupe_suggestions"):
+        out: list[dict[str, str]] = []
+        seen: set[str] = set()
+        for item in suggestions:
+            text = str(item.get("text", "")).replace("\n", " ").strip()
+            text = re.sub(r"\s+", " ", text)
+            if not text:
+                continue
+            key = canonical_text(text)
+            if not key or key in seen:
+                continue
+            seen.add(key)
+            out.append(
+                {
+                    "text": text,
+                    "archetype": normalize_archetype(str(item.get("archetype", "direct"))),
+                    "tone": normalize_tone(str(item.get("tone", "neutral"))),
+                }
+            )
+        return out
 
 
 def overlap_count(a: list[dict[str, str]], b: list[dict[str, str]]) -> int:
@@ -233,7 +211,8 @@ def fallback_pool(style: str) -> list[dict[str, str]]:
     ]
 
 
-def generate_rules_suggestions(payload: dict[str, Any]) -> list[dict[str, str]]:
+def build_rules_suggestions(payload: dict[str, Any]) -> list[dict[str, str]]:
+    """Reference rules algorithm; requests go through the memoized `generate_rules_suggestions`."""
     context = payload.get("context", {}) if isinstance(payload.get("context"), dict) else {}
     controls = payload.get("controls", {}) if isinstance(payload.get("controls"), dict) else {}
     desired_count = desired_count_from_payload(payload)
@@ -266,111 +245,398 @@ def generate_rules_suggestions(payload: dict[str, Any]) -> list[dict[str, str]]:
     return out[:desired_count]
 
 
+RULES_INTENTS = ("asking", "praising", "criticizing", "disagreeing", "joking", "neutral")
+RULES_TONE_BIASES = ("funny", "polite", "serious", "neutral")
+
+# (intent, style, length, emoji_level, slang_level, tone_bias, desired_count) -> suggestions
+_RULES_TABLE: dict[tuple[str, str, str, int, int, str, int], tuple[tuple[str, str, str], ...]] = {}
+
+
+def rules_key(payload: dict[str, Any]) -> tuple[str, str, str, int, int, str, int]:
+    """Collapses a payload to the inputs `build_rules_suggestions` actually depends on."""
+    context = payload.get("context", {}) if isinstance(payload.get("context"), dict) else {}
+    controls = payload.get("controls", {}) if isinstance(payload.get("controls"), dict) else {}
+    intent = str(context.get("intent", "neutral")).strip().lower() or "neutral"
+    style = str(context.get("user_style", "English")).strip() or "English"
+    length_mode = str(controls.get("length", "medium")).strip().lower() or "medium"
+    emoji_level = int(controls.get("emoji_level", 0) or 0)
+    slang_level = int(controls.get("slang_level", 0) or 0)
+    tone_bias = str(controls.get("tone_bias", "neutral")).strip().lower()
+    return (
+        intent if intent in RULES_INTENTS else "neutral",
+        "Hinglish" if style.lower() == "hinglish" else "English",
+        "short" if length_mode == "short" else "medium",
+        max(0, min(2, emoji_level)),
+        max(0, min(2, slang_level)),
+        tone_bias if tone_bias in RULES_TONE_BIASES else "neutral",
+        desired_count_from_payload(payload),
+    )
+
+
+def _rules_payload_for_key(key: tuple[str, str, str, int, int, str, int]) -> dict[str, Any]:
+    intent, style, length_mode, emoji_level, slang_level, tone_bias, desired_count = key
+    return {
+        "context": {"intent": intent, "user_style": style},
+        "controls": {
+            "length": length_mode,
+            "emoji_level": emoji_level,
+            "slang_level": slang_level,
+            "tone_bias": tone_bias,
+        },
+        "desired_count": desired_count,
+    }
+
+
+def _rules_table_entry(key: tuple[str, str, str, int, int, str, int]) -> tuple[tuple[str, str, str], ...]:
+    entry = _RULES_TABLE.get(key)
+    if entry is None:
+        built = build_rules_suggestions(_rules_payload_for_key(key))
+        entry = tuple((it["text"], it["archetype"], it["tone"]) for it in built)
+        _RULES_TABLE[key] = entry
+    return entry
+
+
+def generate_rules_suggestions(payload: dict[str, Any]) -> list[dict[str, str]]:
+    return [
+        {"text": text, "archetype": archetype, "tone": tone}
+        for text, archetype, tone in _rules_table_entry(rules_key(payload))
+    ]
+
+
+def all_rules_keys() -> Iterator[tuple[str, str, str, int, int, str, int]]:
+    for intent in RULES_INTENTS:
+        for style in ("English", "Hinglish"):
+            for length_mode in ("short", "medium"):
+                for emoji_level in range(3):
+                    for slang_level in range(3):
+                        for tone_bias in RULES_TONE_BIASES:
+                            for desired_count in range(1, 6):
+                                yield (intent, style, length_mode, emoji_level, slang_level, tone_bias, desired_count)
+
+
+def precompute_rules_table() -> int:
+    for key in all_rules_keys():
+        _rules_table_entry(key)
+    return len(_RULES_TABLE)
+
+
+def fallback_reason(exc: BaseException) -> str:
+    """Coarse, low-cardinality label for why a model call fell back to rules."""
+    message = str(exc)
+    if isinstance(exc, CircuitOpenError):
+        return "circuit_open"
+    if isinstance(exc, RateLimitedError):
+        return "rate_limited"
+    if isinstance(exc, DeadlineExpiredError):
+        return "deadline_expired"
+    if isinstance(exc, QueueFullError):
+        return "queue_full"
+    if isinstance(exc, SupersededError):
+        return "superseded"
+    if isinstance(exc, TimeoutError) or "timed out" in message.lower():
+        return "timeout"
+    if message.startswith("HTTP Error"):
+        return "upstream_http"
+    if "OPENAI_API_KEY" in message:
+        return "missing_key"
+    if "disconnected" in message:
+        return "client_disconnected"
+    if isinstance(exc, (ConnectionError, OSError, http.client.HTTPException)):
+        return "connection"
+    if isinstance(exc, (RuntimeError, ValueError)):
+        return "invalid_output"
+    return "other"
+
+
+class ChatCompletionStreamDecoder:
+    """Turns raw chat-completions SSE bytes (`stream=true`) into message content deltas."""
+
+    def __init__(self) -> None:
+        self._buffer = b""
+        self.finished = False
+
+    def feed(self, data: bytes) -> list[str]:
+        self._buffer += data
+        out: list[str] = []
+        while b"\n" in self._buffer:
+            line, self._buffer = self._buffer.split(b"\n", 1)
+            line = line.strip()
+            if not line.startswith(b"data:"):
+                continue
+            data_field = line[5:].strip()
+            if data_field == b"[DONE]":
+                self.finished = True
+                continue
+            try:
+                chunk = json.loads(data_field)
+            except json.JSONDecodeError:
+                raise RuntimeError("Malformed upstream stream chunk")
+            choices = chunk.get("choices") if isinstance(chunk, dict) else None
+            if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict):
+                continue
+            delta = choices[0].get("delta") or {}
+            content = delta.get("content") if isinstance(delta, dict) else None
+            if isinstance(content, str) and content:
+                out.append(content)
+        return out
+
+
+class IncrementalSuggestionParser:
+    """Extracts suggestions from partial model JSON as soon as each array item closes."""
+
+    def __init__(self, desired_count: int):
+        self.desired_count = desired_count
+        self.accepted: list[dict[str, str]] = []
+        self._buf = ""
+        self._stack: list[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = -1
+        self._last_key = ""
+        # True where the next top-level string is a key (after `{` or `,`), not a value.
+        self._key_next = False
+        self._in_suggestions = False
+        self._seen_suggestions = False
+        self._closed_suggestions = False
+        self._item_start = -1
+        self._seen: set[str] = set()
+        self._extra = 0
+
+    def feed(self, chunk: str) -> list[dict[str, str]]:
+        out: list[dict[str, str]] = []
+        start = len(self._buf)
+        self._buf += chunk
+        for i in range(start, len(self._buf)):
+            ch = self._buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if len(self._stack) == 1 and self._key_next:
+                        self._last_key = self._buf[self._string_start + 1 : i]
+                        self._key_next = False
+                continue
+            if ch == '"':
+                self._in_string = True
+                self._string_start = i
+            elif ch == ",":
+                self._key_next = self._stack == ["{"]
+            elif ch == "{":
+                if self._in_suggestions and self._stack == ["{", "["]:
+                    self._item_start = i
+                self._stack.append(ch)
+                self._key_next = self._stack == ["{"]
+            elif ch == "[":
+                if self._stack == ["{"]:
+                    self._in_suggestions = self._last_key == "suggestions"
+                    self._seen_suggestions = self._seen_suggestions or self._in_suggestions
+                self._stack.append(ch)
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._item_start >= 0 and self._stack == ["{", "["]:
+                    item = self._accept(self._buf[self._item_start : i + 1])
+                    self._item_start = -1
+                    if item is not None:
+                        out.append(item)
+                elif ch == "]" and self._stack == ["{"]:
+                    self._closed_suggestions = self._closed_suggestions or self._in_suggestions
+                    self._in_suggestions = False
+        return out
+
+    def finish(self) -> list[dict[str, str]]:
+        # A stream cut off inside the array is as unparseable as a truncated one-shot body.
+        if not self._seen_suggestions or not self._closed_suggestions:
+            raise RuntimeError("Failed to parse model JSON")
+        valid = len(self.accepted) + self._extra
+        if valid != self.desired_count:
+            raise RuntimeError(f"Model returned {valid} valid suggestions, expected {self.desired_count}")
+        return list(self.accepted)
+
+    def _accept(self, raw: str) -> dict[str, str] | None:
+        try:
+            item = json.loads(raw)
+        except json.JSONDecodeError:
+            return None
+        if not isinstance(item, dict):
+            return None
+        normalized = dedupe_suggestions(
+            [
+                {
+                    "text": str(item.get("text", "")).strip(),
+                    "archetype": str(item.get("archetype", "direct")),
+                    "tone": str(item.get("tone", "neutral")),
+                }
+            ]
+        )
+        if not normalized:
+            return None
+        key = canonical_text(normalized[0]["text"])
+        if key in self._seen:
+            return None
+        self._seen.add(key)
+        if len(self.accepted) >= self.desired_count:
+            self._extra += 1
+            return None
+        self.accepted.append(normalized[0])
+        return normalized[0]
+
+
 class OpenAIClient:
     def __init__(self, config: Config):
         self.config = config
+        self.pools = UpstreamPools(config)
+        self.prompts = PromptBuilder(config)
+        self.router = EndpointRouter(config)
 
-    def generate(self, payload: dict[str, Any], timeout_sec: int) -> list[dict[str, str]]:
+    def generate(
+        self,
+        payload: dict[str, Any],
+        timeout_sec: float,
+        route: dict[str, Any] | None = None,
+        cancel: UpstreamCancel | None = None,
+    ) -> list[dict[str, str]]:
+        """Routed (and possibly hedged) completion; `route` receives the endpoint choice."""
         if not self.config.openai_api_key:
             raise RuntimeError("OPENAI_API_KEY missing")
 
-        url = f"{self.config.openai_base_url}/v1/chat/completions"
+        kind, user_content = self.prompts.user_message(payload)
         desired_count = desired_count_from_payload(payload)
-        context = payload.get("context", {}) if isinstance(payload.get("context"), dict) else {}
-        reply_type = str(context.get("reply_type", "comment")).strip().lower() or "comment"
-        primary_text = str(context.get("primary_text", "")).strip()
-        secondary_texts_raw = context.get("secondary_texts", [])
-        secondary_texts: list[str] = []
-        if isinstance(secondary_texts_raw, list):
-            for item in secondary_texts_raw:
-                text = str(item).strip()
-                if text:
-                    secondary_texts.append(text)
-        secondary_texts = secondary_texts[:6]
-        user_draft = str(payload.get("user_draft", "")).strip()
-        controls = payload.get("controls", {}) if isinstance(payload.get("controls"), dict) else {}
-
-        if reply_type == "chat":
-            system_prompt = (
-                "You generate direct, in-context reply suggestions for social/chat inputs. "
-                f"Output strict JSON with key 'suggestions' containing exactly {desired_count} objects. "
-                "Each object keys: text, archetype, tone. "
-                "Archetype one of: witty, supportive, short, curious, direct. "
-                "Tone one of: playful, friendly, neutral, serious. "
-                "No markdown. No code fences. No preamble. "
-                "Rewrite ONLY the provided primary_text into improved alternatives. "
-                "Do not add new facts, names, requests, or side topics. "
-                "Preserve the original meaning, topic, entities, and language."
-            )
-            user_payload = {
-                "task": f"Return exactly {desired_count} polished rewrites of primary_text.",
-                "focus_rules": [
-                    "use only primary_text",
-                    "no side-topic additions",
-                    "no context shift",
-                ],
-                "reply_type": reply_type,
-                "primary_text": primary_text,
-                "secondary_texts": secondary_texts,
-                "user_draft": user_draft,
-                "controls": controls,
-            }
-            temperature = 0.2
-        else:
-            system_prompt = (
-                "You generate direct, in-context reply suggestions for social feed comments. "
-                f"Output strict JSON with key 'suggestions' containing exactly {desired_count} objects. "
-                "Each object keys: text, archetype, tone. "
-                "Archetype one of: witty, supportive, short, curious, direct. "
-                "Tone one of: playful, friendly, neutral, serious. "
-                "No markdown. No code fences. No preamble. "
-                "Write replies TO the primary_text, not rewrites OF primary_text. "
-                "Do not copy or paraphrase the full primary_text. "
-                "Use secondary_texts only as supporting context when provided."
-            )
-            user_payload = {
-                "task": f"Return exactly {desired_count} short, sendable replies to the target content.",
-                "focus_rules": [
-                    "reply to primary_text as another person",
-                    "do not rewrite primary_text",
-                    "stay on-topic",
-                ],
-                "reply_type": reply_type,
-                "primary_text": primary_text,
-                "secondary_texts": secondary_texts,
-                "user_draft": user_draft,
-                "controls": controls,
-            }
-            temperature = 0.45
 
-        body = {
-            "model": self.config.openai_model,
-            "temperature": temperature,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": json.dumps(user_payload, ensure_ascii=False)},
-            ],
-            "response_format": {"type": "json_object"},
+        def attempt(endpoint: UpstreamEndpoint, attempt_timeout_sec: float, cancel: UpstreamCancel) -> list[Any]:
+            pool = self.pools.get(endpoint.base_url)
+            with METRICS.openai_network.time():
+                status, reason, raw_bytes = pool.request(
+                    "POST",
+                    "/v1/chat/completions",
+                    body=self.prompts.body(endpoint.model, kind, user_content),
+                    headers=self.request_headers(),
+                    timeout_sec=attempt_timeout_sec,
+                    cancel=cancel,
+                )
+            if status >= 400:
+                raise RuntimeError(f"HTTP Error {status}: {reason}")
+            with METRICS.openai_parse.time():
+                raw = raw_bytes.decode("utf-8", errors="replace")
+                return self.parse_completion(raw, desired_count)
+
+        return self.router.call(attempt, timeout_sec, route, cancel)
+
+    def generate_stream(
+        self,
+        payload: dict[str, Any],
+        timeout_sec: float,
+        route: dict[str, Any] | None = None,
+        cancel: UpstreamCancel | None = None,
+    ) -> Iterator[dict[str, str]]:
+        """Yields each validated suggestion as soon as it is complete; streams are never hedged."""
+        if not self.config.openai_api_key:
+            raise RuntimeError("OPENAI_API_KEY missing")
+
+        kind, user_content = self.prompts.user_message(payload)
+        decoder = ChatCompletionStreamDecoder()
+        parser = IncrementalSuggestionParser(desired_count_from_payload(payload))
+        endpoint = self.router.pick()
+        if route is not None:
+            route["endpoint"] = endpoint.name
+        pool = self.pools.get(endpoint.base_url)
+        started = time.monotonic()
+        outcome = "error"
+        try:
+            with pool.stream(
+                "POST",
+                "/v1/chat/completions",
+                body=self.prompts.body(endpoint.model, kind, user_content, stream=True),
+                headers=self.request_headers(),
+                timeout_sec=timeout_sec,
+                cancel=cancel,
+            ) as resp:
+                if resp.status >= 400:
+                    resp.read()
+                    raise RuntimeError(f"HTTP Error {resp.status}: {resp.reason}")
+                while True:
+                    line = resp.readline()
+                    if not line:
+                        break
+                    for delta in decoder.feed(line):
+                        yield from parser.feed(delta)
+            parser.finish()
+            outcome = "ok"
+        except GeneratorExit:
+            outcome = "cancelled"
+            raise
+        except Exception:
+            if cancel is not None and cancel.cancelled:
+                outcome = "cancelled"
+            raise
+        finally:
+            self.router.record(endpoint, time.monotonic() - started, outcome)
+
+    def request_headers(self) -> dict[str, str]:
+        return {
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {self.config.openai_api_key}",
         }
-        req = urlrequest.Request(
-            url=url,
-            method="POST",
-            data=json.dumps(body).encode("utf-8"),
-            headers={
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.config.openai_api_key}",
-            },
-        )
-        with urlrequest.urlopen(req, timeout=timeout_sec) as resp:
-            raw = resp.read().decode("utf-8", errors="replace")
 
+    def generate_batch(
+        self, payloads: list[dict[str, Any]], timeout_sec: float, route: dict[str, Any] | None = None
+    ) -> list[Any]:
+        """One upstream call for several payloads; returns per-payload suggestions or exceptions."""
+        if not self.config.openai_api_key:
+            raise RuntimeError("OPENAI_API_KEY missing")
+
+        kind, user_content = self.prompts.batch_user_message(payloads)
+
+        def attempt(endpoint: UpstreamEndpoint, attempt_timeout_sec: float, cancel: UpstreamCancel) -> list[Any]:
+            pool = self.pools.get(endpoint.base_url)
+            with METRICS.openai_network.time():
+                status, reason, raw_bytes = pool.request(
+                    "POST",
+                    "/v1/chat/completions",
+                    body=self.prompts.body(endpoint.model, kind, user_content, batch=True),
+                    headers=self.request_headers(),
+                    timeout_sec=attempt_timeout_sec,
+                    cancel=cancel,
+                )
+            if status >= 400:
+                raise RuntimeError(f"HTTP Error {status}: {reason}")
+            parsed = json.loads(raw_bytes.decode("utf-8", errors="replace"))
+            content = parsed.get("choices", [{}])[0].get("message", {}).get("content", "")
+            if not isinstance(content, str) or not content.strip():
+                raise RuntimeError("OpenAI response missing message content")
+            results_raw = self._parse_model_json(content).get("results")
+            if not isinstance(results_raw, list):
+                raise RuntimeError("Model batch results is not a list")
+            return results_raw
+
+        results_raw = self.router.call(attempt, timeout_sec, route)
+        parse_started = time.perf_counter()
+        by_id: dict[int, Any] = {}
+        for entry in results_raw:
+            if isinstance(entry, dict) and isinstance(entry.get("id"), int):
+                by_id.setdefault(entry["id"], entry.get("suggestions"))
+        out: list[Any] = []
+        for index, payload in enumerate(payloads):
+            try:
+                out.append(self._validate_suggestions(by_id.get(index), desired_count_from_payload(payload)))
+            except RuntimeError as exc:
+                out.append(exc)
+        METRICS.openai_parse.observe(time.perf_counter() - parse_started)
+        return out
+
+    def parse_completion(self, raw: str, desired_count: int) -> list[dict[str, str]]:
         parsed = json.loads(raw)
         content = parsed.get("choices", [{}])[0].get("message", {}).get("content", "")
         if not isinstance(content, str) or not content.strip():
             raise RuntimeError("OpenAI response missing message content")
 
         data = self._parse_model_json(content)
-        suggestions_raw = data.get("suggestions")
+        return self._validate_suggestions(data.get("suggestions"), desired_count)
+
+    def _validate_suggestions(self, suggestions_raw: Any, desired_count: int) -> list[dict[str, str]]:
         if not isinstance(suggestions_raw, list):
             raise RuntimeError("Model suggestions is not a list")
 
@@ -407,13 +673,782 @@ class OpenAIClient:
         return parsed
 
 
+class SupersessionRegistry:
+    """Pending model-bound requests per (install, reply_type) that a newer request replaces."""
+
+    STAGES = ("before_upstream", "upstream", "detached")
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.reply_types = {name.strip() for name in config.supersede_reply_types.split(",") if name.strip()}
+        self._lock = threading.Lock()
+        self._pending: dict[tuple[str, str], dict[str, tuple["SuggestionJob", Callable[[], None]]]] = {}
+        self._counts = dict.fromkeys(self.STAGES, 0)
+        self._saved_tokens = 0
+
+    def register(self, job: "SuggestionJob", on_supersede: Callable[[], None]) -> None:
+        if not self.config.supersede_enabled or not job.install_id or job.batch_index is not None:
+            return
+        reply_type = generation_inputs(job.payload)["reply_type"]
+        if reply_type not in self.reply_types:
+            return
+        key = (job.install_id, reply_type)
+        with self._lock:
+            pending = self._pending.setdefault(key, {})
+            stale = [entry for entry in pending.values() if entry[0].cache_key != job.cache_key]
+            for old, _ in stale:
+                del pending[old.request_id]
+                old.superseded = True
+            pending[job.request_id] = (job, on_supersede)
+        job.supersede_key = key
+        for _, callback in stale:
+            callback()
+
+    def release(self, job: "SuggestionJob") -> None:
+        if job.supersede_key is None:
+            return
+        with self._lock:
+            pending = self._pending.get(job.supersede_key)
+            if pending is not None:
+                pending.pop(job.request_id, None)
+                if not pending:
+                    del self._pending[job.supersede_key]
+        job.supersede_key = None
+
+    def record(self, stage: str, saved_tokens: int) -> None:
+        with self._lock:
+            self._counts[stage] += 1
+            self._saved_tokens += saved_tokens
+        METRICS.superseded.inc(stage)
+        if saved_tokens:
+            METRICS.superseded_tokens.inc(amount=saved_tokens)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.supersede_enabled,
+                "reply_types": sorted(self.reply_types),
+                "pending_keys": len(self._pending),
+                "superseded": sum(self._counts.values()),
+                **self._counts,
+                "saved_prompt_tokens": self._saved_tokens,
+            }
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, holding at most `burst`. Not thread-safe."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def try_take(self, now: float, amount: float = 1.0) -> bool:
+        # `now` may predate a bucket created after the caller read the clock.
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = max(self.updated, now)
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def retry_after(self, amount: float = 1.0) -> float:
+        """Seconds until `amount` tokens are available (after a failed `try_take`)."""
+        if self.rate <= 0:
+            return math.inf
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+
+class TokenBucketMap:
+    """Thread-safe token buckets per key, LRU- and idle-evicted; a non-positive rate disables it."""
+
+    def __init__(self, rate: float, burst: float, max_keys: int, idle_ttl_sec: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_keys = max(1, max_keys)
+        self.idle_ttl_sec = idle_ttl_sec
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict[str, TokenBucket] = OrderedDict()
+        self._evicted = 0
+
+    def try_take(self, key: str, amount: float = 1.0) -> tuple[bool, float]:
+        """Returns (allowed, retry_after_sec). Costs above the burst size are charged as a full burst."""
+        if self.rate <= 0:
+            return True, 0.0
+        amount = min(amount, self.burst)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = TokenBucket(self.rate, self.burst)
+                self._buckets[key] = bucket
+            else:
+                self._buckets.move_to_end(key)
+            self._evict(now)
+            if bucket.try_take(now, amount):
+                return True, 0.0
+            return False, bucket.retry_after(amount)
+
+    def refund(self, key: str, amount: float = 1.0) -> None:
+        """Gives back tokens from a successful `try_take` whose work was not done after all."""
+        if self.rate <= 0:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.tokens = min(bucket.burst, bucket.tokens + min(amount, self.burst))
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"rate": self.rate, "burst": self.burst, "keys": len(self._buckets), "evicted": self._evicted}
+
+    def _evict(self, now: float) -> None:
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+            self._evicted += 1
+        while self._buckets:
+            key, oldest = next(iter(self._buckets.items()))
+            if now - oldest.updated <= self.idle_ttl_sec:
+                break
+            del self._buckets[key]
+            self._evicted += 1
+
+
+class RateLimitedError(RuntimeError):
+    pass
+
+
+class AdmissionController:
+    """Per-install and global token buckets: allow, downgrade (rules only) or reject (429)."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.action = "reject" if config.rate_limit_action == "reject" else "downgrade"
+        self.installs = TokenBucketMap(
+            config.rate_limit_install_rps,
+            config.rate_limit_install_burst,
+            max_keys=config.rate_limit_max_installs,
+            idle_ttl_sec=config.rate_limit_idle_ttl_sec,
+        )
+        self.global_bucket = TokenBucketMap(
+            config.rate_limit_global_rps, config.rate_limit_global_burst, max_keys=1, idle_ttl_sec=3600
+        )
+        self._lock = threading.Lock()
+        self._counts = {"allowed": 0, "limited_install": 0, "limited_global": 0}
+
+    def check(self, key: str, cost: int = 1) -> tuple[str, float]:
+        """Returns (decision, retry_after_sec)."""
+        if not self.config.rate_limit_enabled:
+            return "allow", 0.0
+        scope = "install"
+        with trace_span("admission"):
+            allowed, retry_after = self.installs.try_take(key, cost)
+            if allowed:
+                scope = "global"
+                allowed, retry_after = self.global_bucket.try_take("global", cost)
+        with self._lock:
+            self._counts["allowed" if allowed else f"limited_{scope}"] += 1
+        if allowed:
+            return "allow", 0.0
+        METRICS.rate_limited.inc(scope, self.action)
+        return self.action, retry_after
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counts = dict(self._counts)
+        return {
+            "enabled": self.config.rate_limit_enabled,
+            "action": self.action,
+            **counts,
+            "installs": self.installs.stats(),
+            "global": self.global_bucket.stats(),
+        }
+
+
+def admission_key(install_id: str, client: str) -> str:
+    """Requests without X-Install-Id are limited per client address."""
+    return install_id or f"addr:{client}"
+
+
+def retry_after_header(retry_after_sec: float) -> dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(min(retry_after_sec, 3600))))}
+
+
+def request_cost(payload: dict[str, Any], is_batch: bool) -> int:
+    items = payload.get("requests")
+    return max(1, len(items)) if is_batch and isinstance(items, list) else 1
+
+
+class ShadowExecutor:
+    """Fixed pool of shadow workers behind a bounded queue and per-second shadow budgets."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._queue: queue.Queue[tuple[Callable[..., None], tuple[Any, ...], float]] = queue.Queue(
+            maxsize=config.shadow_queue_max
+        )
+        self._global_budget = TokenBucketMap(
+            config.shadow_budget_rps, max(1.0, config.shadow_budget_rps), max_keys=1, idle_ttl_sec=3600
+        )
+        self._install_budgets = TokenBucketMap(
+            config.shadow_install_budget_rps,
+            max(1.0, config.shadow_install_budget_rps),
+            max_keys=config.rate_limit_max_installs,
+            idle_ttl_sec=config.rate_limit_idle_ttl_sec,
+        )
+        self._lock = threading.Lock()
+        self._workers: list[threading.Thread] = []
+        self._submitted = 0
+        self._completed = 0
+        self._dropped_queue_full = 0
+        self._dropped_budget = 0
+        self._failed = 0
+        self.latency = LatencyWindow()
+        self.queue_wait = LatencyWindow()
+
+    def submit(self, install_id: str, fn: Callable[..., None], *args: Any) -> bool:
+        # A task shed by one budget (or the full queue) gives back what it took from the others.
+        if not self._global_budget.try_take("global")[0]:
+            with self._lock:
+                self._dropped_budget += 1
+            return False
+        if not self._install_budgets.try_take(install_id)[0]:
+            self._global_budget.refund("global")
+            with self._lock:
+                self._dropped_budget += 1
+            return False
+        self._ensure_workers()
+        try:
+            self._queue.put_nowait((fn, args, time.monotonic()))
+        except queue.Full:
+            self._global_budget.refund("global")
+            self._install_budgets.refund(install_id)
+            with self._lock:
+                self._dropped_queue_full += 1
+            return False
+        with self._lock:
+            self._submitted += 1
+        return True
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            counters = {
+                "workers": self.config.shadow_workers,
+                "queue_depth": self._queue.qsize(),
+                "queue_max": self.config.shadow_queue_max,
+                "submitted": self._submitted,
+                "completed": self._completed,
+                "dropped_queue_full": self._dropped_queue_full,
+                "dropped_budget": self._dropped_budget,
+                "failed": self._failed,
+            }
+        counters["latency_ms"] = self.latency.percentiles()
+        counters["queue_wait_ms"] = self.queue_wait.percentiles()
+        return counters
+
+    def _ensure_workers(self) -> None:
+        if self._workers:
+            return
+        with self._lock:
+            while len(self._workers) < self.config.shadow_workers:
+                worker = threading.Thread(target=self._run, name=f"shadow-worker-{len(self._workers)}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+
+    def _run(self) -> None:
+        while True:
+            fn, args, enqueued_at = self._queue.get()
+            started = time.monotonic()
+            self.queue_wait.add((started - enqueued_at) * 1000)
+            try:
+                fn(*args)
+            except Exception as exc:
+                with self._lock:
+                    self._failed += 1
+                METRICS.shadow_failures.inc(type(exc).__name__)
+                print(json.dumps({"event": "shadow_task_failed", "error": f"{type(exc).__name__}: {exc}"}), flush=True)
+            self.latency.add((time.monotonic() - started) * 1000)
+            with self._lock:
+                self._completed += 1
+
+
+class CircuitOpenError(RuntimeError):
+    pass
+
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker around the primary model call, with an optional adaptive timeout."""
+
+    def __init__(self, config: Config, on_transition: Callable[[dict[str, Any]], None] | None = None):
+        self.config = config
+        self.on_transition = on_transition
+        self._lock = threading.Lock()
+        self._outcomes: deque[bool] = deque(maxlen=config.circuit_window)
+        self._latency = LatencyWindow(config.circuit_window * 4)
+        self._state = "closed"
+        self._opened_at = 0.0
+        self._probes_in_flight = 0
+        self._probe_successes = 0
+        self._rejected = 0
+        self._opened = 0
+        self._transitions: deque[dict[str, Any]] = deque(maxlen=20)
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    @contextmanager
+    def call(self) -> Iterator[float]:
+        """Admits one upstream call and yields its timeout; raises CircuitOpenError when open."""
+        if not self.config.circuit_breaker_enabled:
+            yield float(self.config.primary_timeout_sec)
+            return
+        probe = self._admit()
+        started = time.monotonic()
+        recorded = False
+        try:
+            yield self.timeout_sec()
+        except (DeadlineExpiredError, SupersededError):
+            # The client's budget ran out or it moved on, which says nothing about upstream health.
+            raise
+        except Exception:
+            recorded = True
+            self._record(False, probe)
+            raise
+        else:
+            recorded = True
+            elapsed = time.monotonic() - started
+            slow_ms = self.config.circuit_slow_call_ms
+            self._record(not (slow_ms and elapsed * 1000 > slow_ms), probe, elapsed)
+        finally:
+            if not recorded and probe:
+                # Cancelled or abandoned (e.g. client went away): free the probe without a verdict.
+                with self._lock:
+                    self._probes_in_flight -= 1
+
+    def allow(self) -> None:
+        """Raises CircuitOpenError when `call` would reject right now; admits nothing."""
+        if not self.config.circuit_breaker_enabled:
+            return
+        with self._lock:
+            if self._state == "open" and time.monotonic() - self._opened_at < self.config.circuit_open_sec:
+                self._rejected += 1
+                raise CircuitOpenError("Circuit open: OpenAI primary temporarily disabled")
+            if self._state == "half_open" and self._probes_in_flight >= self.config.circuit_half_open_probes:
+                self._rejected += 1
+                raise CircuitOpenError("Circuit half-open: probe already in flight")
+
+    def timeout_sec(self) -> float:
+        ceiling = float(self.config.primary_timeout_sec)
+        if not self.config.adaptive_timeout_enabled:
+            return ceiling
+        observed_ms = self._latency.quantile(self.config.adaptive_timeout_quantile)
+        if observed_ms is None or self._latency.count() < self.config.circuit_min_calls:
+            return ceiling
+        timeout_ms = max(self.config.adaptive_timeout_min_ms, observed_ms * self.config.adaptive_timeout_multiplier)
+        return min(ceiling, timeout_ms / 1000.0)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            calls = len(self._outcomes)
+            failures = calls - sum(self._outcomes)
+            out = {
+                "enabled": self.config.circuit_breaker_enabled,
+                "state": self._state,
+                "window_calls": calls,
+                "failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "rejected": self._rejected,
+                "opened": self._opened,
+                "probes_in_flight": self._probes_in_flight,
+                "transitions": list(self._transitions),
+            }
+        out["timeout_sec"] = round(self.timeout_sec(), 3)
+        out["latency_ms"] = self._latency.percentiles()
+        return out
+
+    def _admit(self) -> bool:
+        """Returns True when the admitted call is a half-open probe."""
+        with self._lock:
+            if self._state == "open":
+                if time.monotonic() - self._opened_at < self.config.circuit_open_sec:
+                    self._rejected += 1
+                    raise CircuitOpenError("Circuit open: OpenAI primary temporarily disabled")
+                transition = self._transition("half_open", "cooldown elapsed")
+            else:
+                transition = None
+            if self._state == "half_open":
+                if self._probes_in_flight >= self.config.circuit_half_open_probes:
+                    self._rejected += 1
+                    raise CircuitOpenError("Circuit half-open: probe already in flight")
+                self._probes_in_flight += 1
+                probe = True
+            else:
+                probe = False
+        self._notify(transition)
+        return probe
+
+    def _record(self, success: bool, probe: bool, elapsed_sec: float | None = None) -> None:
+        transition = None
+        with self._lock:
+            if probe:
+                self._probes_in_flight -= 1
+            if success and elapsed_sec is not None:
+                self._latency.add(elapsed_sec * 1000)
+            if self._state == "half_open" and probe:
+                if not success:
+                    transition = self._transition("open", "probe failed")
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.config.circuit_half_open_probes:
+                        self._outcomes.clear()
+                        transition = self._transition("closed", "probes succeeded")
+            elif self._state == "closed":
+                self._outcomes.append(success)
+                calls = len(self._outcomes)
+                failures = calls - sum(self._outcomes)
+                if calls >= self.config.circuit_min_calls and failures / calls >= self.config.circuit_failure_rate:
+                    transition = self._transition("open", f"failure rate {failures}/{calls}")
+        self._notify(transition)
+
+    def _transition(self, state: str, reason: str) -> dict[str, Any]:
+        """Caller holds the lock."""
+        transition = {"timestamp": now_iso(), "from": self._state, "to": state, "reason": reason}
+        self._state = state
+        self._probe_successes = 0
+        if state == "open":
+            self._opened_at = time.monotonic()
+            self._opened += 1
+        self._transitions.append(transition)
+        return transition
+
+    def _notify(self, transition: dict[str, Any] | None) -> None:
+        if transition is not None and self.on_transition is not None:
+            self.on_transition(transition)
+
+
+class DeadlineExpiredError(RuntimeError):
+    pass
+
+
+class QueueFullError(RuntimeError):
+    pass
+
+
+class SupersededError(RuntimeError):
+    pass
+
+
+# Errors that end a coalesced call for its leader's own reasons (its deadline, its supersession); a follower
+# retries instead of falling back, and leads the next call under its own deadline if nobody else does.
+LEADER_ONLY_ERRORS: tuple[type[BaseException], ...] = (DeadlineExpiredError, SupersededError)
+
+
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+
+
+def parse_priority(raw: str | None) -> int | None:
+    """X-Priority: high | normal | low (or 0-2). None when missing or invalid."""
+    value = str(raw or "").strip().lower()
+    if value in PRIORITIES:
+        return PRIORITIES[value]
+    if value.isdigit():
+        return min(int(value), max(PRIORITIES.values()))
+    return None
+
+
+def default_priority(payload: dict[str, Any]) -> int:
+    """Chat rewrites block the user's typing; feed comment replies can wait a little."""
+    return PRIORITIES["high"] if generation_inputs(payload)["reply_type"] == "chat" else PRIORITIES["normal"]
+
+
+def parse_deadline(raw: str | None, received: float) -> float | None:
+    """X-Deadline-Ms is the client's remaining budget; returns a time.monotonic() deadline or None."""
+    value = str(raw or "").strip()
+    try:
+        budget_ms: float | None = float(value) if value else None
+    except ValueError:
+        budget_ms = None
+    if budget_ms is None or not math.isfinite(budget_ms):
+        if not CONFIG.default_deadline_ms:
+            return None
+        budget_ms = float(CONFIG.default_deadline_ms)
+    return received + max(0.0, budget_ms) / 1000.0
+
+
+def request_schedule(header: Callable[[str], str | None]) -> dict[str, Any]:
+    """SuggestionJob `deadline` / `priority` keyword arguments from the request headers."""
+    return {
+        "deadline": parse_deadline(header("x-deadline-ms"), time.monotonic()),
+        "priority": parse_priority(header("x-priority")),
+    }
+
+
+class _GateWaiter:
+    def __init__(self, notify: Callable[[], None]):
+        self.notify = notify
+        self.granted = False
+        self.abandoned = False
+
+
+class PriorityGate:
+    """Bounds concurrent model calls; waiters are admitted by (priority, deadline, arrival)."""
+
+    def __init__(self, max_active: int, max_queued: int):
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._heap: list[tuple[int, float, int, _GateWaiter]] = []
+        self._seq = 0
+        self._active = 0
+        self._queued = 0
+        self._admitted = 0
+        self._expired = 0
+        self._rejected = 0
+
+    def has_capacity(self) -> bool:
+        with self._lock:
+            return not self.max_active or self._active < self.max_active or self._queued < self.max_queued
+
+    def enter(self, priority: int, deadline: float | None, notify: Callable[[], None]) -> _GateWaiter | None:
+        """Takes a slot (returns None) or queues a waiter whose `notify` runs once it holds a slot."""
+        with self._lock:
+            if not self.max_active or self._active < self.max_active:
+                self._active += 1
+                self._admitted += 1
+                return None
+            if self._queued >= self.max_queued:
+                self._rejected += 1
+                METRICS.scheduler_rejected.inc()
+                raise QueueFullError("Model queue full")
+            waiter = _GateWaiter(notify)
+            self._seq += 1
+            heapq.heappush(self._heap, (priority, deadline if deadline is not None else math.inf, self._seq, waiter))
+            self._queued += 1
+            return waiter
+
+    def abandon(self, waiter: _GateWaiter, expired: bool) -> bool:
+        """Withdraws a queued waiter. False when it was granted a slot meanwhile (the caller owns it)."""
+        with self._lock:
+            if waiter.granted:
+                return False
+            waiter.abandoned = True
+            self._queued -= 1
+            if expired:
+                self._expired += 1
+        if expired:
+            METRICS.deadline_expired.inc("queue")
+        return True
+
+    def release(self) -> None:
+        with self._lock:
+            while self._heap:
+                waiter = heapq.heappop(self._heap)[3]
+                if waiter.abandoned:
+                    continue
+                # The slot passes straight to the waiter; `_active` is unchanged.
+                waiter.granted = True
+                self._queued -= 1
+                self._admitted += 1
+                break
+            else:
+                self._active -= 1
+                return
+        waiter.notify()
+
+    @contextmanager
+    def slot(self, priority: int, deadline: float | None, cancel: UpstreamCancel | None = None) -> Iterator[None]:
+        """Blocking variant for the threading engine; raises on deadline or supersession while queued."""
+        event = threading.Event()
+        waiter = self.enter(priority, deadline, event.set)
+        if waiter is not None:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if cancel is not None:
+                cancel.add_callback(event.set)
+            try:
+                with trace_span("gate_wait"):
+                    event.wait(timeout)
+            finally:
+                if cancel is not None:
+                    cancel.remove_callback(event.set)
+            cancelled = cancel is not None and cancel.cancelled
+            # abandon() is False when the slot was granted meanwhile; the caller then owns it.
+            if not waiter.granted and self.abandon(waiter, expired=not cancelled):
+                if cancelled:
+                    raise SupersededError("Superseded waiting for a model slot")
+                raise DeadlineExpiredError("Deadline expired waiting for a model slot")
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "max_active": self.max_active,
+                "max_queued": self.max_queued,
+                "active": self._active,
+                "queued": self._queued,
+                "admitted": self._admitted,
+                "expired": self._expired,
+                "rejected": self._rejected,
+            }
+
+
+class _PendingGeneration:
+    def __init__(
+        self,
+        payload: dict[str, Any],
+        deadline: float,
+        route: dict[str, Any] | None,
+        cancel: UpstreamCancel | None,
+    ):
+        self.payload = payload
+        self.deadline = deadline
+        self.route = route
+        self.cancel = cancel
+        self.done = threading.Event()
+        self.result: list[dict[str, str]] | None = None
+        self.error: BaseException | None = None
+
+
+class MicroBatcher:
+    """Sends concurrent single generations of one prompt kind upstream as one multi-item prompt."""
+
+    def __init__(self, config: Config, openai_client: OpenAIClient):
+        self.config = config
+        self.openai_client = openai_client
+        self._lock = threading.Lock()
+        # prompt kind -> (window id, pending generations)
+        self._pending: dict[str, tuple[int, list[_PendingGeneration]]] = {}
+        self._next_window = 0
+        self._batches = 0
+        self._batched_items = 0
+        self._batch_failures = 0
+        self._individual_fallbacks = 0
+
+    def generate(
+        self,
+        payload: dict[str, Any],
+        timeout_sec: float,
+        route: dict[str, Any] | None = None,
+        cancel: UpstreamCancel | None = None,
+    ) -> list[dict[str, str]]:
+        """`cancel` aborts the call when it goes upstream alone; a shared multi-item call is never cancelled."""
+        if not self.config.micro_batch_enabled:
+            return self.openai_client.generate(payload, timeout_sec=timeout_sec, route=route, cancel=cancel)
+
+        pending = _PendingGeneration(payload, time.monotonic() + timeout_sec, route, cancel)
+        kind = prompt_kind_for(generation_inputs(payload)["reply_type"])
+        ready: list[_PendingGeneration] | None = None
+        with self._lock:
+            window = self._pending.get(kind)
+            if window is None:
+                self._next_window += 1
+                window = (self._next_window, [])
+                self._pending[kind] = window
+                # The timer thread flushes under a copy of this context so the batch spans stay traced.
+                context = contextvars.copy_context()
+                timer = threading.Timer(
+                    self.config.micro_batch_window_ms / 1000.0,
+                    context.run,
+                    args=(self._flush_window, kind, window[0]),
+                )
+                timer.daemon = True
+                timer.start()
+            window[1].append(pending)
+            if len(window[1]) >= self.config.micro_batch_max_items:
+                ready = self._pending.pop(kind)[1]
+        if ready is not None:
+            self._dispatch(ready)
+
+        # Each caller enforces its own deadline; the shared call may run longer for a later one.
+        if not pending.done.wait(max(0.0, pending.deadline - time.monotonic())):
+            raise TimeoutError("Timed out waiting for micro-batch")
+        if pending.result is not None:
+            return pending.result
+
+        remaining = pending.deadline - time.monotonic()
+        if remaining < 1:
+            raise pending.error or RuntimeError("Micro-batch produced no result")
+        with self._lock:
+            self._individual_fallbacks += 1
+        return self.openai_client.generate(payload, timeout_sec=remaining, route=route, cancel=cancel)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.micro_batch_enabled,
+                "window_ms": self.config.micro_batch_window_ms,
+                "batches": self._batches,
+                "batched_items": self._batched_items,
+                "batch_failures": self._batch_failures,
+                "individual_fallbacks": self._individual_fallbacks,
+            }
+
+    def _flush_window(self, kind: str, window_id: int) -> None:
+        with self._lock:
+            window = self._pending.get(kind)
+            if window is None or window[0] != window_id:
+                return
+            del self._pending[kind]
+        self._dispatch(window[1])
+
+    def _dispatch(self, batch: list[_PendingGeneration]) -> None:
+        # The shared call gets the largest remaining budget in the window.
+        timeout_sec = max(it.deadline for it in batch) - time.monotonic()
+        if len(batch) == 1:
+            only = batch[0]
+            try:
+                if timeout_sec <= 0:
+                    raise TimeoutError("Deadline passed before micro-batch dispatch")
+                only.result = self.openai_client.generate(
+                    only.payload, timeout_sec=timeout_sec, route=only.route, cancel=only.cancel
+                )
+            except Exception as exc:
+                only.error = exc
+            only.done.set()
+            return
+
+        with self._lock:
+            self._batches += 1
+            self._batched_items += len(batch)
+        route: dict[str, Any] = {"batch_size": len(batch)}
+        try:
+            if timeout_sec <= 0:
+                raise TimeoutError("Deadline passed before micro-batch dispatch")
+            results = self.openai_client.generate_batch(
+                [it.payload for it in batch], timeout_sec=timeout_sec, route=route
+            )
+        except Exception as exc:
+            with self._lock:
+                self._batch_failures += 1
+            results = [exc] * len(batch)
+        for pending, result in zip(batch, results):
+            if pending.route is not None:
+                pending.route.update(route)
+            if isinstance(result, BaseException):
+                pending.error = result
+            else:
+                pending.result = result
+            pending.done.set()
+
+
 class ShadowEvaluator:
+    # primary_source -> logged mode for requests that need no shadow model call
+    LOGGED_SOURCES = {
+        "openai": "shadow_rules_baseline",
+        "rules_fallback": "fallback_triggered",
+        "rules_deadline": "race_deadline",
+        "superseded": "superseded",
+    }
+
     def __init__(self, config: Config, openai_client: OpenAIClient):
         self.config = config
         self.openai_client = openai_client
-        self._log_lock = threading.Lock()
-        log_path = Path(self.config.shadow_log_path)
-        log_path.parent.mkdir(parents=True, exist_ok=True)
+        self.log_writer = ShadowLogWriter(config)
+        self.executor = ShadowExecutor(config)
 
     def maybe_enqueue(
         self,
@@ -424,6 +1459,7 @@ class ShadowEvaluator:
         primary_source: str,
         primary_error: str,
         rules_output: list[dict[str, str]],
+        request_meta: dict[str, Any] | None = None,
     ) -> None:
         if not self.config.shadow_mode:
             return
@@ -431,51 +1467,36 @@ class ShadowEvaluator:
             return
 
         # OpenAI primary: shadow compares against rules baseline (no extra model request cost).
-        if primary_source == "openai":
+        # OpenAI fallback, race soft deadline and supersession: rules served, log the path explicitly.
+        mode = self.LOGGED_SOURCES.get(primary_source)
+        if mode is not None:
+            shadow_output = rules_output if primary_source == "openai" else []
             self._append_log(
-                {
-                    "timestamp": now_iso(),
-                    "request_id": request_id,
-                    "install_id": install_id,
-                    "mode": "shadow_rules_baseline",
-                    "model": self.config.openai_model,
-                    "primary_source": primary_source,
-                    "error": primary_error,
-                    "primary_texts": [it["text"] for it in primary_output],
-                    "shadow_texts": [it["text"] for it in rules_output],
-                    "overlap_count": overlap_count(primary_output, rules_output),
-                    "context_summary": self._context_summary(payload),
-                }
-            )
-            return
-
-        # OpenAI fallback triggered: log failure path explicitly.
-        if primary_source == "rules_fallback":
-            self._append_log(
-                {
-                    "timestamp": now_iso(),
-                    "request_id": request_id,
-                    "install_id": install_id,
-                    "mode": "fallback_triggered",
-                    "model": self.config.openai_model,
-                    "primary_source": primary_source,
-                    "error": primary_error,
-                    "primary_texts": [it["text"] for it in primary_output],
-                    "shadow_texts": [],
-                    "overlap_count": 0,
-                    "context_summary": self._context_summary(payload),
-                }
+                self._row(
+                    mode,
+                    request_id,
+                    install_id,
+                    payload,
+                    primary_source,
+                    primary_error,
+                    primary_output,
+                    shadow_output,
+                    request_meta or {},
+                )
             )
             return
 
         # Rules primary mode: optionally evaluate OpenAI in shadow.
         if primary_source == "rules_primary":
-            thread = threading.Thread(
-                target=self._rules_primary_shadow_run,
-                args=(request_id, install_id, payload, primary_output),
-                daemon=True,
+            self.executor.submit(
+                install_id,
+                self._rules_primary_shadow_run,
+                request_id,
+                install_id,
+                payload,
+                primary_output,
+                request_meta or {},
             )
-            thread.start()
 
     def _rules_primary_shadow_run(
         self,
@@ -483,6 +1504,7 @@ class ShadowEvaluator:
         install_id: str,
         payload: dict[str, Any],
         primary_output: list[dict[str, str]],
+        request_meta: dict[str, Any],
     ) -> None:
         started = time.time()
         error = ""
@@ -494,22 +1516,54 @@ class ShadowEvaluator:
         latency_ms = int((time.time() - started) * 1000)
 
         self._append_log(
-            {
-                "timestamp": now_iso(),
-                "request_id": request_id,
-                "install_id": install_id,
-                "mode": "shadow_openai_compare",
-                "model": self.config.openai_model,
-                "latency_ms": latency_ms,
-                "primary_source": "rules_primary",
-                "error": error,
-                "primary_texts": [it["text"] for it in primary_output],
-                "shadow_texts": [it["text"] for it in shadow_output],
-                "overlap_count": overlap_count(primary_output, shadow_output),
-                "context_summary": self._context_summary(payload),
-            }
+            self._row(
+                "shadow_openai_compare",
+                request_id,
+                install_id,
+                payload,
+                "rules_primary",
+                error,
+                primary_output,
+                shadow_output,
+                request_meta,
+                latency_ms=latency_ms,
+            )
         )
 
+    def _row(
+        self,
+        mode: str,
+        request_id: str,
+        install_id: str,
+        payload: dict[str, Any],
+        primary_source: str,
+        error: str,
+        primary_output: list[dict[str, str]],
+        shadow_output: list[dict[str, str]],
+        request_meta: dict[str, Any],
+        **extra: Any,
+    ) -> dict[str, Any]:
+        return {
+            "timestamp": now_iso(),
+            "request_id": request_id,
+            "install_id": install_id,
+            "mode": mode,
+            "model": self.config.openai_model,
+            **extra,
+            "primary_source": primary_source,
+            "error": error,
+            "primary_texts": [it["text"] for it in primary_output],
+            "shadow_texts": [it["text"] for it in shadow_output],
+            "overlap_count": overlap_count(primary_output, shadow_output),
+            "context_summary": self._context_summary(payload),
+            "request_meta": request_meta,
+        }
+
+    def log_circuit_transition(self, transition: dict[str, Any]) -> None:
+        if not self.config.shadow_mode:
+            return
+        self._append_log({**transition, "mode": "circuit_transition", "model": self.config.openai_model})
+
     def _context_summary(self, payload: dict[str, Any]) -> dict[str, Any]:
         ctx = payload.get("context", {}) if isinstance(payload.get("context"), dict) else {}
         return {
@@ -520,113 +1574,1127 @@ class ShadowEvaluator:
         }
 
     def _append_log(self, row: dict[str, Any]) -> None:
-        serialized = json.dumps(row, ensure_ascii=False)
-        with self._log_lock:
-            with open(self.config.shadow_log_path, "a", encoding="utf-8") as f:
-                f.write(serialized + "\n")
+        self.log_writer.submit(row)
+
+
+class StackProfiler:
+    """Wall-clock sampling profiler behind GET /admin/profile; one profile runs at a time."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._running = False
+        self._runs = 0
+
+    def run(self, seconds: float, limit: int) -> dict[str, Any] | None:
+        """Samples for `seconds` (capped at PROFILE_MAX_SEC); None when another profile is running."""
+        with self._lock:
+            if self._running:
+                return None
+            self._running = True
+            self._runs += 1
+        try:
+            return self._sample(min(seconds, self.config.profile_max_sec), limit)
+        finally:
+            with self._lock:
+                self._running = False
+
+    def _sample(self, seconds: float, limit: int) -> dict[str, Any]:
+        interval_sec = self.config.profile_interval_ms / 1000.0
+        own = threading.get_ident()
+        stacks: dict[str, int] = {}
+        lines: dict[str, int] = {}
+        rounds = 0
+        thread_samples = 0
+        started = time.perf_counter()
+        deadline = started + seconds
+        while True:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                code = frame.f_code
+                line = f"{code.co_qualname} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                lines[line] = lines.get(line, 0) + 1
+                parts: list[str] = []
+                while frame is not None:
+                    parts.append(f"{frame.f_code.co_qualname} ({os.path.basename(frame.f_code.co_filename)})")
+                    frame = frame.f_back
+                parts.append(names.get(ident, f"thread-{ident}"))
+                stack = ";".join(reversed(parts))
+                stacks[stack] = stacks.get(stack, 0) + 1
+                thread_samples += 1
+            rounds += 1
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            time.sleep(min(interval_sec, remaining))
+
+        def top(counts: dict[str, int], key: str) -> list[dict[str, Any]]:
+            ranked = sorted(counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+            return [
+                {key: name, "samples": count, "ratio": round(count / thread_samples, 4)} for name, count in ranked
+            ]
+
+        return {
+            "pid": os.getpid(),
+            "seconds": round(time.perf_counter() - started, 3),
+            "interval_ms": self.config.profile_interval_ms,
+            "rounds": rounds,
+            "samples": thread_samples,
+            "stacks": top(stacks, "stack"),
+            "lines": top(lines, "line"),
+        }
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {"enabled": bool(self.config.admin_token), "running": self._running, "runs": self._runs}
 
 
-CONFIG = Config()
 OPENAI = OpenAIClient(CONFIG)
 SHADOW = ShadowEvaluator(CONFIG, OPENAI)
+CACHE = ResponseCache(CONFIG)
+STORE = SuggestionStore(CONFIG)
+NEAR_DUP = NearDuplicateIndex(CONFIG)
+SINGLE_FLIGHT = SingleFlight(CONFIG)
+PREFETCH = PrefetchStore(CONFIG)
+SUPERSESSION = SupersessionRegistry(CONFIG)
+MICRO_BATCHER = MicroBatcher(CONFIG, OPENAI)
+BREAKER = CircuitBreaker(CONFIG, on_transition=SHADOW.log_circuit_transition)
+ADMISSION = AdmissionController(CONFIG)
+MODEL_GATE = PriorityGate(CONFIG.model_max_concurrency, CONFIG.model_queue_depth)
+TRACER = Tracer(CONFIG)
+PROFILER = StackProfiler(CONFIG)
+# Set inside pre-forked workers only.
+WORKER_STATE: "WorkerState | None" = None
+
+
+def health_payload(include_workers: bool = True) -> dict[str, Any]:
+    payload = {
+        "ok": True,
+        "server_mode": CONFIG.server_mode,
+        "primary_mode": CONFIG.primary_mode,
+        "shadow_mode": CONFIG.shadow_mode,
+        "shadow_sample_rate": CONFIG.shadow_sample_rate,
+        "openai_model": CONFIG.openai_model,
+        "openai_key_present": bool(CONFIG.openai_api_key),
+        "response_cache": CACHE.stats(),
+        "persistent_cache": STORE.stats(),
+        "near_duplicate": NEAR_DUP.stats(),
+        "prompt": OPENAI.prompts.stats(),
+        "single_flight": SINGLE_FLIGHT.stats(),
+        "prefetch": PREFETCH.stats(),
+        "supersession": SUPERSESSION.stats(),
+        "upstream_pools": OPENAI.pools.stats(),
+        "upstream_router": OPENAI.router.stats(),
+        "micro_batch": MICRO_BATCHER.stats(),
+        "shadow_log": SHADOW.log_writer.stats(),
+        "shadow_executor": SHADOW.executor.stats(),
+        "circuit_breaker": BREAKER.stats(),
+        "admission": ADMISSION.stats(),
+        "scheduler": MODEL_GATE.stats(),
+        "wire": {
+            "max_request_bytes": CONFIG.max_request_bytes,
+            "response_compression": CONFIG.response_compression,
+            "compression_min_bytes": CONFIG.compression_min_bytes,
+            "rules_responses_cached": len(_RULES_RESPONSES),
+        },
+        "tracing": TRACER.stats(),
+        "profiler": PROFILER.stats(),
+    }
+    if WORKER_STATE is not None:
+        payload["worker"] = WORKER_STATE.identity()
+        if include_workers:
+            payload["workers"] = WORKER_STATE.peer_health()
+    return payload
+
+
+def metrics_text() -> str:
+    """Prometheus exposition; in pre-fork mode summed over all workers' latest snapshots."""
+    return METRICS.render(WORKER_STATE.peer_metrics() if WORKER_STATE is not None else [])
+
+
+ADMIN_PROFILE_PATH = "/admin/profile"
+
+
+def admin_profile(query: str, authorization: str) -> tuple[int, dict[str, Any], dict[str, str]]:
+    """GET /admin/profile?seconds=5&limit=50 -> (status, body, headers); blocks while profiling."""
+    if not CONFIG.admin_token:
+        return 404, {"error": "Not found"}, {}
+    scheme, _, supplied = authorization.strip().partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(supplied.strip().encode(), CONFIG.admin_token.encode()):
+        return 401, {"error": "Unauthorized"}, {"WWW-Authenticate": "Bearer"}
+    params = parse_qs(query)
+    try:
+        seconds = float(params.get("seconds", ["5"])[0])
+        limit = int(params.get("limit", ["50"])[0])
+    except ValueError:
+        return 400, {"error": "Invalid query"}, {}
+    if not seconds > 0 or limit < 1:
+        return 400, {"error": "Invalid query"}, {}
+    profile = PROFILER.run(seconds, limit)
+    if profile is None:
+        return 409, {"error": "A profile is already running"}, {}
+    return 200, profile, {}
+
+
+def parse_suggestions_body(body: bytes) -> tuple[dict[str, Any] | None, str]:
+    """Returns (payload, error). Exactly one of them is set."""
+    try:
+        with trace_span("parse_json"):
+            payload = json.loads(body.decode("utf-8"))
+    except Exception:
+        return None, "Invalid JSON"
+    if not isinstance(payload, dict):
+        return None, "Invalid request"
+    return payload, ""
+
+
+JSON_CONTENT_TYPE = "application/json; charset=utf-8"
+CONTENT_ENCODINGS = ("gzip", "deflate")
+# zlib window bits per Content-Encoding: gzip container, zlib-wrapped deflate (RFC 9110).
+_ENCODING_WBITS = {"gzip": 31, "deflate": 15}
+
+
+class BodyRejectedError(ValueError):
+    def __init__(self, status: int, reason: str, message: str):
+        super().__init__(message)
+        self.status = status
+        self.reason = reason
+
+
+def check_content_length(raw: str | None) -> int:
+    """Validated Content-Length; raises BodyRejectedError (413 before any of the body is read)."""
+    try:
+        content_len = int(raw or "0")
+    except ValueError:
+        content_len = -1
+    if content_len < 0:
+        METRICS.body_rejected.inc("malformed")
+        raise BodyRejectedError(400, "malformed", "Invalid Content-Length")
+    if content_len > CONFIG.max_request_bytes:
+        METRICS.body_rejected.inc("too_large")
+        raise BodyRejectedError(413, "too_large", f"Request body too large (max {CONFIG.max_request_bytes} bytes)")
+    return content_len
+
+
+class RequestBodyDecoder:
+    """Incremental body decoding capped at MAX_REQUEST_BYTES; raises BodyRejectedError."""
+
+    def __init__(self, content_encoding: str | None):
+        encoding = (content_encoding or "identity").strip().lower()
+        if encoding not in {"identity", *CONTENT_ENCODINGS}:
+            METRICS.body_rejected.inc("encoding")
+            raise BodyRejectedError(415, "encoding", f"Unsupported Content-Encoding: {encoding}")
+        self.encoding = encoding
+        self._decompressor = zlib.decompressobj(_ENCODING_WBITS[encoding]) if encoding != "identity" else None
+        self._parts: list[bytes] = []
+        self._wire_bytes = 0
+        self._size = 0
+        self._elapsed = 0.0
+
+    def feed(self, chunk: bytes) -> None:
+        self._wire_bytes += len(chunk)
+        if self._decompressor is None:
+            self._append(chunk)
+            return
+        started = time.perf_counter()
+        try:
+            out = self._decompressor.decompress(chunk, CONFIG.max_request_bytes - self._size + 1)
+        except zlib.error:
+            METRICS.body_rejected.inc("malformed")
+            raise BodyRejectedError(400, "malformed", "Invalid compressed body") from None
+        finally:
+            self._elapsed += time.perf_counter() - started
+        self._append(out)
+        if self._decompressor.unconsumed_tail:
+            self._reject_size()
+
+    def finish(self) -> bytes:
+        if self._decompressor is not None:
+            if not self._decompressor.eof:
+                METRICS.body_rejected.inc("malformed")
+                raise BodyRejectedError(400, "malformed", "Truncated compressed body")
+            METRICS.compression.observe(self._elapsed, "request")
+            METRICS.body_bytes.inc("request", "wire", amount=self._wire_bytes)
+            METRICS.body_bytes.inc("request", "raw", amount=self._size)
+        return b"".join(self._parts)
+
+    def _append(self, data: bytes) -> None:
+        self._size += len(data)
+        if self._size > CONFIG.max_request_bytes:
+            self._reject_size()
+        self._parts.append(data)
+
+    def _reject_size(self) -> None:
+        METRICS.body_rejected.inc("too_large")
+        raise BodyRejectedError(413, "too_large", f"Request body too large (max {CONFIG.max_request_bytes} bytes)")
+
+
+def negotiate_encoding(accept_encoding: str | None) -> str:
+    """Preferred of gzip/deflate by Accept-Encoding q-value (header order breaks ties), else identity."""
+    if not CONFIG.response_compression or not accept_encoding:
+        return "identity"
+    best, best_q = "identity", 0.0
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        name = name.strip().lower()
+        quality = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if name == "*":
+            name = "gzip"
+        if name in CONTENT_ENCODINGS and quality > best_q:
+            best, best_q = name, quality
+    return best
+
+
+def encode_response(raw: bytes, encoding: str) -> tuple[bytes, dict[str, str]]:
+    """(body, headers) for a negotiated `encoding`; bodies under COMPRESSION_MIN_BYTES stay identity."""
+    if not CONFIG.response_compression:
+        return raw, {}
+    if encoding == "identity" or len(raw) < CONFIG.compression_min_bytes:
+        return raw, {"Vary": "Accept-Encoding"}
+    with METRICS.compression.time("response"):
+        if encoding == "gzip":
+            body = gzip.compress(raw, compresslevel=CONFIG.compression_level, mtime=0)
+        else:
+            body = zlib.compress(raw, CONFIG.compression_level)
+    METRICS.body_bytes.inc("response", "raw", amount=len(raw))
+    METRICS.body_bytes.inc("response", "wire", amount=len(body))
+    return body, {"Content-Encoding": encoding, "Vary": "Accept-Encoding"}
+
+
+def json_bytes(payload: dict[str, Any]) -> bytes:
+    with METRICS.serialization.time():
+        return json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+
+class SuggestionJob:
+    """Per-request state for /v1/reply-suggestions, shared by the threading and asyncio engines."""
+
+    def __init__(
+        self,
+        payload: dict[str, Any],
+        install_id: str,
+        rate_limited: bool = False,
+        deadline: float | None = None,
+        priority: int | None = None,
+        prefetch_token: str = "",
+        batch_index: int | None = None,
+    ):
+        self.payload = payload
+        self.install_id = install_id
+        self.rate_limited = rate_limited
+        # time.monotonic() by which the client needs an answer (None = no deadline); lower priority runs first.
+        self.deadline = deadline
+        self.priority = default_priority(payload) if priority is None else priority
+        self.prefetch_token = prefetch_token
+        # Set by needs_model() when a still-running prefetch will answer this request.
+        self.prefetch_call: Any = None
+        self.batch_index = batch_index
+        # Supersession (see SupersessionRegistry): `cancel` aborts this job's own upstream call.
+        self.superseded = False
+        self.supersede_key: tuple[str, str] | None = None
+        self.upstream_started = False
+        self.cancel = UpstreamCancel()
+        self.request_id = str(uuid.uuid4())
+        self.started = time.perf_counter()
+        self.desired_count = desired_count_from_payload(payload)
+        with METRICS.rules_duration.time():
+            self.rules_output = generate_rules_suggestions(payload)
+        self.primary_output = self.rules_output
+        self.primary_source = "rules_primary"
+        self.primary_error = ""
+        self.cache_key = ""
+        # Persistent-store result, see `load_stored`.
+        self.stored: list[dict[str, str]] | None = None
+        self.store_loaded = False
+        self.response_headers: dict[str, str] = {}
+        self.request_meta: dict[str, Any] = {}
+        # Filled by the upstream router, possibly from another thread; copied into request_meta on resolve.
+        self.route: dict[str, Any] = {}
+        self.request_meta["priority"] = self.priority
+        if batch_index is not None:
+            self.request_meta["batch_index"] = batch_index
+        if deadline is not None:
+            self.request_meta["deadline_ms"] = int((deadline - time.monotonic()) * 1000)
+        if CONFIG.primary_mode not in {"openai", "rules", "race"}:
+            self.primary_error = f"Unknown PRIMARY_MODE={CONFIG.primary_mode}, using rules"
+
+    def wants_store(self) -> bool:
+        """True when needs_model() would read the persistent store: a model mode and a response-cache miss."""
+        if not CONFIG.persistent_cache_enabled or CONFIG.primary_mode not in {"openai", "race"}:
+            return False
+        self.cache_key = generation_key(self.payload)
+        return not CACHE.contains(self.cache_key)
+
+    def load_stored(self) -> list[dict[str, str]] | None:
+        """Persistent-store lookup, read once per job (blocking; the asyncio engine uses a thread)."""
+        if not self.store_loaded:
+            self.stored = STORE.get(self.cache_key)
+            self.store_loaded = True
+        return self.stored
+
+    def needs_model(self) -> bool:
+        """True when the model must be called; serves cache hits and finished prefetches in place."""
+        if CONFIG.primary_mode not in {"openai", "race"}:
+            return False
+        self.cache_key = generation_key(self.payload)
+        if self._claim_prefetch():
+            return self.prefetch_call is not None
+        with trace_span("cache_lookup"):
+            cached = CACHE.get(self.cache_key)
+            self.response_headers["X-Cache"] = "hit" if cached is not None else "miss"
+            if cached is not None:
+                STORE.record_hit(self.cache_key)
+            else:
+                cached = self.load_stored()
+                if cached is not None:
+                    self.response_headers["X-Cache"] = "store"
+                    CACHE.put(self.cache_key, cached)
+            if cached is None and NEAR_DUP.applies_to(self.payload):
+                cached, score = NEAR_DUP.lookup(self.payload)
+                self.request_meta["near_dup"] = {"reused": cached is not None, "score": round(score, 3)}
+                if cached is not None:
+                    self.response_headers["X-Cache"] = "near"
+                    CACHE.put(self.cache_key, cached)
+        self.request_meta["cache"] = self.response_headers["X-Cache"]
+        if cached is None and self.rate_limited:
+            # Admission control downgrade: over-limit clients get rules, cache hits stay free.
+            self.resolve_fallback(RateLimitedError("Rate limited: model call skipped"))
+            return False
+        if cached is None and self.expired():
+            METRICS.deadline_expired.inc("received")
+            self.resolve_fallback(DeadlineExpiredError("Deadline expired before the model call"))
+            return False
+        if cached is None:
+            self.request_meta["circuit_state"] = BREAKER.state
+            with trace_span("prompt_compact"):
+                self.request_meta["prompt"] = OPENAI.prompts.compact(self.payload)[2]
+            return True
+        self.primary_output = cached
+        self.primary_source = "openai"
+        return False
+
+    def _claim_prefetch(self) -> bool:
+        claimed = PREFETCH.claim(self.prefetch_token, self.cache_key)
+        if claimed is None:
+            return False
+        call, state = claimed
+        self.request_meta["prefetch"] = state
+        self.request_meta["cache"] = self.response_headers["X-Cache"] = "prefetch"
+        if state == "pending":
+            self.prefetch_call = call
+        else:
+            self.primary_output = call_state(call)[1]
+            self.primary_source = "openai"
+        return True
+
+    def remaining_sec(self) -> float | None:
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+    def expired(self) -> bool:
+        """True when too little of the deadline is left for a model call to be useful."""
+        remaining = self.remaining_sec()
+        return remaining is not None and remaining * 1000 < CONFIG.deadline_min_upstream_ms
+
+    def wait_sec(self, timeout_sec: float | None) -> float | None:
+        """`timeout_sec` clipped to the remaining deadline (None = no limit)."""
+        remaining = self.remaining_sec()
+        if remaining is None:
+            return timeout_sec
+        remaining = max(0.0, remaining)
+        return remaining if timeout_sec is None else min(timeout_sec, remaining)
+
+    @contextmanager
+    def upstream_budget(self, timeout_sec: float) -> Iterator[float]:
+        """Yields the upstream timeout clipped to the remaining deadline."""
+        if self.cancel.cancelled:
+            raise SupersededError("Superseded before the model call")
+        remaining = self.remaining_sec()
+        clipped = remaining is not None and remaining < timeout_sec
+        if clipped and self.expired():
+            METRICS.deadline_expired.inc("upstream")
+            raise DeadlineExpiredError("Deadline expired before the model call")
+        self.upstream_started = True
+        try:
+            yield remaining if clipped else timeout_sec
+        except Exception as exc:
+            if self.cancel.cancelled:
+                raise SupersededError("Superseded during the model call") from exc
+            if not clipped or fallback_reason(exc) != "timeout":
+                raise
+            METRICS.deadline_expired.inc("upstream")
+            raise DeadlineExpiredError("Deadline expired during the model call") from exc
+
+    def resolve_model(self, output: list[dict[str, str]], coalesced_waiters: int) -> None:
+        self.primary_output = output
+        self.primary_source = "openai"
+        self.response_headers["X-Coalesced-Waiters"] = str(coalesced_waiters)
+        self.request_meta["coalesced_waiters"] = coalesced_waiters
+        self._settle()
+
+    def resolve_fallback(self, exc: BaseException) -> None:
+        if self.superseded:
+            # The failure is the abandoned call itself (or irrelevant now): answer as superseded.
+            self.resolve_superseded()
+            return
+        self.primary_output = self.rules_output
+        self.primary_source = "rules_fallback"
+        self.primary_error = str(exc)
+        METRICS.fallbacks.inc(fallback_reason(exc))
+        self._settle()
+
+    def resolve_superseded(self) -> None:
+        """A newer request from the same install replaced this one: cheap rules answer, no model spend."""
+        if not self.cancel.cancelled:
+            stage = "detached"
+        else:
+            stage = "upstream" if self.upstream_started else "before_upstream"
+        prompt = self.request_meta.get("prompt") or {}
+        saved_tokens = 0
+        if stage == "before_upstream":
+            saved_tokens = prompt.get("system_tokens", 0) + prompt.get("user_tokens", 0)
+        self.primary_output = self.rules_output
+        self.primary_source = "superseded"
+        self.request_meta["superseded"] = stage
+        SUPERSESSION.record(stage, saved_tokens)
+        self._settle()
+
+    def _settle(self) -> None:
+        SUPERSESSION.release(self)
+        if self.route:
+            self.request_meta["upstream"] = dict(self.route)
+
+    def resolve_deadline(self) -> None:
+        """Race mode: the model missed the soft deadline and keeps running in the background."""
+        self.primary_output = self.rules_output
+        self.primary_source = "rules_deadline"
+        self.request_meta["soft_deadline_ms"] = CONFIG.race_soft_deadline_ms
+        METRICS.fallbacks.inc("soft_deadline")
+        SUPERSESSION.release(self)
+
+    def response_payload(self) -> dict[str, Any]:
+        return {
+            "source": self.primary_source,
+            "suggestions": self.primary_output[: self.desired_count],
+        }
+
+    def finish(self) -> None:
+        """Records request metrics and hands the request to the shadow evaluator."""
+        METRICS.request_duration.observe(time.perf_counter() - self.started, self.primary_source)
+        if self.batch_index is None:
+            trace_annotate(request_id=self.request_id, source=self.primary_source, cache=self.request_meta.get("cache"))
+        with trace_span("shadow_enqueue"):
+            SHADOW.maybe_enqueue(
+                request_id=self.request_id,
+                install_id=self.install_id,
+                payload=self.payload,
+                primary_output=self.primary_output[: self.desired_count],
+                primary_source=self.primary_source,
+                primary_error=self.primary_error,
+                rules_output=self.rules_output[: self.desired_count],
+                request_meta=self.request_meta,
+            )
+
+
+PREFETCH_PATH = "/v1/reply-suggestions:prefetch"
+SUGGESTION_PATHS = {
+    "/v1/reply-suggestions",
+    "/v1/reply-suggestions:stream",
+    "/v1/reply-suggestions:batch",
+    PREFETCH_PATH,
+}
+
+
+def sse_event(event: str, data: dict[str, Any]) -> bytes:
+    with METRICS.serialization.time():
+        return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+# (source, rules_key, encoding) -> encoded response body and its content headers.
+_RULES_RESPONSES: dict[tuple[str, tuple[str, str, str, int, int, str, int], str], tuple[bytes, dict[str, str]]] = {}
+RULES_RESPONSES_MAX = 16384
+
+
+def job_response_body(job: SuggestionJob, encoding: str) -> tuple[bytes, dict[str, str]]:
+    """Encoded response body and content headers for `job`; rules answers are built once."""
+    if job.primary_output is not job.rules_output:
+        return encode_response(json_bytes(job.response_payload()), encoding)
+    key = (job.primary_source, rules_key(job.payload), encoding)
+    encoded = _RULES_RESPONSES.get(key)
+    if encoded is None:
+        encoded = encode_response(json_bytes(job.response_payload()), encoding)
+        if len(_RULES_RESPONSES) < RULES_RESPONSES_MAX:
+            _RULES_RESPONSES[key] = encoded
+    return encoded
+
+
+def parse_batch_items(payload: dict[str, Any]) -> tuple[list[Any] | None, str]:
+    """Validates a /v1/reply-suggestions:batch body. Returns (items, error)."""
+    items = payload.get("requests")
+    if not isinstance(items, list) or not items:
+        return None, "Invalid request"
+    if len(items) > CONFIG.batch_max_items:
+        return None, f"Too many requests in batch (max {CONFIG.batch_max_items})"
+    return items, ""
+
+
+def remember_output(job: SuggestionJob, output: list[dict[str, str]]) -> None:
+    """Stores a fresh model result for exact (response cache, persistent store) and near-duplicate reuse."""
+    CACHE.put(job.cache_key, output)
+    STORE.put(job.cache_key, output)
+    if NEAR_DUP.applies_to(job.payload):
+        NEAR_DUP.add(job.payload, output)
+
+
+def start_prefetch(job: SuggestionJob, start: Callable[[], Any]) -> tuple[int, dict[str, Any]]:
+    """Registers a speculative generation for `job`; returns (status, body) for :prefetch."""
+    if CONFIG.primary_mode not in {"openai", "race"} or job.rate_limited:
+        return 200, {"status": "skipped", "claim_token": None}
+    job.cache_key = generation_key(job.payload)
+    token = PREFETCH.find(job.cache_key)
+    if token is not None:
+        return 200, {"status": "existing", "claim_token": token}
+    if CACHE.get(job.cache_key) is not None or job.load_stored() is not None:
+        return 200, {"status": "cached", "claim_token": None}
+    token = PREFETCH.add(job.cache_key, start())
+    return 202, {"status": "started", "claim_token": token, "ttl_ms": int(CONFIG.prefetch_ttl_sec * 1000)}
+
+
+def cancel_unshared_call(job: SuggestionJob) -> None:
+    """Threading-engine supersession callback: aborts the job's call unless others share it."""
+    if job.prefetch_call is None and SINGLE_FLIGHT.waiters(job.cache_key) == 0:
+        job.cancel.cancel()
+
+
+def generate_and_cache(job: SuggestionJob) -> list[dict[str, str]]:
+    BREAKER.allow()
+    with (
+        MODEL_GATE.slot(job.priority, job.deadline, job.cancel),
+        BREAKER.call() as timeout_sec,
+        job.upstream_budget(timeout_sec) as budget_sec,
+        trace_span("upstream"),
+    ):
+        output = MICRO_BATCHER.generate(job.payload, timeout_sec=budget_sec, route=job.route, cancel=job.cancel)
+    remember_output(job, output)
+    return output
 
 
 class ReplyHandler(BaseHTTPRequestHandler):
     server_version = "AIReplyBackend/1.1"
 
-    def _write_json(self, status: int, payload: dict[str, Any]) -> None:
-        raw = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    def _write_json(
+        self, status: int, payload: dict[str, Any] | SuggestionJob, headers: dict[str, str] | None = None
+    ) -> None:
+        """Writes `payload` (or a job's response) compressed as the client's Accept-Encoding allows."""
+        encoding = negotiate_encoding(self.headers.get("Accept-Encoding"))
+        if isinstance(payload, SuggestionJob):
+            raw, encoding_headers = job_response_body(payload, encoding)
+        else:
+            raw, encoding_headers = encode_response(json_bytes(payload), encoding)
+        self._write_body(status, raw, JSON_CONTENT_TYPE, {**encoding_headers, **(headers or {})})
+
+    def _write_body(self, status: int, raw: bytes, content_type: str, headers: dict[str, str] | None = None) -> None:
         self.send_response(status)
-        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Type", content_type)
         self.send_header("Content-Length", str(len(raw)))
-        self.end_headers()
-        self.wfile.write(raw)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        with trace_span("write"):
+            self.end_headers()
+            self.wfile.write(raw)
+
+    def send_response(self, code: int, message: str | None = None) -> None:
+        trace_annotate(status=code)
+        super().send_response(code, message)
 
     def do_GET(self) -> None:
         if self.path == "/health":
-            self._write_json(
-                200,
-                {
-                    "ok": True,
-                    "primary_mode": CONFIG.primary_mode,
-                    "shadow_mode": CONFIG.shadow_mode,
-                    "shadow_sample_rate": CONFIG.shadow_sample_rate,
-                    "openai_model": CONFIG.openai_model,
-                    "openai_key_present": bool(CONFIG.openai_api_key),
-                },
+            self._write_json(200, health_payload())
+            return
+        if self.path == "/metrics":
+            raw, headers = encode_response(
+                metrics_text().encode("utf-8"), negotiate_encoding(self.headers.get("Accept-Encoding"))
             )
+            self._write_body(200, raw, METRICS_CONTENT_TYPE, headers)
+            return
+        url = urlsplit(self.path)
+        if url.path == ADMIN_PROFILE_PATH:
+            status, body, headers = admin_profile(url.query, self.headers.get("Authorization", ""))
+            self._write_json(status, body, headers=headers)
             return
         self._write_json(404, {"error": "Not found"})
 
     def do_POST(self) -> None:
-        if self.path != "/v1/reply-suggestions":
-            self._write_json(404, {"error": "Not found"})
-            return
+        METRICS.requests_in_flight.inc()
+        try:
+            with TRACER.request(f"POST {self.path}"):
+                self._handle_post()
+        finally:
+            METRICS.requests_in_flight.dec()
 
-        content_len = int(self.headers.get("Content-Length", "0"))
-        if content_len <= 0:
-            self._write_json(400, {"error": "Empty body"})
+    def _handle_post(self) -> None:
+        if self.path not in SUGGESTION_PATHS or (self.path == PREFETCH_PATH and not CONFIG.prefetch_enabled):
+            self._write_json(404, {"error": "Not found"})
             return
 
-        body = self.rfile.read(content_len)
         try:
-            payload = json.loads(body.decode("utf-8"))
-        except Exception:
-            self._write_json(400, {"error": "Invalid JSON"})
+            content_len = check_content_length(self.headers.get("Content-Length"))
+            if content_len <= 0:
+                self._write_json(400, {"error": "Empty body"})
+                return
+            with trace_span("read_body"):
+                body = self._read_body(content_len)
+        except BodyRejectedError as exc:
+            # The rest of the body is left unread, so the connection cannot be reused.
+            self.close_connection = True
+            self._write_json(exc.status, {"error": str(exc)})
             return
-
-        if not isinstance(payload, dict):
-            self._write_json(400, {"error": "Invalid request"})
+        payload, error = parse_suggestions_body(body)
+        if payload is None:
+            self._write_json(400, {"error": error})
             return
 
         install_id = str(self.headers.get("X-Install-Id", "")).strip()
-        request_id = str(uuid.uuid4())
-        desired_count = desired_count_from_payload(payload)
+        schedule = request_schedule(self.headers.get)
+        is_batch = self.path == "/v1/reply-suggestions:batch"
+        decision, retry_after = ADMISSION.check(
+            admission_key(install_id, self.client_address[0]), request_cost(payload, is_batch)
+        )
+        if decision == "reject":
+            self._write_json(429, {"error": "Rate limited"}, headers=retry_after_header(retry_after))
+            return
+        rate_limited = decision == "downgrade"
+        if is_batch:
+            self._handle_batch(payload, install_id, rate_limited, schedule)
+            return
+        if self.path == PREFETCH_PATH:
+            job = SuggestionJob(payload, install_id=install_id, rate_limited=rate_limited, priority=PRIORITIES["low"])
+            status, body = start_prefetch(
+                job, lambda: SINGLE_FLIGHT.submit(job.cache_key, lambda: generate_and_cache(job), count_waiter=False)
+            )
+            self._write_json(status, body)
+            return
+        prefetch_token = str(self.headers.get("X-Prefetch-Token", "")).strip()
+        job = SuggestionJob(
+            payload, install_id=install_id, rate_limited=rate_limited, prefetch_token=prefetch_token, **schedule
+        )
+        if self.path == "/v1/reply-suggestions:stream":
+            self._stream_suggestions(job)
+            return
 
-        rules_output = generate_rules_suggestions(payload)
-        primary_output = rules_output
-        primary_source = "rules_primary"
-        primary_error = ""
+        self._resolve_job(job)
+        self._write_json(200, job, headers=job.response_headers)
+        job.finish()
+
+    def _read_body(self, content_len: int) -> bytes:
+        """Reads and decodes (Content-Encoding) the request body in chunks, within MAX_REQUEST_BYTES."""
+        decoder = RequestBodyDecoder(self.headers.get("Content-Encoding"))
+        remaining = content_len
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64 * 1024))
+            if not chunk:
+                METRICS.body_rejected.inc("malformed")
+                raise BodyRejectedError(400, "malformed", "Incomplete body")
+            remaining -= len(chunk)
+            decoder.feed(chunk)
+        return decoder.finish()
+
+    def _resolve_job(self, job: SuggestionJob) -> None:
+        if job.needs_model():
+            SUPERSESSION.register(job, lambda: cancel_unshared_call(job))
+            with trace_span("model_call"):
+                if job.prefetch_call is not None:
+                    self._await_call(job, job.prefetch_call)
+                elif CONFIG.primary_mode == "race":
+                    self._await_call(job, SINGLE_FLIGHT.submit(job.cache_key, lambda: generate_and_cache(job)))
+                else:
+                    self._call_model(job)
+
+    def _handle_batch(
+        self, payload: dict[str, Any], install_id: str, rate_limited: bool, schedule: dict[str, Any]
+    ) -> None:
+        """Resolves every item concurrently through the regular pipeline; results keep input order."""
+        items, error = parse_batch_items(payload)
+        if items is None:
+            self._write_json(400, {"error": error})
+            return
 
-        if CONFIG.primary_mode == "openai":
+        results: list[dict[str, Any]] = [{"status": 400, "error": "Invalid request"} for _ in items]
+        jobs: list[tuple[int, SuggestionJob]] = []
+        for index, item in enumerate(items):
+            if isinstance(item, dict):
+                job = SuggestionJob(
+                    item, install_id=install_id, rate_limited=rate_limited, batch_index=index, **schedule
+                )
+                jobs.append((index, job))
+        if jobs:
+            # Items run on pool threads; each gets a copy of this request's context to join its trace.
+            contexts = [contextvars.copy_context() for _ in jobs]
+            with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+                list(executor.map(lambda entry, context: context.run(self._resolve_job, entry[1]), jobs, contexts))
+        for index, job in jobs:
+            results[index] = {"status": 200, **job.response_payload()}
+
+        self._write_json(200, {"results": results})
+        for _, job in jobs:
+            job.finish()
+
+    def _stream_suggestions(self, job: SuggestionJob) -> None:
+        """Server-sent events: optional `rules`, one `suggestion` per item, then `done`."""
+        started = time.monotonic()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        job.request_meta["stream"] = True
+
+        client_ok = True
+        needs_model = job.needs_model()
+        if needs_model and job.prefetch_call is not None:
+            # A pending prefetch answers this stream; its suggestions go out as soon as it finishes.
+            self._await_call(job, job.prefetch_call)
+            needs_model = False
+        if needs_model:
+            SUPERSESSION.register(job, job.cancel.cancel)
+            if CONFIG.stream_rules_first:
+                client_ok = self._write_event(
+                    "rules", {"source": "rules", "suggestions": job.rules_output[: job.desired_count]}
+                )
+            streamed: list[dict[str, str]] = []
             try:
-                primary_output = OPENAI.generate(payload, timeout_sec=CONFIG.primary_timeout_sec)
-                primary_source = "openai"
+                BREAKER.allow()
+                with (
+                    MODEL_GATE.slot(job.priority, job.deadline, job.cancel),
+                    BREAKER.call() as timeout_sec,
+                    job.upstream_budget(timeout_sec) as budget_sec,
+                    trace_span("upstream"),
+                ):
+                    items = OPENAI.generate_stream(
+                        job.payload, timeout_sec=budget_sec, route=job.route, cancel=job.cancel
+                    )
+                    try:
+                        for item in items:
+                            if not client_ok or job.superseded:
+                                break
+                            streamed.append(item)
+                            elapsed_ms = int((time.monotonic() - started) * 1000)
+                            job.request_meta.setdefault("first_suggestion_ms", elapsed_ms)
+                            client_ok = self._write_event(
+                                "suggestion",
+                                {"index": len(streamed) - 1, "suggestion": item, "elapsed_ms": elapsed_ms},
+                            )
+                    finally:
+                        items.close()
+                if job.superseded:
+                    job.resolve_superseded()
+                elif client_ok:
+                    remember_output(job, streamed)
+                    job.resolve_model(streamed, 0)
+                else:
+                    job.resolve_fallback(RuntimeError("Client disconnected during stream"))
             except Exception as exc:
-                primary_output = rules_output
-                primary_source = "rules_fallback"
-                primary_error = str(exc)
-        elif CONFIG.primary_mode != "rules":
-            primary_source = "rules_primary"
-            primary_error = f"Unknown PRIMARY_MODE={CONFIG.primary_mode}, using rules"
-
-        response_payload = {
-            "source": primary_source,
-            "suggestions": primary_output[:desired_count],
-        }
-        self._write_json(200, response_payload)
-
-        SHADOW.maybe_enqueue(
-            request_id=request_id,
-            install_id=install_id,
-            payload=payload,
-            primary_output=primary_output[:desired_count],
-            primary_source=primary_source,
-            primary_error=primary_error,
-            rules_output=rules_output[:desired_count],
-        )
+                job.resolve_fallback(exc)
+        else:
+            for index, item in enumerate(job.primary_output[: job.desired_count]):
+                client_ok = client_ok and self._write_event(
+                    "suggestion", {"index": index, "suggestion": item, "elapsed_ms": 0}
+                )
+
+        if client_ok:
+            self._write_event("done", job.response_payload())
+        else:
+            job.request_meta["client_disconnected"] = True
+        job.finish()
+
+    def _write_event(self, event: str, data: dict[str, Any]) -> bool:
+        try:
+            self.wfile.write(sse_event(event, data))
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            return False
+        return True
+
+    def _call_model(self, job: SuggestionJob) -> None:
+        try:
+            output, waiters = SINGLE_FLIGHT.do(
+                job.cache_key,
+                lambda: generate_and_cache(job),
+                wait_timeout_sec=job.wait_sec(CONFIG.primary_timeout_sec + 1),
+                rejoin_on=LEADER_ONLY_ERRORS,
+            )
+            job.resolve_model(output, waiters)
+        except Exception as exc:
+            job.resolve_fallback(exc)
+
+    def _await_call(self, job: SuggestionJob, call: InFlightCall) -> None:
+        """Waits on a background call until the soft deadline (race), primary timeout or deadline."""
+        if CONFIG.primary_mode == "race":
+            if not call.done.wait(job.wait_sec(CONFIG.race_soft_deadline_ms / 1000.0)):
+                job.resolve_deadline()
+                return
+        elif not call.done.wait(job.wait_sec(CONFIG.primary_timeout_sec + 1)):
+            if job.expired():
+                job.resolve_fallback(DeadlineExpiredError("Deadline expired waiting for the model"))
+            else:
+                job.resolve_fallback(TimeoutError("Timed out waiting for the model"))
+            return
+        if call.error is not None:
+            job.resolve_fallback(call.error)
+        else:
+            job.resolve_model(call.result, call.waiters)
 
     def log_message(self, format: str, *args: Any) -> None:
         line = "%s - - [%s] %s\n" % (self.address_string(), self.log_date_time_string(), format % args)
         print(line.rstrip())
 
 
+class WorkerState:
+    """Per-worker health and metrics snapshots shared through a directory."""
+
+    def __init__(self, directory: Path, index: int, interval_sec: float):
+        self.directory = directory
+        self.index = index
+        self.pid = os.getpid()
+        self.interval_sec = interval_sec
+        self.extra_health: Callable[[], dict[str, Any]] | None = None
+
+    def start(self) -> None:
+        self.publish()
+        threading.Thread(target=self._run, name="worker-state", daemon=True).start()
+
+    def identity(self) -> dict[str, Any]:
+        return {"index": self.index, "pid": self.pid}
+
+    def publish(self) -> None:
+        health = health_payload(include_workers=False)
+        if self.extra_health is not None:
+            health.update(self.extra_health())
+        snapshot = {**self.identity(), "updated_at": time.time(), "health": health, "metrics": METRICS.snapshot()}
+        target = self.directory / f"worker-{self.index}.json"
+        tmp = target.with_suffix(".tmp")
+        try:
+            tmp.write_text(json.dumps(snapshot, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, target)
+        except OSError:
+            pass
+
+    def peers(self) -> list[dict[str, Any]]:
+        """Latest snapshots of the other workers (unreadable or half-written files are skipped)."""
+        out: list[dict[str, Any]] = []
+        for path in sorted(self.directory.glob("worker-*.json")):
+            try:
+                snapshot = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                continue
+            if snapshot.get("index") != self.index:
+                out.append(snapshot)
+        return out
+
+    def peer_health(self) -> list[dict[str, Any]]:
+        now = time.time()
+        return [
+            {
+                "index": peer.get("index"),
+                "pid": peer.get("pid"),
+                "snapshot_age_sec": round(now - float(peer.get("updated_at", 0)), 1),
+                "health": peer.get("health", {}),
+            }
+            for peer in self.peers()
+        ]
+
+    def peer_metrics(self) -> list[dict[str, list[list[Any]]]]:
+        return [peer.get("metrics", {}) for peer in self.peers()]
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval_sec)
+            self.publish()
+
+
+class ReplyHTTPServer(ThreadingHTTPServer):
+    # The stdlib default backlog of 5 turns connection bursts into 1s SYN retries.
+    request_queue_size = CONFIG.listen_backlog
+
+
+class DrainingHTTPServer(ReplyHTTPServer):
+    """ReplyHTTPServer whose server_close() waits for in-flight request threads."""
+
+    daemon_threads = False
+    block_on_close = True
+
+
+def run_worker(index: int, sock: socket.socket, state_dir: Path) -> None:
+    """Body of one pre-forked worker: serves on the inherited socket, drains on SIGTERM."""
+    global WORKER_STATE
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    # One shadow log per worker (`<SHADOW_LOG_PATH>.w<index>`), rotated independently.
+    SHADOW.log_writer.path = Path(f"{CONFIG.shadow_log_path}.w{index}")
+    TRACER.writer.path = Path(f"{CONFIG.trace_path}.w{index}")
+    WORKER_STATE = WorkerState(state_dir, index, CONFIG.worker_snapshot_interval_sec)
+    STORE.warm(CACHE)
+    print(
+        json.dumps({"event": "worker_start", **WORKER_STATE.identity(), "server_mode": CONFIG.server_mode}),
+        flush=True,
+    )
+
+    if CONFIG.server_mode == "asyncio":
+        from reply_async import AsyncReplyServer
+
+        server = AsyncReplyServer(CONFIG)
+        WORKER_STATE.extra_health = lambda: {"async_server": server.stats()}
+        WORKER_STATE.start()
+        asyncio.run(server.serve(sock=sock, drain_sec=CONFIG.worker_drain_sec))
+    else:
+        WORKER_STATE.start()
+        httpd = DrainingHTTPServer(sock.getsockname(), ReplyHandler, bind_and_activate=False)
+        httpd.socket.close()
+        httpd.socket = sock
+        httpd.server_name, httpd.server_port = sock.getsockname()[:2]
+        # shutdown() blocks until serve_forever() returns, so it cannot run on the signalled thread.
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=httpd.shutdown).start())
+        httpd.serve_forever()
+        httpd.server_close()
+    SHADOW.log_writer.flush()
+    TRACER.writer.flush()
+    STORE.flush()
+    print(json.dumps({"event": "worker_exit", **WORKER_STATE.identity()}), flush=True)
+
+
+class Supervisor:
+    """Pre-fork process manager for WORKERS > 1: SIGTERM drains, SIGHUP rolls workers."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.workers: dict[int, tuple[int, float]] = {}
+        self.draining: set[int] = set()
+        self.restart_at: dict[int, float] = {}
+        self._stopping = False
+        self._reload = False
+
+    def run(self) -> None:
+        sock = socket.create_server(
+            (self.config.host, self.config.port), backlog=self.config.listen_backlog
+        )
+        owns_state_dir = not self.config.worker_state_dir
+        state_dir = Path(self.config.worker_state_dir or tempfile.mkdtemp(prefix="reply_backend_workers_"))
+        state_dir.mkdir(parents=True, exist_ok=True)
+        for stale in state_dir.glob("worker-*.json"):
+            stale.unlink(missing_ok=True)
+
+        signal.signal(signal.SIGTERM, self._request_stop)
+        signal.signal(signal.SIGINT, self._request_stop)
+        signal.signal(signal.SIGHUP, self._request_reload)
+        for index in range(self.config.workers):
+            self._spawn(index, sock, state_dir)
+        try:
+            while not self._stopping:
+                if self._reload:
+                    self._reload = False
+                    self._rolling_restart(sock, state_dir)
+                self._reap(sock, state_dir)
+                time.sleep(0.2)
+            self._drain_all()
+        finally:
+            sock.close()
+            if owns_state_dir:
+                shutil.rmtree(state_dir, ignore_errors=True)
+
+    def _spawn(self, index: int, sock: socket.socket, state_dir: Path) -> None:
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(index, sock, state_dir)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            finally:
+                sys.stdout.flush()
+                os._exit(code)
+        self.workers[index] = (pid, time.monotonic())
+
+    def _reap(self, sock: socket.socket, state_dir: Path) -> None:
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                pid = 0
+            if pid == 0:
+                break
+            if pid in self.draining:
+                self.draining.discard(pid)
+                continue
+            for index, (worker_pid, started) in list(self.workers.items()):
+                if worker_pid != pid:
+                    continue
+                del self.workers[index]
+                print(json.dumps({"event": "worker_died", "index": index, "pid": pid, "status": status}), flush=True)
+                crashed_fast = time.monotonic() - started < 1.0
+                self.restart_at[index] = time.monotonic() + (1.0 if crashed_fast else 0.0)
+        if self._stopping:
+            return
+        for index, due in list(self.restart_at.items()):
+            if time.monotonic() >= due:
+                del self.restart_at[index]
+                self._spawn(index, sock, state_dir)
+
+    def _rolling_restart(self, sock: socket.socket, state_dir: Path) -> None:
+        for index in sorted(self.workers):
+            old_pid, _ = self.workers[index]
+            self._spawn(index, sock, state_dir)
+            self.draining.add(old_pid)
+            self._signal(old_pid, signal.SIGTERM)
+
+    def _drain_all(self) -> None:
+        pids = {pid for pid, _ in self.workers.values()} | self.draining
+        for pid in pids:
+            self._signal(pid, signal.SIGTERM)
+        deadline = time.monotonic() + self.config.worker_drain_sec
+        while pids and time.monotonic() < deadline:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid:
+                pids.discard(pid)
+            else:
+                time.sleep(0.1)
+        for pid in pids:
+            self._signal(pid, signal.SIGKILL)
+
+    def _signal(self, pid: int, signum: int) -> None:
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _request_stop(self, signum: int, frame: Any) -> None:
+        self._stopping = True
+
+    def _request_reload(self, signum: int, frame: Any) -> None:
+        self._reload = True
+
+
 def main() -> None:
-    server = ThreadingHTTPServer((CONFIG.host, CONFIG.port), ReplyHandler)
     print(
         json.dumps(
             {
                 "event": "server_start",
+                "server_mode": CONFIG.server_mode,
+                "workers": CONFIG.workers,
                 "host": CONFIG.host,
                 "port": CONFIG.port,
                 "primary_mode": CONFIG.primary_mode,
@@ -636,11 +2704,29 @@ def main() -> None:
                 "openai_model": CONFIG.openai_model,
                 "openai_key_present": bool(CONFIG.openai_api_key),
                 "shadow_log_path": CONFIG.shadow_log_path,
+                "trace_sample_rate": CONFIG.trace_sample_rate,
             }
         )
     )
+    if CONFIG.rules_precompute:
+        precompute_rules_table()
+    if CONFIG.workers > 1:
+        if hasattr(os, "fork"):
+            Supervisor(CONFIG).run()
+            return
+        print(json.dumps({"event": "workers_unsupported", "detail": "os.fork unavailable, serving in one process"}))
+    # Pre-fork workers warm their own response caches after the fork.
+    STORE.warm(CACHE)
+    if CONFIG.server_mode == "asyncio":
+        from reply_async import AsyncReplyServer
+
+        asyncio.run(AsyncReplyServer(CONFIG).serve())
+        return
+    server = ReplyHTTPServer((CONFIG.host, CONFIG.port), ReplyHandler)
     server.serve_forever()
 
 
 if __name__ == "__main__":
+    # reply_async imports this module by name; share the running module instead of loading a second copy.
+    sys.modules.setdefault("reply_backend", sys.modules[__name__])
     main()
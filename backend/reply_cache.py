@@ -0,0 +1,784 @@
+"""Response cache, persistent suggestion store, near-duplicate index, single-flight and prefetch."""
+
+import asyncio
+import atexit
+import contextvars
+import hashlib
+import json
+import random
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+from reply_config import Config
+from reply_metrics import METRICS
+from reply_prompts import PROMPT_VERSION, canonical_text, generation_inputs, prompt_kind_for
+from reply_upstream import upstream_endpoints
+
+
+class ResponseCache:
+    """Bounded TTL + LRU cache of model suggestions keyed by `generation_key`."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, int, list[dict[str, str]]]] = OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key: str) -> list[dict[str, str]] | None:
+        if not self.config.response_cache_enabled:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            expires_at, _, value = entry
+            if expires_at <= now:
+                self._remove(key)
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return [dict(item) for item in value]
+
+    def contains(self, key: str) -> bool:
+        """Live entry check that leaves hit counts and LRU order alone."""
+        if not self.config.response_cache_enabled:
+            return False
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and entry[0] > time.monotonic()
+
+    def put(self, key: str, value: list[dict[str, str]]) -> None:
+        if not self.config.response_cache_enabled or self.config.response_cache_ttl_sec <= 0:
+            return
+        stored = [dict(item) for item in value]
+        size = len(key) + len(json.dumps(stored, ensure_ascii=False).encode("utf-8"))
+        if size > self.config.response_cache_max_bytes:
+            return
+        expires_at = time.monotonic() + self.config.response_cache_ttl_sec
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, size, stored)
+            self._bytes += size
+            while (
+                len(self._entries) > self.config.response_cache_max_entries
+                or self._bytes > self.config.response_cache_max_bytes
+            ):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.response_cache_enabled,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "expirations": self._expirations,
+            }
+
+    def _remove(self, key: str) -> None:
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+
+class SuggestionStore:
+    """SQLite (WAL) tier behind ResponseCache, shared by workers; any sqlite error is a miss."""
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS suggestions ("
+        " key TEXT PRIMARY KEY, model TEXT NOT NULL, value TEXT NOT NULL, created_at REAL NOT NULL,"
+        " expires_at REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, last_hit_at REAL NOT NULL"
+        ") WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS suggestions_expires ON suggestions (expires_at)",
+        "CREATE INDEX IF NOT EXISTS suggestions_usage ON suggestions (model, hits, last_hit_at)",
+    )
+    queue_max = 10000
+    flush_interval_sec = 0.2
+    max_idle_connections = 4
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.path = Path(config.persistent_cache_path)
+        models = ",".join(sorted({model for _, model, _ in upstream_endpoints(config)}))
+        self.model_key = f"{models}@{PROMPT_VERSION}"
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # Idle reader connections. Only workers open them: the pre-fork supervisor never serves requests.
+        self._idle: list[sqlite3.Connection] = []
+        self._retry_at = 0.0
+        self._queue: deque[tuple[str, str, str | None, float]] = deque()
+        # Set while the writer thread applies a batch it took off the queue.
+        self._writing = False
+        self._thread: threading.Thread | None = None
+        self._writer: sqlite3.Connection | None = None
+        self._next_compaction = 0.0
+        self._hits = 0
+        self._misses = 0
+        self._errors = 0
+        self._writes = 0
+        self._dropped = 0
+        self._compactions = 0
+        self._compacted = 0
+        self._entries: int | None = None
+        self._warm_loaded = 0
+
+    def get(self, key: str) -> list[dict[str, str]] | None:
+        if not self.config.persistent_cache_enabled:
+            return None
+        conn = self._acquire()
+        if conn is None:
+            self._count("_misses")
+            return None
+        try:
+            row = conn.execute(
+                "SELECT value FROM suggestions WHERE key = ? AND expires_at > ?", (self._row_key(key), time.time())
+            ).fetchone()
+            value = json.loads(row[0]) if row is not None else None
+        except (sqlite3.Error, ValueError) as exc:
+            self._failed(conn, exc)
+            self._count("_misses")
+            return None
+        self._release(conn)
+        if not isinstance(value, list):
+            self._count("_misses")
+            return None
+        self._count("_hits")
+        self.record_hit(key)
+        return value
+
+    def put(self, key: str, value: list[dict[str, str]]) -> None:
+        if self.config.persistent_cache_enabled:
+            self._submit(("put", self._row_key(key), json.dumps(value, ensure_ascii=False), time.time()))
+
+    def record_hit(self, key: str) -> None:
+        """Counts a use of `key` (also for response-cache hits) so compaction and warm start keep it."""
+        if self.config.persistent_cache_enabled:
+            self._submit(("hit", self._row_key(key), None, time.time()))
+
+    def warm(self, cache: ResponseCache) -> int:
+        """Loads the most used live entries for the current model(s) into `cache`; returns how many."""
+        if not self.config.persistent_cache_enabled or not self.config.persistent_cache_warm_entries:
+            return 0
+        conn = self._acquire()
+        if conn is None:
+            return 0
+        try:
+            rows = conn.execute(
+                "SELECT key, value FROM suggestions WHERE model = ? AND expires_at > ?"
+                " ORDER BY hits DESC, last_hit_at DESC LIMIT ?",
+                (self.model_key, time.time(), self.config.persistent_cache_warm_entries),
+            ).fetchall()
+        except sqlite3.Error as exc:
+            self._failed(conn, exc)
+            return 0
+        self._release(conn)
+        loaded = 0
+        prefix = f"{self.model_key}:"
+        for row_key, raw in rows:
+            try:
+                value = json.loads(raw)
+            except ValueError:
+                continue
+            if isinstance(value, list) and row_key.startswith(prefix):
+                cache.put(row_key[len(prefix) :], value)
+                loaded += 1
+        with self._lock:
+            self._warm_loaded += loaded
+        return loaded
+
+    def flush(self, timeout_sec: float = 5.0) -> None:
+        """Blocks until queued writes are applied (used at shutdown)."""
+        deadline = time.monotonic() + timeout_sec
+        with self._cond:
+            self._cond.notify()
+            while (self._queue or self._writing) and self._thread is not None and time.monotonic() < deadline:
+                self._cond.wait(0.05)
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.persistent_cache_enabled,
+                "path": str(self.path),
+                "model_key": self.model_key,
+                "entries": self._entries,
+                "hits": self._hits,
+                "misses": self._misses,
+                "writes": self._writes,
+                "queued": len(self._queue),
+                "dropped": self._dropped,
+                "errors": self._errors,
+                "compactions": self._compactions,
+                "compacted": self._compacted,
+                "warm_loaded": self._warm_loaded,
+                "paused": self._retry_at > time.monotonic(),
+            }
+
+    def _row_key(self, key: str) -> str:
+        return f"{self.model_key}:{key}"
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            self.path,
+            timeout=self.config.persistent_cache_busy_timeout_ms / 1000.0,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        try:
+            # auto_vacuum only takes effect on a new database, before the first table exists.
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+        except sqlite3.Error:
+            conn.close()
+            raise
+        return conn
+
+    def _acquire(self) -> sqlite3.Connection | None:
+        with self._lock:
+            if self._retry_at > time.monotonic():
+                return None
+            if self._idle:
+                return self._idle.pop()
+        try:
+            return self._connect()
+        except (sqlite3.Error, OSError) as exc:
+            self._failed(None, exc)
+            return None
+
+    def _release(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle_connections:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def _failed(self, conn: sqlite3.Connection | None, exc: BaseException) -> None:
+        busy = isinstance(exc, sqlite3.OperationalError) and ("locked" in str(exc) or "busy" in str(exc))
+        with self._lock:
+            self._errors += 1
+            if not busy:
+                self._retry_at = time.monotonic() + self.config.persistent_cache_retry_sec
+        if conn is not None:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def _submit(self, op: tuple[str, str, str | None, float]) -> None:
+        with self._cond:
+            if len(self._queue) >= self.queue_max:
+                self._dropped += 1
+                return
+            self._queue.append(op)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="suggestion-store-writer", daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if not self._queue:
+                    self._cond.wait(self.flush_interval_sec)
+                batch = list(self._queue)
+                self._queue.clear()
+                self._writing = bool(batch)
+            if batch:
+                self._write(batch)
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+            if time.monotonic() >= self._next_compaction:
+                self._next_compaction = time.monotonic() + self.config.persistent_cache_compact_interval_sec
+                self._compact()
+
+    def _writer_conn(self) -> sqlite3.Connection | None:
+        if self._writer is None:
+            with self._lock:
+                if self._retry_at > time.monotonic():
+                    return None
+            try:
+                self._writer = self._connect()
+            except (sqlite3.Error, OSError) as exc:
+                self._failed(None, exc)
+        return self._writer
+
+    def _write(self, batch: list[tuple[str, str, str | None, float]]) -> None:
+        conn = self._writer_conn()
+        if conn is None:
+            with self._lock:
+                self._dropped += len(batch)
+            return
+        ttl = self.config.persistent_cache_ttl_sec
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for op, row_key, value, now in batch:
+                if op == "put":
+                    conn.execute(
+                        "INSERT INTO suggestions (key, model, value, created_at, expires_at, last_hit_at)"
+                        " VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (key) DO UPDATE SET"
+                        " value = excluded.value, created_at = excluded.created_at, expires_at = excluded.expires_at",
+                        (row_key, self.model_key, value, now, now + ttl, now),
+                    )
+                else:
+                    conn.execute(
+                        "UPDATE suggestions SET hits = hits + 1, last_hit_at = ? WHERE key = ?", (now, row_key)
+                    )
+            conn.execute("COMMIT")
+        except sqlite3.Error as exc:
+            self._abandon_writer(exc)
+            with self._lock:
+                self._dropped += len(batch)
+            return
+        with self._lock:
+            self._writes += sum(1 for op in batch if op[0] == "put")
+
+    def _compact(self) -> None:
+        """Drops expired rows, then stale model keys and the least used beyond the entry limit."""
+        conn = self._writer_conn()
+        if conn is None:
+            return
+        try:
+            removed = conn.execute("DELETE FROM suggestions WHERE expires_at <= ?", (time.time(),)).rowcount
+            entries = conn.execute("SELECT COUNT(*) FROM suggestions").fetchone()[0]
+            excess = entries - self.config.persistent_cache_max_entries
+            if excess > 0:
+                removed += conn.execute(
+                    "DELETE FROM suggestions WHERE key IN"
+                    " (SELECT key FROM suggestions ORDER BY model = ?, hits, last_hit_at LIMIT ?)",
+                    (self.model_key, excess),
+                ).rowcount
+                entries -= excess
+            conn.execute("PRAGMA incremental_vacuum")
+            conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+        except sqlite3.Error as exc:
+            self._abandon_writer(exc)
+            return
+        with self._lock:
+            self._compactions += 1
+            self._compacted += removed
+            self._entries = entries
+
+    def _abandon_writer(self, exc: BaseException) -> None:
+        # Closing the connection rolls back an open transaction; the next batch reconnects.
+        conn, self._writer = self._writer, None
+        self._failed(conn, exc)
+
+
+_MINHASH_PRIME = (1 << 61) - 1
+_HANDLE_RE = re.compile(r"[@#]\w+")
+
+
+def near_dup_text(text: str) -> str:
+    """`canonical_text` minus @handles/#tags and with whitespace collapsed."""
+    return " ".join(canonical_text(_HANDLE_RE.sub(" ", text.lower())).split())
+
+
+def near_dup_variant_key(payload: dict[str, Any]) -> str:
+    """Generation inputs that must match exactly for a near-duplicate reuse."""
+    inputs = generation_inputs(payload)
+    del inputs["primary_text"], inputs["secondary_texts"]
+    canonical = json.dumps(inputs, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class NearDuplicateIndex:
+    """MinHash/LSH index over recent comment-path primary_texts and their model output."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.num_perm = config.near_dup_num_perm
+        self.bands = max(1, min(config.near_dup_bands, self.num_perm))
+        self.rows_per_band = self.num_perm // self.bands
+        rng = random.Random(1)
+        self._perms = [
+            (rng.randrange(1, _MINHASH_PRIME), rng.randrange(0, _MINHASH_PRIME)) for _ in range(self.num_perm)
+        ]
+        # primary_text -> signature; a miss computes it for lookup() and again for add().
+        self._signatures: OrderedDict[str, tuple[int, ...] | None] = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 0
+        # entry id -> (expires_at, variant_key, normalized text, signature, output)
+        self._entries: OrderedDict[int, tuple[float, str, str, tuple[int, ...], list[dict[str, str]]]] = OrderedDict()
+        # (variant_key, normalized text) -> entry id
+        self._ids: dict[tuple[str, str], int] = {}
+        self._buckets: dict[tuple[int, str, tuple[int, ...]], set[int]] = {}
+        self._lookups = 0
+        self._reuses = 0
+        self._below_threshold = 0
+        self._evictions = 0
+        self._replaced = 0
+
+    def applies_to(self, payload: dict[str, Any]) -> bool:
+        return self.config.near_dup_enabled and prompt_kind_for(generation_inputs(payload)["reply_type"]) == "comment"
+
+    def signature(self, text: str) -> tuple[int, ...] | None:
+        with self._lock:
+            if text in self._signatures:
+                self._signatures.move_to_end(text)
+                return self._signatures[text]
+        signature = self._compute_signature(text)
+        with self._lock:
+            self._signatures[text] = signature
+            while len(self._signatures) > self.config.near_dup_signature_cache_size:
+                self._signatures.popitem(last=False)
+        return signature
+
+    def _compute_signature(self, text: str) -> tuple[int, ...] | None:
+        normalized = near_dup_text(text)
+        if not normalized:
+            return None
+        width = self.config.near_dup_shingle_chars
+        shingles = {normalized[i : i + width] for i in range(max(1, len(normalized) - width + 1))}
+        hashes = [
+            int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little")
+            for shingle in shingles
+        ]
+        return tuple(min((a * h + b) % _MINHASH_PRIME for h in hashes) for a, b in self._perms)
+
+    def lookup(self, payload: dict[str, Any]) -> tuple[list[dict[str, str]] | None, float]:
+        """Returns (reusable output or None, best similarity seen among LSH candidates)."""
+        signature = self.signature(generation_inputs(payload)["primary_text"])
+        if signature is None:
+            return None, 0.0
+        variant = near_dup_variant_key(payload)
+        now = time.monotonic()
+        best_score = 0.0
+        best_output: list[dict[str, str]] | None = None
+        with self._lock:
+            self._lookups += 1
+            self._expire(now)
+            candidates: set[int] = set()
+            for band_key in self._band_keys(variant, signature):
+                candidates |= self._buckets.get(band_key, set())
+            for entry_id in candidates:
+                _, _, _, other, output = self._entries[entry_id]
+                score = sum(1 for x, y in zip(signature, other) if x == y) / self.num_perm
+                if score > best_score:
+                    best_score, best_output = score, output
+            if best_output is not None and best_score >= self.config.near_dup_threshold:
+                self._reuses += 1
+                return [dict(item) for item in best_output], best_score
+            if best_output is not None:
+                self._below_threshold += 1
+        return None, best_score
+
+    def add(self, payload: dict[str, Any], output: list[dict[str, str]]) -> None:
+        text = generation_inputs(payload)["primary_text"]
+        signature = self.signature(text)
+        if signature is None:
+            return
+        variant = near_dup_variant_key(payload)
+        key = (variant, near_dup_text(text))
+        expires_at = time.monotonic() + self.config.near_dup_ttl_sec
+        with self._lock:
+            previous = self._ids.get(key)
+            if previous is not None:
+                self._remove(previous)
+                self._replaced += 1
+            entry_id = self._next_id
+            self._next_id += 1
+            self._entries[entry_id] = (expires_at, variant, key[1], signature, [dict(item) for item in output])
+            self._ids[key] = entry_id
+            for band_key in self._band_keys(variant, signature):
+                self._buckets.setdefault(band_key, set()).add(entry_id)
+            while len(self._entries) > self.config.near_dup_max_entries:
+                self._remove(next(iter(self._entries)))
+                self._evictions += 1
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.near_dup_enabled,
+                "threshold": self.config.near_dup_threshold,
+                "entries": len(self._entries),
+                "buckets": len(self._buckets),
+                "lookups": self._lookups,
+                "reuses": self._reuses,
+                "below_threshold": self._below_threshold,
+                "evictions": self._evictions,
+                "replaced": self._replaced,
+            }
+
+    def _band_keys(self, variant: str, signature: tuple[int, ...]) -> Iterator[tuple[int, str, tuple[int, ...]]]:
+        for band in range(self.bands):
+            start = band * self.rows_per_band
+            yield band, variant, signature[start : start + self.rows_per_band]
+
+    def _expire(self, now: float) -> None:
+        """Entries are insertion-ordered with a fixed TTL, so expired ones are at the front."""
+        while self._entries:
+            entry_id, entry = next(iter(self._entries.items()))
+            if entry[0] > now:
+                break
+            self._remove(entry_id)
+
+    def _remove(self, entry_id: int) -> None:
+        _, variant, text, signature, _ = self._entries.pop(entry_id)
+        del self._ids[(variant, text)]
+        for band_key in self._band_keys(variant, signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[band_key]
+
+
+class InFlightCall:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: BaseException | None = None
+        self.waiters = 0
+        self._lock = threading.Lock()
+
+    def add_waiter(self, delta: int = 1) -> None:
+        with self._lock:
+            self.waiters += delta
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key onto one execution of `fn`."""
+
+    # Calls a waiter may join or lead in turn when leaders fail with a `rejoin_on` error.
+    MAX_ATTEMPTS = 3
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._calls: dict[str, InFlightCall] = {}
+        self._leaders = 0
+        self._coalesced = 0
+        self._rejoined = 0
+
+    def do(
+        self,
+        key: str,
+        fn: Callable[[], Any],
+        wait_timeout_sec: float,
+        rejoin_on: tuple[type[BaseException], ...] = (),
+    ) -> tuple[Any, int]:
+        """Returns (result, coalesced_waiters); waiters hit by a leader-only `rejoin_on` error retry the call."""
+        if not self.config.single_flight_enabled:
+            return fn(), 0
+
+        deadline = time.monotonic() + wait_timeout_sec
+        for attempt in range(self.MAX_ATTEMPTS):
+            call, leader = self._join(key)
+            if leader:
+                self._run(key, call, fn)
+            elif not call.done.wait(max(0.0, deadline - time.monotonic())):
+                raise TimeoutError("Timed out waiting for coalesced upstream call")
+
+            if call.error is None:
+                return call.result, call.waiters
+            if leader or not isinstance(call.error, rejoin_on) or attempt == self.MAX_ATTEMPTS - 1:
+                raise call.error
+            with self._lock:
+                self._rejoined += 1
+        raise RuntimeError("unreachable")
+
+    def submit(self, key: str, fn: Callable[[], Any], count_waiter: bool = True) -> InFlightCall:
+        """Like `do`, but a new call runs on a background thread and the caller waits on `call.done`."""
+        if self.config.single_flight_enabled:
+            call, leader = self._join(key, count_waiter)
+        else:
+            call, leader = InFlightCall(), True
+        if leader:
+            # The context copy lets the call's spans land in the starting request's trace.
+            context = contextvars.copy_context()
+            threading.Thread(target=context.run, args=(self._run, key, call, fn), daemon=True).start()
+        return call
+
+    def _join(self, key: str, count_waiter: bool = True) -> tuple[InFlightCall, bool]:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = InFlightCall()
+                self._calls[key] = call
+                self._leaders += 1
+                return call, True
+            if count_waiter:
+                call.add_waiter()
+                self._coalesced += 1
+            return call, False
+
+    def _run(self, key: str, call: InFlightCall, fn: Callable[[], Any]) -> None:
+        try:
+            call.result = fn()
+        except BaseException as exc:
+            call.error = exc
+        finally:
+            with self._lock:
+                if self._calls.get(key) is call:
+                    del self._calls[key]
+            call.done.set()
+
+    def waiters(self, key: str) -> int:
+        """Requests coalesced onto the in-flight call for `key` besides its leader."""
+        with self._lock:
+            call = self._calls.get(key)
+            return call.waiters if call is not None else 0
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "enabled": self.config.single_flight_enabled,
+                "in_flight": len(self._calls),
+                "leaders": self._leaders,
+                "coalesced": self._coalesced,
+                "rejoined": self._rejoined,
+            }
+
+
+def call_state(call: Any) -> tuple[bool, Any, BaseException | None]:
+    """(done, result, error) of a threading `InFlightCall` or an asyncio future."""
+    if isinstance(call, asyncio.Future):
+        if not call.done():
+            return False, None, None
+        return True, None if call.exception() else call.result(), call.exception()
+    return call.done.is_set(), call.result, call.error
+
+
+def add_call_waiter(call: Any, delta: int = 1) -> None:
+    """Counts a request relying on a threading `InFlightCall` or an asyncio future."""
+    if isinstance(call, asyncio.Future):
+        call.waiters += delta  # type: ignore[attr-defined]
+    else:
+        call.add_waiter(delta)
+
+
+class _PrefetchEntry:
+    def __init__(self, token: str, key: str, call: Any, expires_at: float):
+        self.token = token
+        self.key = key
+        self.call = call
+        self.expires_at = expires_at
+        self.claims = 0
+        # The entry counts as a waiter on its call until the first claim takes that over or it is dropped.
+        self.held = True
+
+
+class PrefetchStore:
+    """Speculative generations from :prefetch, claimable by token or by generation key."""
+
+    EVENTS = ("started", "ready", "pending", "failed", "miss", "expired", "evicted")
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, _PrefetchEntry] = OrderedDict()
+        self._by_key: dict[str, str] = {}
+        self._counts = dict.fromkeys(self.EVENTS, 0)
+        # Entries claimed at least once; ready/pending count every claim, so several requests can share one.
+        self._used = 0
+
+    def find(self, key: str) -> str | None:
+        """Claim token of a live prefetch for `key`, so repeated prefetches share one generation."""
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._by_key.get(key)
+
+    def add(self, key: str, call: Any) -> str:
+        token = uuid.uuid4().hex
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            while len(self._entries) >= self.config.prefetch_max_entries:
+                self._drop(self._entries.popitem(last=False)[1], "evicted")
+            self._entries[token] = _PrefetchEntry(token, key, call, now + self.config.prefetch_ttl_sec)
+            self._by_key[key] = token
+            add_call_waiter(call)
+            self._count("started")
+        return token
+
+    def claim(self, token: str, key: str) -> tuple[Any, str] | None:
+        """Returns (call, "ready" | "pending") for a usable prefetch of `key`, else None."""
+        with self._lock:
+            self._expire(time.monotonic())
+            entry = self._entries.get(token) if token else None
+            if entry is None or entry.key != key:
+                entry = self._entries.get(self._by_key.get(key, ""))
+            if entry is None:
+                if token:
+                    self._count("miss")
+                return None
+            entry.claims += 1
+            done, _, error = call_state(entry.call)
+            state = "pending" if not done else "failed" if error is not None else "ready"
+            self._count(state)
+            if state == "failed":
+                self._drop(self._entries.pop(entry.token), "")
+                return None
+            if entry.claims == 1:
+                self._used += 1
+            if state == "pending":
+                if entry.held:
+                    entry.held = False
+                else:
+                    add_call_waiter(entry.call)
+            return entry.call, state
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            self._expire(time.monotonic())
+            started = self._counts["started"]
+            wasted = self._counts["expired"] + self._counts["evicted"]
+            return {
+                "enabled": self.config.prefetch_enabled,
+                "entries": len(self._entries),
+                "max_entries": self.config.prefetch_max_entries,
+                "ttl_sec": self.config.prefetch_ttl_sec,
+                **self._counts,
+                "used": self._used,
+                "hit_rate": round(self._used / started, 3) if started else 0.0,
+                "wasted_rate": round(wasted / started, 3) if started else 0.0,
+            }
+
+    def _count(self, event: str) -> None:
+        """Caller holds the lock."""
+        self._counts[event] += 1
+        METRICS.prefetches.inc(event)
+
+    def _expire(self, now: float) -> None:
+        """Caller holds the lock. Entries are in creation order with one TTL, so expiry is a prefix."""
+        while self._entries:
+            entry = next(iter(self._entries.values()))
+            if entry.expires_at > now:
+                break
+            self._drop(self._entries.popitem(last=False)[1], "expired")
+
+    def _drop(self, entry: _PrefetchEntry, reason: str) -> None:
+        """Caller holds the lock and has removed `entry` from `_entries`."""
+        if self._by_key.get(entry.key) == entry.token:
+            del self._by_key[entry.key]
+        if entry.held:
+            entry.held = False
+            add_call_waiter(entry.call, -1)
+        if reason and not entry.claims:
+            self._count(reason)
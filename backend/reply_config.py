@@ -0,0 +1,248 @@
+"""Environment-driven settings for the reply backend."""
+
+import os
+
+
+def env_bool(name: str, default: bool) -> bool:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    return raw.strip().lower() in {"1", "true", "yes", "on"}
+
+
+def env_float(name: str, default: float) -> float:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    try:
+        return float(raw)
+    except ValueError:
+        return default
+
+
+def env_int(name: str, default: int) -> int:
+    raw = os.getenv(name)
+    if raw is None:
+        return default
+    try:
+        return int(raw)
+    except ValueError:
+        return default
+
+
+class Config:
+    host: str = os.getenv("BACKEND_HOST", "0.0.0.0")
+    port: int = env_int("BACKEND_PORT", 4000)
+
+    # Serving engine:
+    # - "threading" => ThreadingHTTPServer, one OS thread per request
+    # - "asyncio" => single event loop, non-blocking upstream calls with bounded concurrency
+    server_mode: str = os.getenv("SERVER_MODE", "threading").strip().lower()
+    async_max_concurrency: int = max(1, env_int("ASYNC_MAX_CONCURRENCY", 1000))
+    async_queue_depth: int = max(0, env_int("ASYNC_QUEUE_DEPTH", 4000))
+    # Listen backlog of either engine (and of the pre-fork listening socket). ASYNC_LISTEN_BACKLOG is
+    # still read as a fallback for deployments that set it before it covered both engines.
+    listen_backlog: int = max(16, env_int("LISTEN_BACKLOG", env_int("ASYNC_LISTEN_BACKLOG", 1024)))
+    # Pre-fork multi-process serving (POSIX): WORKERS > 1 forks that many processes sharing one
+    # listening socket; either engine runs inside each worker.
+    workers: int = max(1, env_int("WORKERS", 1))
+    worker_drain_sec: float = max(1.0, env_float("WORKER_DRAIN_SEC", 20.0))
+    worker_state_dir: str = os.getenv("WORKER_STATE_DIR", "").strip()
+    worker_snapshot_interval_sec: float = max(0.2, env_float("WORKER_SNAPSHOT_INTERVAL_SEC", 1.0))
+
+    # Primary generation mode:
+    # - "openai" => GPT-4.1-nano primary, rules fallback
+    # - "rules" => rules primary, OpenAI shadow optional
+    # - "race" => OpenAI primary until a soft deadline, then rules; the model result is cached for repeats
+    primary_mode: str = os.getenv("PRIMARY_MODE", "openai").strip().lower()
+    primary_timeout_sec: int = max(3, env_int("PRIMARY_TIMEOUT_SEC", 12))
+    race_soft_deadline_ms: int = max(50, env_int("RACE_SOFT_DEADLINE_MS", 800))
+
+    # Circuit breaker around the primary OpenAI call: opens when the failure rate over the last
+    # CIRCUIT_WINDOW calls reaches CIRCUIT_FAILURE_RATE (calls slower than CIRCUIT_SLOW_CALL_MS count
+    # as failures; 0 disables), serves rules immediately for CIRCUIT_OPEN_SEC, then probes.
+    circuit_breaker_enabled: bool = env_bool("CIRCUIT_BREAKER_ENABLED", True)
+    circuit_window: int = max(1, env_int("CIRCUIT_WINDOW", 50))
+    circuit_min_calls: int = max(1, env_int("CIRCUIT_MIN_CALLS", 10))
+    circuit_failure_rate: float = min(1.0, max(0.01, env_float("CIRCUIT_FAILURE_RATE", 0.5)))
+    circuit_slow_call_ms: int = max(0, env_int("CIRCUIT_SLOW_CALL_MS", 0))
+    circuit_open_sec: float = max(0.1, env_float("CIRCUIT_OPEN_SEC", 10.0))
+    circuit_half_open_probes: int = max(1, env_int("CIRCUIT_HALF_OPEN_PROBES", 2))
+    # Adaptive timeout: quantile of recent successful latencies x multiplier, within
+    # [ADAPTIVE_TIMEOUT_MIN_MS, PRIMARY_TIMEOUT_SEC].
+    adaptive_timeout_enabled: bool = env_bool("ADAPTIVE_TIMEOUT_ENABLED", False)
+    adaptive_timeout_quantile: float = min(1.0, max(0.5, env_float("ADAPTIVE_TIMEOUT_QUANTILE", 0.99)))
+    adaptive_timeout_multiplier: float = max(1.0, env_float("ADAPTIVE_TIMEOUT_MULTIPLIER", 1.5))
+    adaptive_timeout_min_ms: int = max(100, env_int("ADAPTIVE_TIMEOUT_MIN_MS", 1500))
+
+    # Admission control: token buckets per X-Install-Id (client address when missing) and global,
+    # in requests per second (0 = unlimited; batch items count individually). Over-limit requests are
+    # "downgrade"d to rules or "reject"ed with 429 + Retry-After.
+    rate_limit_enabled: bool = env_bool("RATE_LIMIT_ENABLED", False)
+    rate_limit_action: str = os.getenv("RATE_LIMIT_ACTION", "downgrade").strip().lower()
+    rate_limit_install_rps: float = max(0.0, env_float("RATE_LIMIT_INSTALL_RPS", 1.0))
+    rate_limit_install_burst: float = max(1.0, env_float("RATE_LIMIT_INSTALL_BURST", 10.0))
+    rate_limit_global_rps: float = max(0.0, env_float("RATE_LIMIT_GLOBAL_RPS", 0.0))
+    rate_limit_global_burst: float = max(1.0, env_float("RATE_LIMIT_GLOBAL_BURST", 100.0))
+
+    # /v1/reply-suggestions:stream sends the rules output as the first event before model suggestions.
+    stream_rules_first: bool = env_bool("STREAM_RULES_FIRST", True)
+
+    # /v1/reply-suggestions:batch item limit.
+    batch_max_items: int = max(1, env_int("BATCH_MAX_ITEMS", 16))
+    # Optional upstream micro-batching of concurrent single requests (threading engine).
+    micro_batch_enabled: bool = env_bool("MICRO_BATCH_ENABLED", False)
+    micro_batch_window_ms: int = max(1, env_int("MICRO_BATCH_WINDOW_MS", 5))
+    micro_batch_max_items: int = max(2, env_int("MICRO_BATCH_MAX_ITEMS", 8))
+
+    # Request deadlines and priorities: clients may send X-Deadline-Ms (remaining budget in ms) and
+    # X-Priority (high | normal | low; defaults to high for chat rewrites, normal for comment replies).
+    # DEFAULT_DEADLINE_MS applies when the header is missing (0 = none). Requests with less than
+    # DEADLINE_MIN_UPSTREAM_MS left get rules without a model call; upstream timeouts are clipped to
+    # the remaining budget.
+    default_deadline_ms: int = max(0, env_int("DEFAULT_DEADLINE_MS", 0))
+    deadline_min_upstream_ms: int = max(0, env_int("DEADLINE_MIN_UPSTREAM_MS", 50))
+    # Threading engine: model calls beyond MODEL_MAX_CONCURRENCY (0 = unlimited) wait in a priority
+    # queue of up to MODEL_QUEUE_DEPTH requests, earliest deadline first within a priority; the rest
+    # are served rules. The asyncio engine queues the same way behind ASYNC_MAX_CONCURRENCY.
+    model_max_concurrency: int = max(0, env_int("MODEL_MAX_CONCURRENCY", 0))
+    model_queue_depth: int = max(0, env_int("MODEL_QUEUE_DEPTH", 256))
+
+    # Fill the memoized rules table at startup instead of lazily on first use.
+    rules_precompute: bool = env_bool("RULES_PRECOMPUTE", False)
+
+    # Shadow calibration mode. In openai primary mode, shadow compares against rules baseline (no extra model cost).
+    # In rules primary mode, shadow optionally calls OpenAI for comparison.
+    shadow_mode: bool = env_bool("SHADOW_MODE", True)
+    shadow_sample_rate: float = max(0.0, min(1.0, env_float("SHADOW_SAMPLE_RATE", 1.0)))
+    shadow_timeout_sec: int = max(3, env_int("SHADOW_TIMEOUT_SEC", 12))
+    # Rules-primary shadow OpenAI calls run on a fixed worker pool behind a bounded queue and
+    # optional requests-per-second budgets (0 = unlimited); anything over is shed.
+    shadow_workers: int = max(1, env_int("SHADOW_WORKERS", 4))
+    shadow_queue_max: int = max(1, env_int("SHADOW_QUEUE_MAX", 256))
+    shadow_budget_rps: float = max(0.0, env_float("SHADOW_BUDGET_RPS", 0.0))
+    shadow_install_budget_rps: float = max(0.0, env_float("SHADOW_INSTALL_BUDGET_RPS", 0.0))
+    # Bounds for per-install limiter state.
+    rate_limit_max_installs: int = max(1, env_int("RATE_LIMIT_MAX_INSTALLS", 50000))
+    rate_limit_idle_ttl_sec: float = max(1.0, env_float("RATE_LIMIT_IDLE_TTL_SEC", 600.0))
+
+    openai_api_key: str = os.getenv("OPENAI_API_KEY", "").strip()
+    openai_model: str = os.getenv("OPENAI_MODEL", "gpt-4.1-nano").strip()
+    openai_base_url: str = os.getenv("OPENAI_BASE_URL", "https://api.openai.com").rstrip("/")
+    # Latency-aware routing over several upstreams: comma-separated `base_url|model|weight` entries
+    # (model and weight optional). Empty means the single OPENAI_BASE_URL / OPENAI_MODEL endpoint.
+    # Each endpoint keeps an EWMA latency and error score; the fastest healthy one (latency / weight)
+    # is picked, with an occasional weighted-random pick so idle endpoints stay measured.
+    openai_endpoints: str = os.getenv("OPENAI_ENDPOINTS", "").strip()
+    router_ewma_alpha: float = min(1.0, max(0.01, env_float("ROUTER_EWMA_ALPHA", 0.2)))
+    router_max_error_score: float = min(1.0, max(0.05, env_float("ROUTER_MAX_ERROR_SCORE", 0.5)))
+    router_retry_sec: float = max(0.1, env_float("ROUTER_RETRY_SEC", 10.0))
+    router_explore_rate: float = min(1.0, max(0.0, env_float("ROUTER_EXPLORE_RATE", 0.05)))
+    # Hedged requests: when a call outlives the endpoint's HEDGE_QUANTILE latency (at least
+    # HEDGE_MIN_MS), a second attempt goes to another endpoint; the first success wins and the other
+    # attempt is cancelled. HEDGE_MAX_RATIO caps hedges as a fraction of routed calls.
+    hedge_enabled: bool = env_bool("HEDGE_ENABLED", False)
+    hedge_quantile: float = min(0.999, max(0.5, env_float("HEDGE_QUANTILE", 0.95)))
+    hedge_min_ms: int = max(1, env_int("HEDGE_MIN_MS", 200))
+    hedge_min_samples: int = max(1, env_int("HEDGE_MIN_SAMPLES", 20))
+    hedge_max_ratio: float = min(1.0, max(0.0, env_float("HEDGE_MAX_RATIO", 0.1)))
+    # Prompt compaction: estimated token budget for the per-request (user message) part of the prompt.
+    # Secondary texts are clipped per item and dropped past the budget, then the draft and primary_text
+    # are clipped. The system prompt is fixed per prompt kind so provider prompt caching can reuse it.
+    prompt_token_budget: int = max(64, env_int("PROMPT_TOKEN_BUDGET", 400))
+    prompt_secondary_max_items: int = max(0, env_int("PROMPT_SECONDARY_MAX_ITEMS", 6))
+    prompt_secondary_item_chars: int = max(16, env_int("PROMPT_SECONDARY_ITEM_CHARS", 280))
+    prompt_draft_max_chars: int = max(16, env_int("PROMPT_DRAFT_MAX_CHARS", 400))
+    prompt_primary_max_chars: int = max(64, env_int("PROMPT_PRIMARY_MAX_CHARS", 1200))
+
+    # Persistent keep-alive connections to the OpenAI upstream, one pool per base URL. UPSTREAM_POOL_MAX_IDLE
+    # caps the connections kept open between calls (extra ones are closed on release); it does not cap
+    # checkouts, which are bounded by MODEL_MAX_CONCURRENCY / ASYNC_MAX_CONCURRENCY plus hedges.
+    # UPSTREAM_POOL_MAX_SIZE, its former name, is still read as a fallback.
+    upstream_pool_max_idle: int = max(1, env_int("UPSTREAM_POOL_MAX_IDLE", env_int("UPSTREAM_POOL_MAX_SIZE", 16)))
+    upstream_pool_idle_timeout_sec: float = max(1.0, env_float("UPSTREAM_POOL_IDLE_TIMEOUT_SEC", 60.0))
+
+    shadow_log_path: str = os.getenv("SHADOW_LOG_PATH", "backend/shadow_logs.jsonl")
+    # Shadow log writer: bounded queue (overflow is dropped and counted), batched flushes, rotation.
+    shadow_log_queue_max: int = max(1, env_int("SHADOW_LOG_QUEUE_MAX", 10000))
+    shadow_log_flush_lines: int = max(1, env_int("SHADOW_LOG_FLUSH_LINES", 256))
+    shadow_log_flush_interval_ms: int = max(10, env_int("SHADOW_LOG_FLUSH_INTERVAL_MS", 500))
+    shadow_log_rotate_bytes: int = max(0, env_int("SHADOW_LOG_ROTATE_BYTES", 64 * 1024 * 1024))
+    shadow_log_rotate_interval_sec: int = max(0, env_int("SHADOW_LOG_ROTATE_INTERVAL_SEC", 0))
+    shadow_log_gzip: bool = env_bool("SHADOW_LOG_GZIP", False)
+
+    # In-memory cache of successful model generations, keyed by canonical generation inputs.
+    response_cache_enabled: bool = env_bool("RESPONSE_CACHE_ENABLED", True)
+    response_cache_ttl_sec: float = max(0.0, env_float("RESPONSE_CACHE_TTL_SEC", 300.0))
+    response_cache_max_entries: int = max(1, env_int("RESPONSE_CACHE_MAX_ENTRIES", 2048))
+    response_cache_max_bytes: int = max(1024, env_int("RESPONSE_CACHE_MAX_BYTES", 8 * 1024 * 1024))
+
+    # Wire format: request bodies over MAX_REQUEST_BYTES (as sent, or once decoded) get 413 without being
+    # read further; gzip/deflate request bodies (Content-Encoding) are decoded incrementally. Responses of
+    # at least COMPRESSION_MIN_BYTES are compressed when Accept-Encoding allows gzip or deflate.
+    max_request_bytes: int = max(1024, env_int("MAX_REQUEST_BYTES", 256 * 1024))
+    response_compression: bool = env_bool("RESPONSE_COMPRESSION", True)
+    compression_min_bytes: int = max(0, env_int("COMPRESSION_MIN_BYTES", 256))
+    compression_level: int = min(9, max(1, env_int("COMPRESSION_LEVEL", 6)))
+
+    # Persistent suggestion store behind the response cache: SQLite (WAL) at PERSISTENT_CACHE_PATH, shared by
+    # all workers and kept across restarts. Keyed by generation inputs, the configured model(s) and the prompt
+    # version; entries live PERSISTENT_CACHE_TTL_SEC, compaction every PERSISTENT_CACHE_COMPACT_INTERVAL_SEC
+    # drops expired ones and, beyond PERSISTENT_CACHE_MAX_ENTRIES, rows of other models or prompt versions
+    # before the least used current ones. At startup the PERSISTENT_CACHE_WARM_ENTRIES
+    # most used entries are loaded into the response cache. Store errors (locked, corrupt) count as misses.
+    persistent_cache_enabled: bool = env_bool("PERSISTENT_CACHE_ENABLED", False)
+    persistent_cache_path: str = os.getenv("PERSISTENT_CACHE_PATH", "backend/suggestion_cache.sqlite3")
+    persistent_cache_ttl_sec: float = max(1.0, env_float("PERSISTENT_CACHE_TTL_SEC", 86400.0))
+    persistent_cache_max_entries: int = max(1, env_int("PERSISTENT_CACHE_MAX_ENTRIES", 100000))
+    persistent_cache_compact_interval_sec: float = max(1.0, env_float("PERSISTENT_CACHE_COMPACT_INTERVAL_SEC", 300.0))
+    persistent_cache_warm_entries: int = max(0, env_int("PERSISTENT_CACHE_WARM_ENTRIES", 1000))
+    persistent_cache_busy_timeout_ms: int = max(0, env_int("PERSISTENT_CACHE_BUSY_TIMEOUT_MS", 50))
+    persistent_cache_retry_sec: float = max(0.0, env_float("PERSISTENT_CACHE_RETRY_SEC", 30.0))
+
+    # Near-duplicate reuse for comment replies: MinHash/LSH over recent primary_text values; a model
+    # result is reused when the estimated Jaccard similarity reaches NEAR_DUP_THRESHOLD and all other
+    # generation inputs (controls, draft, desired_count) match exactly.
+    near_dup_enabled: bool = env_bool("NEAR_DUP_ENABLED", False)
+    near_dup_threshold: float = min(1.0, max(0.1, env_float("NEAR_DUP_THRESHOLD", 0.85)))
+    near_dup_num_perm: int = max(8, env_int("NEAR_DUP_NUM_PERM", 64))
+    near_dup_bands: int = max(1, env_int("NEAR_DUP_BANDS", 16))
+    near_dup_shingle_chars: int = max(2, env_int("NEAR_DUP_SHINGLE_CHARS", 5))
+    near_dup_max_entries: int = max(1, env_int("NEAR_DUP_MAX_ENTRIES", 5000))
+    near_dup_ttl_sec: int = max(0, env_int("NEAR_DUP_TTL_SEC", 3600))
+    # Memoized primary_text signatures, so a lookup miss followed by add() hashes the text once.
+    near_dup_signature_cache_size: int = max(1, env_int("NEAR_DUP_SIGNATURE_CACHE_SIZE", 256))
+
+    # Concurrent primary requests with identical generation inputs share one upstream call.
+    single_flight_enabled: bool = env_bool("SINGLE_FLIGHT_ENABLED", True)
+
+    # Speculative prefetch (POST /v1/reply-suggestions:prefetch): low-priority generations started
+    # before the user asks, claimable by X-Prefetch-Token or an equivalent payload for PREFETCH_TTL_SEC.
+    # At most PREFETCH_MAX_ENTRIES are kept; unclaimed ones that expire or are evicted count as wasted.
+    prefetch_enabled: bool = env_bool("PREFETCH_ENABLED", True)
+    prefetch_ttl_sec: float = max(1.0, env_float("PREFETCH_TTL_SEC", 30.0))
+    prefetch_max_entries: int = max(1, env_int("PREFETCH_MAX_ENTRIES", 1024))
+
+    # Per-install supersession: a newer model-bound request from the same X-Install-Id and reply_type
+    # (one of SUPERSEDE_REPLY_TYPES, comma-separated) abandons older pending ones with different inputs.
+    # They get the rules output with source "superseded"; their upstream call is cancelled unless
+    # other requests share it.
+    supersede_enabled: bool = env_bool("SUPERSEDE_ENABLED", True)
+    supersede_reply_types: str = os.getenv("SUPERSEDE_REPLY_TYPES", "chat").strip().lower()
+
+    # Request tracing: TRACE_SAMPLE_RATE of suggestion requests record a span per handling stage and are
+    # appended to TRACE_PATH as Chrome trace events (chrome://tracing, Perfetto); past TRACE_MAX_BYTES
+    # the file moves to `<TRACE_PATH>.1`. Up to TRACE_QUEUE_MAX finished traces wait for the writer.
+    trace_sample_rate: float = min(1.0, max(0.0, env_float("TRACE_SAMPLE_RATE", 0.0)))
+    trace_path: str = os.getenv("TRACE_PATH", "backend/traces.json")
+    trace_max_bytes: int = max(64 * 1024, env_int("TRACE_MAX_BYTES", 64 * 1024 * 1024))
+    trace_queue_max: int = max(1, env_int("TRACE_QUEUE_MAX", 1000))
+
+    # Admin endpoints (GET /admin/profile) need `Authorization: Bearer <ADMIN_TOKEN>`; empty disables them.
+    # A profile samples every thread's stack each PROFILE_INTERVAL_MS for at most PROFILE_MAX_SEC.
+    admin_token: str = os.getenv("ADMIN_TOKEN", "")
+    profile_max_sec: float = max(1.0, env_float("PROFILE_MAX_SEC", 30.0))
+    profile_interval_ms: float = max(1.0, env_float("PROFILE_INTERVAL_MS", 10.0))
+
+
+CONFIG = Config()
@@ -0,0 +1,307 @@
+"""Buffered background writers for the shadow log and request traces."""
+
+import atexit
+import gzip
+import json
+import os
+import random
+import shutil
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterator
+
+from reply_config import Config
+from reply_metrics import CURRENT_TRACE, METRICS, Trace
+
+
+class BufferedFileWriter(ABC):
+    """Bounded queue plus a daemon thread appending batches to a kept-open, rotating file."""
+
+    thread_name = "file-writer"
+
+    def __init__(self, path: str, queue_max: int, flush_items: int, flush_interval_sec: float):
+        self.path = Path(path)
+        self.queue_max = queue_max
+        self.flush_items = max(1, flush_items)
+        self.flush_interval_sec = flush_interval_sec
+        self._cond = threading.Condition()
+        self._queue: deque[Any] = deque()
+        self._thread: threading.Thread | None = None
+        self._file: Any = None
+        self._file_bytes = 0
+        self._file_opened_at = 0.0
+        self._submitted = 0
+        self._completed = 0
+        self._dropped = 0
+        self._written = 0
+        self._flushes = 0
+        self._rotations = 0
+        self._write_errors = 0
+        self._last_flush_ms = 0.0
+
+    def submit(self, item: Any) -> bool:
+        with self._cond:
+            if len(self._queue) >= self.queue_max:
+                self._dropped += 1
+                return False
+            self._queue.append(item)
+            self._submitted += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.thread_name, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+            if len(self._queue) >= self.flush_items:
+                self._cond.notify()
+        return True
+
+    def flush(self, timeout_sec: float = 5.0) -> None:
+        """Blocks until everything submitted so far is on disk (used at shutdown)."""
+        deadline = time.monotonic() + timeout_sec
+        with self._cond:
+            self._cond.notify()
+            while self._completed < self._submitted and self._thread is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._cond.wait(min(remaining, 0.05))
+
+    def stats(self) -> dict[str, Any]:
+        with self._cond:
+            return {
+                "queued": len(self._queue),
+                "queue_max": self.queue_max,
+                "submitted": self._submitted,
+                "written": self._written,
+                "dropped": self._dropped,
+                "flushes": self._flushes,
+                "rotations": self._rotations,
+                "write_errors": self._write_errors,
+                "last_flush_ms": round(self._last_flush_ms, 3),
+            }
+
+    @abstractmethod
+    def _encode(self, batch: list[Any]) -> bytes:
+        """Serializes one batch of queued items for a single append."""
+
+    def _file_header(self) -> bytes:
+        return b""
+
+    def _flushed(self, duration_sec: float) -> None:
+        pass
+
+    def _should_rotate(self) -> bool:
+        return False
+
+    def _rotation_target(self) -> Path:
+        return self.path.with_name(f"{self.path.name}.1")
+
+    def _finish_rotation(self, target: Path) -> None:
+        pass
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                if len(self._queue) < self.flush_items:
+                    self._cond.wait(self.flush_interval_sec)
+                batch = list(self._queue)
+                self._queue.clear()
+            if batch:
+                self._write_batch(batch)
+            else:
+                self._maybe_rotate()
+
+    def _write_batch(self, batch: list[Any]) -> None:
+        started = time.perf_counter()
+        data = self._encode(batch)
+        written = 0
+        try:
+            self._open()
+            self._file.write(data)
+            self._file.flush()
+            self._file_bytes += len(data)
+            written = len(batch)
+        except OSError:
+            self._close()
+        with self._cond:
+            self._completed += len(batch)
+            self._written += written
+            self._dropped += len(batch) - written
+            self._write_errors += 1 if written == 0 else 0
+            self._flushes += 1
+            self._last_flush_ms = (time.perf_counter() - started) * 1000
+            self._cond.notify_all()
+        self._flushed(self._last_flush_ms / 1000)
+        self._maybe_rotate()
+
+    def _open(self) -> None:
+        if self._file is not None:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(self.path, "ab")
+        self._file_bytes = self._file.tell()
+        self._file_opened_at = time.time()
+        if self._file_bytes == 0:
+            header = self._file_header()
+            self._file.write(header)
+            self._file_bytes = len(header)
+
+    def _close(self) -> None:
+        if self._file is None:
+            return
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+
+    def _maybe_rotate(self) -> None:
+        if self._file is None or self._file_bytes <= 0 or not self._should_rotate():
+            return
+        self._close()
+        target = self._rotation_target()
+        try:
+            os.replace(self.path, target)
+            self._finish_rotation(target)
+        except OSError:
+            with self._cond:
+                self._write_errors += 1
+            return
+        with self._cond:
+            self._rotations += 1
+
+
+class ShadowLogWriter(BufferedFileWriter):
+    """JSONL shadow log rotated by size and/or age, optionally gzipped."""
+
+    thread_name = "shadow-log-writer"
+
+    def __init__(self, config: Config):
+        super().__init__(
+            config.shadow_log_path,
+            config.shadow_log_queue_max,
+            config.shadow_log_flush_lines,
+            config.shadow_log_flush_interval_ms / 1000.0,
+        )
+        self.config = config
+
+    def _encode(self, batch: list[dict[str, Any]]) -> bytes:
+        return "".join(json.dumps(row, ensure_ascii=False) + "\n" for row in batch).encode("utf-8")
+
+    def _flushed(self, duration_sec: float) -> None:
+        METRICS.shadow_log_write.observe(duration_sec)
+
+    def _should_rotate(self) -> bool:
+        too_big = 0 < self.config.shadow_log_rotate_bytes <= self._file_bytes
+        too_old = (
+            self.config.shadow_log_rotate_interval_sec > 0
+            and time.time() - self._file_opened_at >= self.config.shadow_log_rotate_interval_sec
+        )
+        return too_big or too_old
+
+    def _rotation_target(self) -> Path:
+        stamp = time.strftime("%Y%m%dT%H%M%SZ", time.gmtime())
+        target = self.path.with_name(f"{self.path.name}.{stamp}")
+        suffix = 1
+        while target.exists() or target.with_name(target.name + ".gz").exists():
+            target = self.path.with_name(f"{self.path.name}.{stamp}.{suffix}")
+            suffix += 1
+        return target
+
+    def _finish_rotation(self, target: Path) -> None:
+        if self.config.shadow_log_gzip:
+            with open(target, "rb") as src, gzip.open(target.with_name(target.name + ".gz"), "wb") as dst:
+                shutil.copyfileobj(src, dst)
+            os.remove(target)
+
+
+class TraceWriter(BufferedFileWriter):
+    """Chrome trace event array (closing bracket optional); past TRACE_MAX_BYTES it replaces `<path>.1`."""
+
+    thread_name = "trace-writer"
+
+    def __init__(self, config: Config):
+        # Flushed every half second unless the queue fills up.
+        super().__init__(config.trace_path, config.trace_queue_max, config.trace_queue_max, 0.5)
+        self.config = config
+
+    def stats(self) -> dict[str, Any]:
+        return {"path": str(self.path), **super().stats()}
+
+    def _encode(self, batch: list[list[dict[str, Any]]]) -> bytes:
+        return "".join(
+            json.dumps(event, ensure_ascii=False, separators=(",", ":")) + ",\n" for events in batch for event in events
+        ).encode("utf-8")
+
+    def _file_header(self) -> bytes:
+        return b"[\n"
+
+    def _should_rotate(self) -> bool:
+        return self._file_bytes >= self.config.trace_max_bytes
+
+
+class Tracer:
+    """Samples requests for tracing and turns finished traces into Chrome trace events."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.writer = TraceWriter(config)
+        self._lock = threading.Lock()
+        self._seq = 0
+        # time.perf_counter() -> epoch microseconds.
+        self._epoch_offset_us = (time.time() - time.perf_counter()) * 1_000_000
+
+    @contextmanager
+    def request(self, name: str) -> Iterator[Trace | None]:
+        rate = self.config.trace_sample_rate
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            yield None
+            return
+        with self._lock:
+            self._seq += 1
+            trace = Trace(name, self._seq)
+        token = CURRENT_TRACE.set(trace)
+        try:
+            yield trace
+        finally:
+            CURRENT_TRACE.reset(token)
+            self._finish(trace)
+
+    def _finish(self, trace: Trace) -> None:
+        ended = time.perf_counter()
+        trace.closed = True
+        pid = os.getpid()
+        label = f"{trace.name} #{trace.track}"
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": trace.track, "args": {"name": label}},
+            self._event(trace.name, "request", trace.started, ended, pid, trace.track, trace.args),
+        ]
+        events.extend(
+            self._event(name, "stage", started, span_ended, pid, trace.track, args)
+            for name, started, span_ended, args in trace.spans
+        )
+        self.writer.submit(events)
+
+    def _event(
+        self, name: str, cat: str, started: float, ended: float, pid: int, tid: int, args: dict[str, Any] | None
+    ) -> dict[str, Any]:
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": round(started * 1_000_000 + self._epoch_offset_us, 1),
+            "dur": round((ended - started) * 1_000_000, 1),
+            "pid": pid,
+            "tid": tid,
+        }
+        if args:
+            event["args"] = args
+        return event
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            sampled = self._seq
+        return {"sample_rate": self.config.trace_sample_rate, "sampled": sampled, **self.writer.stats()}
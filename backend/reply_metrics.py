@@ -0,0 +1,318 @@
+"""Prometheus-style metrics, request trace context and latency windows."""
+
+import bisect
+import contextvars
+import math
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Any, Iterator
+
+
+class Trace:
+    """Spans recorded while handling one sampled request; see Tracer for how they are written."""
+
+    def __init__(self, name: str, track: int):
+        self.name = name
+        self.track = track
+        self.started = time.perf_counter()
+        self.args: dict[str, Any] = {}
+        # (name, started, ended, args) in time.perf_counter() seconds.
+        self.spans: list[tuple[str, float, float, dict[str, Any] | None]] = []
+        self.closed = False
+
+    def add(self, name: str, started: float, ended: float, args: dict[str, Any] | None = None) -> None:
+        # Background work (race mode, prefetch) may outlive the request; its late spans are dropped.
+        if not self.closed:
+            self.spans.append((name, started, ended, args))
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, started, time.perf_counter())
+
+
+# The sampled request being handled, if any. Threads started on its behalf copy the context.
+CURRENT_TRACE: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("reply_trace", default=None)
+_NO_SPAN = nullcontext()
+
+
+def trace_span(name: str) -> Any:
+    """Context manager timing one stage of the current request; a shared no-op when it is not sampled."""
+    trace = CURRENT_TRACE.get()
+    return _NO_SPAN if trace is None else trace.span(name)
+
+
+def trace_annotate(**args: Any) -> None:
+    """Adds `args` to the current request's trace (no-op when it is not sampled)."""
+    trace = CURRENT_TRACE.get()
+    if trace is not None:
+        trace.args.update(args)
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0)
+FAST_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1)
+PROMPT_TOKEN_BUCKETS = (32, 64, 128, 192, 256, 384, 512, 768, 1024, 1536, 2048, 4096)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Monotonic counter with optional labels, rendered in the Prometheus text format."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str, labelnames: tuple[str, ...] = ()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0.0) + amount
+
+    def snapshot(self) -> list[list[Any]]:
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def render(self, peers: list[list[list[Any]]] = ()) -> list[str]:
+        """`peers` are snapshots from other worker processes, summed into the output."""
+        with self._lock:
+            merged = dict(self._values)
+        for snapshot in peers:
+            for key, value in snapshot:
+                merged[tuple(key)] = merged.get(tuple(key), 0.0) + value
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value:g}" for key, value in sorted(merged.items())]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labelvalues: str, amount: float = 1.0) -> None:
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram:
+    """Fixed-bucket histogram; `observe` is a bisect plus a few additions under a per-metric lock."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help_text: str,
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+        labelnames: tuple[str, ...] = (),
+    ):
+        self.name = name
+        self.help_text = help_text
+        # Trace span name for `time()` sections, e.g. reply_openai_network_seconds -> openai_network.
+        self.span_name = name.removeprefix("reply_").removesuffix("_seconds").removesuffix("_duration")
+        self.buckets = buckets
+        self.labelnames = labelnames
+        self._lock = threading.Lock()
+        # Per label set: [count per bucket (last is +Inf)..., sum]
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labelvalues)
+            if row is None:
+                row = self._values[labelvalues] = [0.0] * (len(self.buckets) + 2)
+            row[index] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, *labelvalues: str) -> Iterator[None]:
+        """Observes the block's duration; also records it as a span when the request is traced."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            ended = time.perf_counter()
+            self.observe(ended - started, *labelvalues)
+            trace = CURRENT_TRACE.get()
+            if trace is not None:
+                trace.add(self.span_name, started, ended, dict(zip(self.labelnames, labelvalues)) or None)
+
+    def snapshot(self) -> list[list[Any]]:
+        with self._lock:
+            return [[list(key), list(row)] for key, row in self._values.items()]
+
+    def render(self, peers: list[list[list[Any]]] = ()) -> list[str]:
+        """`peers` are snapshots from other worker processes, summed into the output."""
+        with self._lock:
+            merged = {key: list(row) for key, row in self._values.items()}
+        for snapshot in peers:
+            for key, row in snapshot:
+                if len(row) != len(self.buckets) + 2:
+                    continue
+                current = merged.setdefault(tuple(key), [0.0] * len(row))
+                for index, value in enumerate(row):
+                    current[index] += value
+        lines: list[str] = []
+        for key, row in sorted(merged.items()):
+            cumulative = 0.0
+            for bound, count in zip((*self.buckets, math.inf), row):
+                cumulative += count
+                le = 'le="+Inf"' if bound == math.inf else f'le="{bound:g}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative:g}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {row[-1]:.6f}")
+            lines.append(f"{self.name}_count{labels} {cumulative:g}")
+        return lines
+
+
+class Metrics:
+    """Process-wide metric registry served at GET /metrics."""
+
+    def __init__(self) -> None:
+        self.requests_in_flight = Gauge("reply_requests_in_flight", "HTTP requests currently being handled.")
+        self.request_duration = Histogram(
+            "reply_request_duration_seconds",
+            "Suggestion request latency from parsed body to response written, by response source.",
+            labelnames=("source",),
+        )
+        self.rules_duration = Histogram(
+            "reply_rules_duration_seconds", "Time spent in generate_rules_suggestions.", FAST_BUCKETS
+        )
+        self.openai_network = Histogram(
+            "reply_openai_network_seconds", "OpenAI chat completion round trip (send to body read)."
+        )
+        self.openai_parse = Histogram(
+            "reply_openai_parse_seconds", "Decoding and validating OpenAI completion JSON.", FAST_BUCKETS
+        )
+        self.serialization = Histogram(
+            "reply_serialization_seconds", "JSON response serialization time.", FAST_BUCKETS
+        )
+        self.fallbacks = Counter(
+            "reply_fallbacks_total", "Requests served from rules because the model call failed.", ("reason",)
+        )
+        self.upstream_calls = Counter(
+            "reply_upstream_calls_total",
+            "Upstream model calls by endpoint and outcome (ok, error, cancelled).",
+            ("endpoint", "outcome"),
+        )
+        self.hedges = Counter(
+            "reply_hedged_calls_total", "Hedged model calls by winning attempt (primary, hedge, none).", ("winner",)
+        )
+        self.deadline_expired = Counter(
+            "reply_deadline_expired_total",
+            "Model calls dropped because the request deadline passed, by stage (received, queue, upstream).",
+            ("stage",),
+        )
+        self.scheduler_rejected = Counter(
+            "reply_scheduler_rejected_total", "Model calls turned away because the priority queue was full."
+        )
+        self.prefetches = Counter(
+            "reply_prefetch_total",
+            "Prefetch lifecycle: started, claims (ready, pending, failed, miss) and wasted (expired, evicted).",
+            ("event",),
+        )
+        self.superseded = Counter(
+            "reply_superseded_total",
+            "Requests abandoned for a newer one from the same install, by stage (before_upstream, upstream, detached).",
+            ("stage",),
+        )
+        self.superseded_tokens = Counter(
+            "reply_superseded_saved_prompt_tokens_total",
+            "Estimated prompt tokens of upstream calls never sent because their request was superseded.",
+        )
+        self.rate_limited = Counter(
+            "reply_rate_limited_total", "Requests over an admission limit, by scope and action.", ("scope", "action")
+        )
+        self.prompt_tokens = Histogram(
+            "reply_prompt_user_tokens",
+            "Estimated tokens in the per-request part of upstream prompts, by prompt kind.",
+            PROMPT_TOKEN_BUCKETS,
+            ("kind",),
+        )
+        self.shadow_failures = Counter(
+            "reply_shadow_task_failures_total", "Shadow tasks that raised, by exception type.", ("error",)
+        )
+        self.shadow_log_write = Histogram(
+            "reply_shadow_log_write_seconds", "Shadow log batch write and flush time.", FAST_BUCKETS
+        )
+        self.compression = Histogram(
+            "reply_compression_seconds",
+            "Content-Encoding work by direction (response: compress, request: decompress).",
+            FAST_BUCKETS,
+            ("direction",),
+        )
+        self.body_bytes = Counter(
+            "reply_encoded_body_bytes_total",
+            "Sizes of content-encoded bodies by direction and form (raw: uncompressed, wire: as sent).",
+            ("direction", "form"),
+        )
+        self.body_rejected = Counter(
+            "reply_request_body_rejected_total",
+            "Request bodies refused before parsing, by reason (too_large, encoding, malformed).",
+            ("reason",),
+        )
+
+    def families(self) -> list[Counter | Histogram]:
+        return [value for value in vars(self).values() if isinstance(value, (Counter, Histogram))]
+
+    def snapshot(self) -> dict[str, list[list[Any]]]:
+        return {family.name: family.snapshot() for family in self.families()}
+
+    def render(self, peers: list[dict[str, list[list[Any]]]] = ()) -> str:
+        lines: list[str] = []
+        for family in self.families():
+            lines.append(f"# HELP {family.name} {family.help_text}")
+            lines.append(f"# TYPE {family.name} {family.kind}")
+            lines.extend(family.render([peer.get(family.name, []) for peer in peers]))
+        return "\n".join(lines) + "\n"
+
+
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class LatencyWindow:
+    """Percentiles over the most recent `size` samples (milliseconds)."""
+
+    def __init__(self, size: int = 1024):
+        self._lock = threading.Lock()
+        self._samples: deque[float] = deque(maxlen=size)
+
+    def add(self, value_ms: float) -> None:
+        with self._lock:
+            self._samples.append(value_ms)
+
+    def count(self) -> int:
+        with self._lock:
+            return len(self._samples)
+
+    def quantile(self, q: float) -> float | None:
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)]
+
+    def percentiles(self, quantiles: tuple[float, ...] = (0.5, 0.95, 0.99)) -> dict[str, float | None]:
+        with self._lock:
+            ordered = sorted(self._samples)
+        out: dict[str, float | None] = {}
+        for q in quantiles:
+            name = f"p{int(q * 100)}"
+            if not ordered:
+                out[name] = None
+                continue
+            out[name] = round(ordered[min(len(ordered) - 1, int(math.ceil(q * len(ordered))) - 1)], 1)
+        return out
+
+
+METRICS = Metrics()
@@ -0,0 +1,275 @@
+"""Generation inputs and keys, and chat-completions prompt construction."""
+
+import hashlib
+import json
+import re
+from typing import Any
+
+from reply_config import Config
+from reply_metrics import METRICS
+from reply_upstream import upstream_endpoints
+
+
+def canonical_text(text: str) -> str:
+    return re.sub(r"[^a-z0-9\s]+", "", text.lower()).strip()
+
+
+def desired_count_from_payload(payload: dict[str, Any]) -> int:
+    raw = payload.get("desired_count", 5)
+    try:
+        value = int(raw)
+    except (TypeError, ValueError):
+        value = 5
+    return max(1, min(5, value))
+
+
+def secondary_texts_from_payload(payload: dict[str, Any]) -> list[str]:
+    context = payload.get("context", {}) if isinstance(payload.get("context"), dict) else {}
+    secondary_texts_raw = context.get("secondary_texts", [])
+    secondary_texts: list[str] = []
+    if isinstance(secondary_texts_raw, list):
+        for item in secondary_texts_raw:
+            text = str(item).strip()
+            if text:
+                secondary_texts.append(text)
+    return secondary_texts
+
+
+def generation_inputs(payload: dict[str, Any]) -> dict[str, Any]:
+    context = payload.get("context", {}) if isinstance(payload.get("context"), dict) else {}
+    # The key covers every secondary text a prompt may carry (PROMPT_SECONDARY_MAX_ITEMS).
+    secondary_limit = max(6, Config.prompt_secondary_max_items)
+    return {
+        "reply_type": str(context.get("reply_type", "comment")).strip().lower() or "comment",
+        "primary_text": str(context.get("primary_text", "")).strip(),
+        "secondary_texts": secondary_texts_from_payload(payload)[:secondary_limit],
+        "user_draft": str(payload.get("user_draft", "")).strip(),
+        "controls": payload.get("controls", {}) if isinstance(payload.get("controls"), dict) else {},
+        "desired_count": desired_count_from_payload(payload),
+    }
+
+
+def generation_key(payload: dict[str, Any]) -> str:
+    canonical = json.dumps(
+        generation_inputs(payload),
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+        default=str,
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+SYSTEM_PROMPT_INTRO = {
+    "chat": "You generate direct, in-context reply suggestions for social/chat inputs. ",
+    "comment": "You generate direct, in-context reply suggestions for social feed comments. ",
+}
+SYSTEM_PROMPT_RULES = {
+    "chat": (
+        "Each object keys: text, archetype, tone. "
+        "Archetype one of: witty, supportive, short, curious, direct. "
+        "Tone one of: playful, friendly, neutral, serious. "
+        "No markdown. No code fences. No preamble. "
+        "Rewrite ONLY the provided primary_text into improved alternatives. "
+        "Do not add new facts, names, requests, or side topics. "
+        "Preserve the original meaning, topic, entities, and language."
+    ),
+    "comment": (
+        "Each object keys: text, archetype, tone. "
+        "Archetype one of: witty, supportive, short, curious, direct. "
+        "Tone one of: playful, friendly, neutral, serious. "
+        "No markdown. No code fences. No preamble. "
+        "Write replies TO the primary_text, not rewrites OF primary_text. "
+        "Do not copy or paraphrase the full primary_text. "
+        "Use secondary_texts only as supporting context when provided."
+    ),
+}
+
+
+def prompt_kind_for(reply_type: str) -> str:
+    """Chat rewrites and feed replies use different prompts and temperatures."""
+    return "chat" if reply_type == "chat" else "comment"
+
+
+PROMPT_TEMPERATURES = {"chat": 0.2, "comment": 0.45}
+SYSTEM_PROMPT_TASK = {
+    "chat": (
+        "Return exactly desired_count polished rewrites of primary_text: "
+        "use only primary_text, no side-topic additions, no context shift. "
+    ),
+    "comment": (
+        "Return exactly desired_count short, sendable replies to the target content: "
+        "reply to primary_text as another person, do not rewrite primary_text, stay on-topic. "
+    ),
+}
+SINGLE_OUTPUT_FORMAT = "Output strict JSON with key 'suggestions' containing exactly desired_count objects. "
+BATCH_OUTPUT_FORMAT = (
+    "The user message has 'items': independent requests that must be answered separately. "
+    "Output strict JSON with key 'results' containing one object per item, in input order, "
+    "with keys id and suggestions; each suggestions list has exactly that item's desired_count objects. "
+)
+PROMPT_CONTROL_KEYS = ("tone_bias", "length", "emoji_level", "slang_level")
+PROMPT_FIELD_MIN_CHARS = 16
+# Changes with the prompt text, so stored suggestions from an older prompt are not served.
+PROMPT_VERSION = hashlib.sha256(
+    json.dumps(
+        [
+            SYSTEM_PROMPT_INTRO,
+            SYSTEM_PROMPT_TASK,
+            SYSTEM_PROMPT_RULES,
+            SINGLE_OUTPUT_FORMAT,
+            BATCH_OUTPUT_FORMAT,
+            PROMPT_TEMPERATURES,
+        ],
+        sort_keys=True,
+    ).encode("utf-8")
+).hexdigest()[:12]
+
+
+def estimate_tokens(text: str) -> int:
+    """Tokenizer-free estimate: about four ASCII characters per token, one per other character."""
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+
+def clip_text(text: str, max_chars: int) -> str:
+    """Cuts `text` to at most `max_chars` characters, at a word boundary when one is close."""
+    if len(text) <= max_chars:
+        return text
+    cut = text[: max(1, max_chars - 1)]
+    space = cut.rfind(" ")
+    if space >= len(cut) * 0.6:
+        cut = cut[:space]
+    return cut.rstrip() + "\u2026"
+
+
+class PromptBuilder:
+    """Encodes chat-completions bodies with a byte-stable system prompt prefix per prompt kind."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.system_prompts: dict[tuple[str, bool], str] = {}
+        self._prefixes: dict[tuple[str, str, bool, bool], bytes] = {}
+        models = sorted({model for _, model, _ in upstream_endpoints(config)})
+        for kind, temperature in PROMPT_TEMPERATURES.items():
+            for batch in (False, True):
+                system_prompt = (
+                    SYSTEM_PROMPT_INTRO[kind]
+                    + SYSTEM_PROMPT_TASK[kind]
+                    + (BATCH_OUTPUT_FORMAT if batch else SINGLE_OUTPUT_FORMAT)
+                    + SYSTEM_PROMPT_RULES[kind]
+                )
+                self.system_prompts[(kind, batch)] = system_prompt
+                for model in models:
+                    for stream in (False, True):
+                        head: dict[str, Any] = {"model": model, "temperature": temperature}
+                        if stream:
+                            head["stream"] = True
+                        head["response_format"] = {"type": "json_object"}
+                        self._prefixes[(model, kind, batch, stream)] = (
+                            json.dumps(head)[:-1]
+                            + ', "messages": [{"role": "system", "content": '
+                            + json.dumps(system_prompt)
+                            + '}, {"role": "user", "content": '
+                        ).encode("utf-8")
+        self.system_tokens = {key: estimate_tokens(text) for key, text in self.system_prompts.items()}
+
+    def compact(self, payload: dict[str, Any]) -> tuple[str, dict[str, Any], dict[str, Any]]:
+        """Returns (prompt_kind, user_message_fields, stats) for one request."""
+        config = self.config
+        inputs = generation_inputs(payload)
+        kind = prompt_kind_for(inputs["reply_type"])
+        controls = {
+            key: inputs["controls"][key]
+            for key in PROMPT_CONTROL_KEYS
+            if isinstance(inputs["controls"].get(key), (str, int, float))
+        }
+        fields: dict[str, Any] = {
+            "reply_type": inputs["reply_type"],
+            "desired_count": inputs["desired_count"],
+            "controls": controls,
+            "primary_text": clip_text(inputs["primary_text"], config.prompt_primary_max_chars),
+        }
+        if inputs["user_draft"]:
+            fields["user_draft"] = clip_text(inputs["user_draft"], config.prompt_draft_max_chars)
+
+        raw_secondary = secondary_texts_from_payload(payload)
+        # Room for the secondary_texts and secondary_omitted keys, whichever end up in the message.
+        budget = config.prompt_token_budget
+        if raw_secondary:
+            budget -= estimate_tokens(f',"secondary_texts":[],"secondary_omitted":{len(raw_secondary)}')
+        remaining = budget - estimate_tokens(self._encode_fields(fields))
+        # Over budget before any context: shrink the draft first, then the post itself. Characters per
+        # token vary (non-ASCII text costs one token each), so re-estimate until it fits or hits the floor.
+        for name in ("user_draft", "primary_text"):
+            while remaining < 0 and name in fields and len(fields[name]) > PROMPT_FIELD_MIN_CHARS:
+                text = fields[name]
+                chars_per_token = len(text) / max(1, estimate_tokens(text))
+                target = max(PROMPT_FIELD_MIN_CHARS, min(len(text) - 1, int(len(text) + remaining * chars_per_token)))
+                fields[name] = clip_text(text, target)
+                remaining = budget - estimate_tokens(self._encode_fields(fields))
+
+        secondary: list[str] = []
+        clipped_secondary = 0
+        for text in raw_secondary[: config.prompt_secondary_max_items]:
+            clipped = clip_text(text, config.prompt_secondary_item_chars)
+            cost = estimate_tokens(json.dumps(clipped, ensure_ascii=False)) + 1
+            if cost <= remaining:
+                secondary.append(clipped)
+                clipped_secondary += clipped != text
+                remaining -= cost
+        omitted = len(raw_secondary) - len(secondary)
+        if secondary:
+            fields["secondary_texts"] = secondary
+        if omitted:
+            # Tell the model context exists even when it did not fit.
+            fields["secondary_omitted"] = omitted
+
+        stats = {
+            "kind": kind,
+            "system_tokens": self.system_tokens[(kind, False)],
+            "user_tokens": estimate_tokens(self._encode_fields(fields)),
+            "secondary_kept": len(secondary),
+            "secondary_omitted": omitted,
+            "clipped_fields": clipped_secondary
+            + (fields["primary_text"] != inputs["primary_text"])
+            + (fields.get("user_draft", "") != inputs["user_draft"]),
+        }
+        return kind, fields, stats
+
+    def user_message(self, payload: dict[str, Any]) -> tuple[str, str]:
+        """Returns (prompt_kind, encoded user message) for one request."""
+        kind, fields, stats = self.compact(payload)
+        METRICS.prompt_tokens.observe(stats["user_tokens"], kind)
+        return kind, self._encode_fields(fields)
+
+    def batch_user_message(self, payloads: list[dict[str, Any]]) -> tuple[str, str]:
+        """One multi-item user message for payloads of the same prompt kind (see `prompt_kind`)."""
+        kind = "comment"
+        items: list[dict[str, Any]] = []
+        for index, payload in enumerate(payloads):
+            kind, fields, stats = self.compact(payload)
+            METRICS.prompt_tokens.observe(stats["user_tokens"], kind)
+            items.append({"id": index, **fields})
+        return kind, self._encode_fields({"items": items})
+
+    def body(self, model: str, kind: str, user_content: str, batch: bool = False, stream: bool = False) -> bytes:
+        prefix = self._prefixes[(model, kind, batch, stream)]
+        return prefix + json.dumps(user_content).encode("utf-8") + b"}]}"
+
+    @staticmethod
+    def _encode_fields(fields: dict[str, Any]) -> str:
+        return json.dumps(fields, ensure_ascii=False, separators=(",", ":"))
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "token_budget": self.config.prompt_token_budget,
+            "system_tokens": {
+                f"{kind}{':batch' if batch else ''}": tokens for (kind, batch), tokens in self.system_tokens.items()
+            },
+            "system_prefix_bytes": {
+                f"{model}:{kind}{':batch' if batch else ''}": len(prefix)
+                for (model, kind, batch, stream), prefix in self._prefixes.items()
+                if not stream
+            },
+        }
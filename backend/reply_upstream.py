@@ -0,0 +1,807 @@
+"""Upstream HTTP: keep-alive connection pools, cancellation and latency-aware endpoint routing."""
+
+import asyncio
+import contextvars
+import http.client
+import math
+import queue
+import random
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, AsyncIterator, Callable, Iterator
+from urllib.parse import urlsplit
+
+from reply_config import Config
+from reply_metrics import METRICS, LatencyWindow
+
+
+class UpstreamCancelledError(RuntimeError):
+    pass
+
+
+class UpstreamCancel:
+    """Lets another thread abort a blocking pooled request by shutting its socket down."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._conn: http.client.HTTPConnection | None = None
+        self._children: list[UpstreamCancel] = []
+        self._callbacks: list[Callable[[], None]] = []
+        self.cancelled = False
+
+    def child(self) -> "UpstreamCancel":
+        child = UpstreamCancel()
+        with self._lock:
+            child.cancelled = self.cancelled
+            if not self.cancelled:
+                self._children.append(child)
+        return child
+
+    def attach(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if self.cancelled:
+                raise UpstreamCancelledError("Upstream request cancelled")
+            self._conn = conn
+
+    def detach(self) -> None:
+        """Called once the request is over, before the connection can go back to the pool."""
+        with self._lock:
+            self._conn = None
+
+    def add_callback(self, fn: Callable[[], None]) -> None:
+        """Runs `fn` on cancel, right away if already cancelled, e.g. to wake a waiter queued for a slot."""
+        with self._lock:
+            if not self.cancelled:
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def remove_callback(self, fn: Callable[[], None]) -> None:
+        with self._lock:
+            if fn in self._callbacks:
+                self._callbacks.remove(fn)
+
+    def cancel(self) -> None:
+        with self._lock:
+            self.cancelled = True
+            conn = self._conn
+            children, self._children = self._children, []
+            callbacks, self._callbacks = self._callbacks, []
+        for child in children:
+            child.cancel()
+        for callback in callbacks:
+            callback()
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class UpstreamConnectionPool:
+    """Thread-safe pool of persistent HTTP/1.1 connections to one base URL; keeps up to `max_idle` open when idle."""
+
+    def __init__(self, base_url: str, max_idle: int, idle_timeout_sec: float):
+        parts = urlsplit(base_url)
+        if parts.scheme not in {"http", "https"} or not parts.hostname:
+            raise ValueError(f"Unsupported upstream base URL: {base_url}")
+        self.base_url = base_url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.base_path = parts.path.rstrip("/")
+        self.max_idle = max_idle
+        self.idle_timeout_sec = idle_timeout_sec
+        self._ssl_context = ssl.create_default_context() if parts.scheme == "https" else None
+        self._lock = threading.Lock()
+        # (connection, last_used_monotonic); most recently used connections are on the right.
+        self._idle: deque[tuple[http.client.HTTPConnection, float]] = deque()
+        self._in_use = 0
+        self._created = 0
+        self._reused = 0
+        self._stale_retries = 0
+        self._idle_closed = 0
+        self._overflow_closed = 0
+        self._requests = 0
+
+    def request(
+        self,
+        method: str,
+        path: str,
+        body: bytes,
+        headers: dict[str, str],
+        timeout_sec: float,
+        cancel: UpstreamCancel | None = None,
+    ) -> tuple[int, str, bytes]:
+        """Sends one request and returns (status, reason, body)."""
+        conn, resp = self._send(method, path, body, headers, timeout_sec, cancel)
+        try:
+            data = resp.read()
+        except BaseException:
+            self._discard(conn)
+            raise
+        finally:
+            if cancel is not None:
+                cancel.detach()
+        self._release(conn, reusable=not resp.will_close)
+        return resp.status, resp.reason, data
+
+    @contextmanager
+    def stream(
+        self,
+        method: str,
+        path: str,
+        body: bytes,
+        headers: dict[str, str],
+        timeout_sec: float,
+        cancel: UpstreamCancel | None = None,
+    ) -> Iterator[http.client.HTTPResponse]:
+        """Yields the response for incremental reads; the connection is only reused if it was fully read."""
+        conn, resp = self._send(method, path, body, headers, timeout_sec, cancel)
+        try:
+            yield resp
+        except BaseException:
+            self._discard(conn)
+            raise
+        finally:
+            if cancel is not None:
+                cancel.detach()
+        if resp.isclosed():
+            self._release(conn, reusable=not resp.will_close)
+        else:
+            self._discard(conn)
+
+    def _send(
+        self,
+        method: str,
+        path: str,
+        body: bytes,
+        headers: dict[str, str],
+        timeout_sec: float,
+        cancel: UpstreamCancel | None = None,
+    ) -> tuple[http.client.HTTPConnection, http.client.HTTPResponse]:
+        """Sends the request and reads the response head, retrying once if a reused connection was closed."""
+        with self._lock:
+            self._requests += 1
+        for attempt in range(2):
+            conn, reused = self._acquire(timeout_sec)
+            try:
+                conn.timeout = timeout_sec
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout_sec)
+                if cancel is not None:
+                    if conn.sock is None:
+                        conn.connect()
+                    cancel.attach(conn)
+                conn.request(method, self.base_path + path, body=body, headers=headers)
+                return conn, conn.getresponse()
+            except (ConnectionResetError, BrokenPipeError, http.client.BadStatusLine):
+                self._discard(conn)
+                if reused and attempt == 0:
+                    with self._lock:
+                        self._stale_retries += 1
+                    continue
+                raise
+            except BaseException:
+                self._discard(conn)
+                raise
+        raise RuntimeError("unreachable")
+
+    def close(self) -> None:
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            conn.close()
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "max_idle": self.max_idle,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "requests": self._requests,
+                "created": self._created,
+                "reused": self._reused,
+                "stale_retries": self._stale_retries,
+                "idle_closed": self._idle_closed,
+                "overflow_closed": self._overflow_closed,
+            }
+
+    def _acquire(self, timeout_sec: float) -> tuple[http.client.HTTPConnection, bool]:
+        expired: list[http.client.HTTPConnection] = []
+        conn: http.client.HTTPConnection | None = None
+        now = time.monotonic()
+        with self._lock:
+            self._in_use += 1
+            while self._idle:
+                candidate, last_used = self._idle.pop()
+                if now - last_used > self.idle_timeout_sec:
+                    expired.append(candidate)
+                    self._idle_closed += 1
+                    continue
+                conn = candidate
+                self._reused += 1
+                break
+            if conn is None:
+                self._created += 1
+        for stale in expired:
+            stale.close()
+        if conn is not None:
+            return conn, True
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.host, self.port, timeout=timeout_sec, context=self._ssl_context), False
+        return http.client.HTTPConnection(self.host, self.port, timeout=timeout_sec), False
+
+    def _release(self, conn: http.client.HTTPConnection, reusable: bool) -> None:
+        with self._lock:
+            self._in_use -= 1
+            if reusable and len(self._idle) < self.max_idle:
+                self._idle.append((conn, time.monotonic()))
+                return
+            if reusable:
+                self._overflow_closed += 1
+        conn.close()
+
+    def _discard(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            self._in_use -= 1
+        conn.close()
+
+
+def upstream_endpoints(config: Config) -> list[tuple[str, str, float]]:
+    """Parses OPENAI_ENDPOINTS into (base_url, model, weight); defaults to the single configured endpoint."""
+    out: list[tuple[str, str, float]] = []
+    for entry in config.openai_endpoints.split(","):
+        if not entry.strip():
+            continue
+        base_url, _, rest = entry.strip().partition("|")
+        model, _, weight = rest.partition("|")
+        try:
+            parsed_weight = float(weight) if weight.strip() else 1.0
+        except ValueError:
+            raise ValueError(f"Invalid weight in OPENAI_ENDPOINTS entry: {entry.strip()}") from None
+        out.append((base_url.strip().rstrip("/"), model.strip() or config.openai_model, max(0.01, parsed_weight)))
+    return out or [(config.openai_base_url, config.openai_model, 1.0)]
+
+
+class UpstreamPools:
+    def __init__(self, config: Config):
+        self.config = config
+        self._lock = threading.Lock()
+        self._pools: dict[str, UpstreamConnectionPool] = {}
+
+    def get(self, base_url: str) -> UpstreamConnectionPool:
+        with self._lock:
+            pool = self._pools.get(base_url)
+            if pool is None:
+                pool = UpstreamConnectionPool(
+                    base_url,
+                    max_idle=self.config.upstream_pool_max_idle,
+                    idle_timeout_sec=self.config.upstream_pool_idle_timeout_sec,
+                )
+                self._pools[base_url] = pool
+            return pool
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            pools = dict(self._pools)
+        return {base_url: pool.stats() for base_url, pool in pools.items()}
+
+
+class UpstreamEndpoint:
+    """One routable upstream (base URL + model) with its EWMA latency and error score."""
+
+    def __init__(self, base_url: str, model: str, weight: float):
+        self.base_url = base_url
+        self.model = model
+        self.weight = weight
+        self.name = f"{model}@{urlsplit(base_url).netloc or base_url}"
+        self.ewma_latency_ms: float | None = None
+        self.error_score = 0.0
+        self.retry_at = 0.0
+        self.latency = LatencyWindow(256)
+        self.calls = 0
+        self.errors = 0
+        self.cancelled = 0
+        self.hedge_wins = 0
+
+
+class EndpointRouter:
+    """Routes model calls to the healthy endpoint with the lowest EWMA latency and hedges slow calls."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.endpoints = [UpstreamEndpoint(url, model, weight) for url, model, weight in upstream_endpoints(config)]
+        self._lock = threading.Lock()
+        self._rng = random.Random()
+        self._routed = 0
+        self._hedged = 0
+
+    def pick(self, exclude: UpstreamEndpoint | None = None) -> UpstreamEndpoint:
+        now = time.monotonic()
+        max_error = self.config.router_max_error_score
+        with self._lock:
+            candidates = [e for e in self.endpoints if e is not exclude] or self.endpoints
+            healthy = [e for e in candidates if e.error_score < max_error or now >= e.retry_at]
+            if not healthy:
+                return min(candidates, key=lambda e: e.error_score)
+            if len(healthy) > 1 and self._rng.random() < self.config.router_explore_rate:
+                chosen = self._rng.choices(healthy, weights=[e.weight for e in healthy])[0]
+            else:
+                chosen = min(healthy, key=self._score)
+            if chosen.error_score >= max_error:
+                chosen.retry_at = now + self.config.router_retry_sec
+            return chosen
+
+    @staticmethod
+    def _score(endpoint: UpstreamEndpoint) -> float:
+        """Lower is better; endpoints that never answered go first unless they have only failed."""
+        if endpoint.ewma_latency_ms is None:
+            return 0.0 if endpoint.errors == 0 else math.inf
+        return endpoint.ewma_latency_ms / endpoint.weight * (1.0 + endpoint.error_score)
+
+    def record(self, endpoint: UpstreamEndpoint, elapsed_sec: float, outcome: str) -> None:
+        """`outcome` is ok, error or cancelled (the losing side of a hedge)."""
+        METRICS.upstream_calls.inc(endpoint.name, outcome)
+        elapsed_ms = elapsed_sec * 1000
+        alpha = self.config.router_ewma_alpha
+        with self._lock:
+            if outcome == "cancelled":
+                endpoint.cancelled += 1
+                # The attempt would have taken at least this long, so it may only raise the estimate.
+                if endpoint.ewma_latency_ms is not None:
+                    elapsed_ms = max(elapsed_ms, endpoint.ewma_latency_ms)
+            else:
+                endpoint.calls += 1
+                failed = outcome != "ok"
+                endpoint.error_score += alpha * (float(failed) - endpoint.error_score)
+                if failed:
+                    endpoint.errors += 1
+                    if endpoint.error_score >= self.config.router_max_error_score:
+                        endpoint.retry_at = time.monotonic() + self.config.router_retry_sec
+                    return
+            if endpoint.ewma_latency_ms is None:
+                endpoint.ewma_latency_ms = elapsed_ms
+            else:
+                endpoint.ewma_latency_ms += alpha * (elapsed_ms - endpoint.ewma_latency_ms)
+        if outcome == "ok":
+            endpoint.latency.add(elapsed_ms)
+
+    def hedge_delay_sec(self, endpoint: UpstreamEndpoint, timeout_sec: float) -> float | None:
+        """Seconds to wait before hedging a call to `endpoint`, or None when it should not be hedged."""
+        config = self.config
+        if not config.hedge_enabled or endpoint.latency.count() < config.hedge_min_samples:
+            return None
+        with self._lock:
+            if self._hedged >= config.hedge_max_ratio * self._routed:
+                return None
+        observed_ms = endpoint.latency.quantile(config.hedge_quantile) or 0.0
+        delay = max(config.hedge_min_ms, observed_ms) / 1000.0
+        return delay if delay < timeout_sec else None
+
+    def call(
+        self,
+        attempt: Callable[[UpstreamEndpoint, float, UpstreamCancel], Any],
+        timeout_sec: float,
+        route: dict[str, Any] | None = None,
+        cancel: UpstreamCancel | None = None,
+    ) -> Any:
+        """Runs `attempt` on a picked endpoint, hedging it when it runs long."""
+        new_cancel = cancel.child if cancel is not None else UpstreamCancel
+        primary = self.pick()
+        with self._lock:
+            self._routed += 1
+        delay = self.hedge_delay_sec(primary, timeout_sec)
+        if delay is None:
+            try:
+                result, elapsed_sec = self._run(primary, attempt, timeout_sec, new_cancel())
+            except BaseException:
+                self._settle([(primary, "primary")], "none", 0.0, route)
+                raise
+            self._settle([(primary, "primary")], "primary", elapsed_sec, route)
+            return result
+
+        deadline = time.monotonic() + timeout_sec
+        done: queue.Queue = queue.Queue()
+        attempts = [(primary, "primary")]
+        cancels = {"primary": new_cancel()}
+        self._spawn(primary, attempt, timeout_sec, cancels["primary"], "primary", done)
+        try:
+            first = done.get(timeout=delay)
+        except queue.Empty:
+            first = None
+            hedge = self.pick(exclude=primary)
+            with self._lock:
+                self._hedged += 1
+            attempts.append((hedge, "hedge"))
+            cancels["hedge"] = new_cancel()
+            self._spawn(hedge, attempt, timeout_sec - delay, cancels["hedge"], "hedge", done)
+
+        error: BaseException | None = None
+        for _ in attempts:
+            if first is not None:
+                outcome, first = first, None
+            else:
+                try:
+                    outcome = done.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            label, result, exc, elapsed_sec = outcome
+            if exc is None:
+                for other, attempt_cancel in cancels.items():
+                    if other != label:
+                        attempt_cancel.cancel()
+                self._settle(attempts, label, elapsed_sec, route)
+                return result
+            error = exc
+        for attempt_cancel in cancels.values():
+            attempt_cancel.cancel()
+        self._settle(attempts, "none", 0.0, route)
+        raise error or TimeoutError("Hedged upstream call timed out")
+
+    async def call_async(
+        self,
+        attempt: Callable[[UpstreamEndpoint, float], Any],
+        timeout_sec: float,
+        route: dict[str, Any] | None = None,
+    ) -> Any:
+        """Event-loop counterpart of `call`; the losing attempt's task is cancelled."""
+        primary = self.pick()
+        with self._lock:
+            self._routed += 1
+        delay = self.hedge_delay_sec(primary, timeout_sec)
+        if delay is None:
+            try:
+                result, elapsed_sec = await self._run_async(primary, attempt, timeout_sec)
+            except BaseException:
+                self._settle([(primary, "primary")], "none", 0.0, route)
+                raise
+            self._settle([(primary, "primary")], "primary", elapsed_sec, route)
+            return result
+
+        attempts = [(primary, "primary")]
+        tasks = {asyncio.ensure_future(self._run_async(primary, attempt, timeout_sec)): "primary"}
+        try:
+            done, pending = await asyncio.wait(set(tasks), timeout=delay)
+            if not done:
+                hedge = self.pick(exclude=primary)
+                with self._lock:
+                    self._hedged += 1
+                attempts.append((hedge, "hedge"))
+                tasks[asyncio.ensure_future(self._run_async(hedge, attempt, timeout_sec - delay))] = "hedge"
+                pending = set(tasks)
+            error: BaseException | None = None
+            while True:
+                for task in done:
+                    if task.exception() is None:
+                        result, elapsed_sec = task.result()
+                        self._settle(attempts, tasks[task], elapsed_sec, route)
+                        return result
+                    error = task.exception()
+                if not pending:
+                    break
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            self._settle(attempts, "none", 0.0, route)
+            raise error or TimeoutError("Hedged upstream call timed out")
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def stats(self) -> dict[str, Any]:
+        now = time.monotonic()
+        with self._lock:
+            endpoints = [
+                {
+                    "name": e.name,
+                    "base_url": e.base_url,
+                    "model": e.model,
+                    "weight": e.weight,
+                    "healthy": e.error_score < self.config.router_max_error_score or now >= e.retry_at,
+                    "ewma_latency_ms": round(e.ewma_latency_ms, 1) if e.ewma_latency_ms is not None else None,
+                    "error_score": round(e.error_score, 3),
+                    "calls": e.calls,
+                    "errors": e.errors,
+                    "cancelled": e.cancelled,
+                    "hedge_wins": e.hedge_wins,
+                }
+                for e in self.endpoints
+            ]
+            out: dict[str, Any] = {
+                "hedge_enabled": self.config.hedge_enabled,
+                "routed": self._routed,
+                "hedged": self._hedged,
+            }
+        for entry, endpoint in zip(endpoints, self.endpoints):
+            entry["latency_ms"] = endpoint.latency.percentiles()
+        out["endpoints"] = endpoints
+        return out
+
+    def _run(
+        self,
+        endpoint: UpstreamEndpoint,
+        attempt: Callable[[UpstreamEndpoint, float, UpstreamCancel], Any],
+        timeout_sec: float,
+        cancel: UpstreamCancel,
+    ) -> tuple[Any, float]:
+        started = time.monotonic()
+        try:
+            result = attempt(endpoint, timeout_sec, cancel)
+        except BaseException:
+            self.record(endpoint, time.monotonic() - started, "cancelled" if cancel.cancelled else "error")
+            raise
+        elapsed_sec = time.monotonic() - started
+        self.record(endpoint, elapsed_sec, "ok")
+        return result, elapsed_sec
+
+    async def _run_async(
+        self,
+        endpoint: UpstreamEndpoint,
+        attempt: Callable[[UpstreamEndpoint, float], Any],
+        timeout_sec: float,
+    ) -> tuple[Any, float]:
+        started = time.monotonic()
+        try:
+            result = await attempt(endpoint, timeout_sec)
+        except asyncio.CancelledError:
+            self.record(endpoint, time.monotonic() - started, "cancelled")
+            raise
+        except BaseException:
+            self.record(endpoint, time.monotonic() - started, "error")
+            raise
+        elapsed_sec = time.monotonic() - started
+        self.record(endpoint, elapsed_sec, "ok")
+        return result, elapsed_sec
+
+    def _spawn(
+        self,
+        endpoint: UpstreamEndpoint,
+        attempt: Callable[[UpstreamEndpoint, float, UpstreamCancel], Any],
+        timeout_sec: float,
+        cancel: UpstreamCancel,
+        label: str,
+        done: queue.Queue,
+    ) -> None:
+        def run() -> None:
+            try:
+                result, elapsed_sec = self._run(endpoint, attempt, timeout_sec, cancel)
+            except Exception as exc:
+                done.put((label, None, exc, 0.0))
+            else:
+                done.put((label, result, None, elapsed_sec))
+
+        context = contextvars.copy_context()
+        threading.Thread(target=context.run, args=(run,), name=f"upstream-{label}", daemon=True).start()
+
+    def _settle(
+        self,
+        attempts: list[tuple[UpstreamEndpoint, str]],
+        winner: str,
+        elapsed_sec: float,
+        route: dict[str, Any] | None,
+    ) -> None:
+        """Counts the hedge outcome and records the endpoint choice for the shadow log."""
+        by_label = {label: endpoint for endpoint, label in attempts}
+        hedged = len(attempts) > 1
+        if hedged:
+            METRICS.hedges.inc(winner)
+            if winner == "hedge":
+                with self._lock:
+                    by_label["hedge"].hedge_wins += 1
+        if route is None:
+            return
+        route["endpoint"] = by_label.get(winner, by_label["primary"]).name
+        route["ok"] = winner in by_label
+        if winner in by_label:
+            route["latency_ms"] = round(elapsed_sec * 1000, 1)
+        if hedged:
+            route["hedged"] = {"primary": by_label["primary"].name, "hedge": by_label["hedge"].name, "winner": winner}
+
+
+class AsyncUpstreamClient:
+    """Minimal non-blocking HTTP/1.1 client with per-base-URL keep-alive connections (event loop only)."""
+
+    def __init__(self, config: Config):
+        self.config = config
+        self._ssl_context = ssl.create_default_context()
+        self._idle: dict[str, list[tuple[asyncio.StreamReader, asyncio.StreamWriter, float]]] = {}
+        self._in_use = 0
+        self._created = 0
+        self._reused = 0
+        self._stale_retries = 0
+
+    async def request(
+        self,
+        base_url: str,
+        method: str,
+        path: str,
+        body: bytes,
+        headers: dict[str, str],
+        timeout_sec: float,
+    ) -> tuple[int, str, bytes]:
+        try:
+            return await asyncio.wait_for(self._request(base_url, method, path, body, headers), timeout_sec)
+        except asyncio.TimeoutError:
+            raise TimeoutError("timed out") from None
+
+    async def stream(
+        self,
+        base_url: str,
+        method: str,
+        path: str,
+        body: bytes,
+        headers: dict[str, str],
+        timeout_sec: float,
+    ) -> AsyncIterator[bytes]:
+        """Yields response body chunks as they arrive; `timeout_sec` bounds the whole exchange."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_sec
+        try:
+            reader, writer, status, reason, resp_headers, reusable = await asyncio.wait_for(
+                self._open(base_url, method, path, body, headers), timeout_sec
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError("timed out") from None
+        completed = False
+        try:
+            if status >= 400:
+                raise RuntimeError(f"HTTP Error {status}: {reason}")
+            chunks = self._iter_body(reader, resp_headers)
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise TimeoutError("timed out")
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), remaining)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise TimeoutError("timed out") from None
+                yield chunk
+            completed = True
+        finally:
+            self._finish(base_url, reader, writer, reusable=completed and reusable)
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "idle": sum(len(conns) for conns in self._idle.values()),
+            "in_use": self._in_use,
+            "created": self._created,
+            "reused": self._reused,
+            "stale_retries": self._stale_retries,
+        }
+
+    async def _request(
+        self,
+        base_url: str,
+        method: str,
+        path: str,
+        body: bytes,
+        headers: dict[str, str],
+    ) -> tuple[int, str, bytes]:
+        reader, writer, status, reason, resp_headers, reusable = await self._open(base_url, method, path, body, headers)
+        completed = False
+        try:
+            data = b"".join([chunk async for chunk in self._iter_body(reader, resp_headers)])
+            completed = True
+        finally:
+            self._finish(base_url, reader, writer, reusable=completed and reusable)
+        return status, reason, data
+
+    async def _open(
+        self,
+        base_url: str,
+        method: str,
+        path: str,
+        body: bytes,
+        headers: dict[str, str],
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, int, str, dict[str, str], bool]:
+        """Sends the request and reads the response head, retrying once if a reused connection was closed."""
+        parts = urlsplit(base_url)
+        if parts.scheme not in {"http", "https"} or not parts.hostname:
+            raise ValueError(f"Unsupported upstream base URL: {base_url}")
+        host = parts.hostname
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        head = [f"{method} {parts.path.rstrip('/')}{path} HTTP/1.1", f"Host: {parts.netloc}"]
+        head.extend(f"{name}: {value}" for name, value in headers.items())
+        head.append(f"Content-Length: {len(body)}")
+        request_bytes = ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+        for attempt in range(2):
+            reader, writer, reused = await self._acquire(base_url, parts.scheme, host, port)
+            self._in_use += 1
+            try:
+                writer.write(request_bytes)
+                await writer.drain()
+                status, reason, resp_headers, reusable = await self._read_head(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._finish(base_url, reader, writer, reusable=False)
+                if reused and attempt == 0:
+                    self._stale_retries += 1
+                    continue
+                raise
+            except BaseException:
+                self._finish(base_url, reader, writer, reusable=False)
+                raise
+            return reader, writer, status, reason, resp_headers, reusable
+        raise RuntimeError("unreachable")
+
+    async def _acquire(
+        self, base_url: str, scheme: str, host: str, port: int
+    ) -> tuple[asyncio.StreamReader, asyncio.StreamWriter, bool]:
+        idle = self._idle.get(base_url, [])
+        now = time.monotonic()
+        while idle:
+            reader, writer, last_used = idle.pop()
+            if now - last_used > self.config.upstream_pool_idle_timeout_sec or reader.at_eof():
+                writer.close()
+                continue
+            self._reused += 1
+            return reader, writer, True
+        reader, writer = await asyncio.open_connection(
+            host,
+            port,
+            ssl=self._ssl_context if scheme == "https" else None,
+        )
+        self._created += 1
+        return reader, writer, False
+
+    def _finish(
+        self, base_url: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, reusable: bool
+    ) -> None:
+        self._in_use -= 1
+        idle = self._idle.setdefault(base_url, [])
+        if reusable and len(idle) < self.config.upstream_pool_max_idle:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+
+    async def _read_head(self, reader: asyncio.StreamReader) -> tuple[int, str, dict[str, str], bool]:
+        status_line = (await reader.readuntil(b"\r\n")).decode("latin-1").rstrip("\r\n")
+        if not status_line:
+            raise ConnectionResetError("Upstream closed connection")
+        parts = status_line.split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise RuntimeError(f"Malformed upstream status line: {status_line[:80]}")
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ""
+        headers: dict[str, str] = {}
+        while True:
+            line = (await reader.readuntil(b"\r\n")).decode("latin-1").rstrip("\r\n")
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        framed = headers.get("transfer-encoding", "").lower() == "chunked" or "content-length" in headers
+        reusable = framed and headers.get("connection", "").lower() != "close" and parts[0] != "HTTP/1.0"
+        return status, reason, headers, reusable
+
+    async def _iter_body(self, reader: asyncio.StreamReader, headers: dict[str, str]) -> AsyncIterator[bytes]:
+        if headers.get("transfer-encoding", "").lower() == "chunked":
+            while True:
+                size_line = (await reader.readuntil(b"\r\n")).split(b";", 1)[0].strip()
+                size = int(size_line, 16)
+                if size == 0:
+                    while (await reader.readuntil(b"\r\n")) != b"\r\n":
+                        pass
+                    return
+                yield await reader.readexactly(size)
+                await reader.readexactly(2)
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"])
+            while remaining > 0:
+                chunk = await reader.read(min(remaining, 65536))
+                if not chunk:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(chunk)
+                yield chunk
+        else:
+            while True:
+                chunk = await reader.read(65536)
+                if not chunk:
+                    return
+                yield chunk
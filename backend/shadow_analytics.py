@@ -0,0 +1,409 @@
+"""Shadow log analytics and columnar compaction.
+
+Reads shadow logs (plain or gzip-rotated JSONL) in a single streaming pass with memory bounded by
+the number of distinct values, and reports latency percentiles, fallback rates by error class,
+row counts by mode/source and overlap distributions by reply_type and intent:
+
+    python backend/shadow_analytics.py summary backend/shadow_logs.jsonl --with-rotated
+
+`compact` turns logs into a columnar directory (one little-endian array file per column plus
+meta.json; text columns are dictionary-encoded) that can be memory-mapped, so repeated summaries
+over months of logs only touch a few small arrays:
+
+    python backend/shadow_analytics.py compact backend/shadow_logs.jsonl --with-rotated --out shadow_columns
+    python backend/shadow_analytics.py summary --columnar shadow_columns
+
+NumPy is used for columnar summaries when installed; the pure-Python path gives identical output.
+"""
+
+import argparse
+import calendar
+import gzip
+import json
+import math
+import mmap
+import sys
+import time
+from array import array
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Any, Iterable, Iterator
+
+try:
+    import numpy as np
+except ImportError:  # optional: only speeds up columnar summaries
+    np = None
+
+FORMAT_VERSION = 1
+CHUNK_ROWS = 65536
+MISSING = -1
+
+# name -> (array typecode, numpy dtype); "category" columns store uint16 dictionary codes.
+NUMERIC_COLUMNS = {"ts": ("q", "<i8"), "latency_ms": ("i", "<i4"), "overlap_count": ("i", "<i4")}
+CATEGORY_COLUMNS = ("mode", "primary_source", "error_class", "reply_type", "intent", "cache")
+CATEGORY_TYPECODE = ("H", "<u2")
+MODEL_SOURCES = {"openai", "rules_fallback", "rules_deadline"}
+
+
+def error_class(message: str) -> str:
+    """Low-cardinality class for a shadow-log `error` string."""
+    text = message.lower()
+    if not text:
+        return "none"
+    if "circuit" in text:
+        return "circuit_open"
+    if "rate limited" in text:
+        return "rate_limited"
+    if "timed out" in text or "timeout" in text:
+        return "timeout"
+    if text.startswith("http error 5"):
+        return "upstream_5xx"
+    if text.startswith("http error 4"):
+        return "upstream_4xx"
+    if "openai_api_key" in text:
+        return "missing_key"
+    if "disconnected" in text:
+        return "client_disconnected"
+    if "connection" in text or "errno" in text or "closed" in text:
+        return "connection"
+    if "model" in text or "json" in text or "parse" in text or "content" in text:
+        return "invalid_output"
+    return "other"
+
+
+def parse_timestamp(value: Any) -> int:
+    try:
+        return calendar.timegm(time.strptime(str(value), "%Y-%m-%dT%H:%M:%SZ"))
+    except ValueError:
+        return MISSING
+
+
+def format_timestamp(value: int) -> str | None:
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(value)) if value != MISSING else None
+
+
+def flatten_row(raw: dict[str, Any]) -> dict[str, Any]:
+    """The subset of a shadow-log row used by summaries and stored by compaction."""
+    context = raw.get("context_summary") if isinstance(raw.get("context_summary"), dict) else {}
+    meta = raw.get("request_meta") if isinstance(raw.get("request_meta"), dict) else {}
+    latency = raw.get("latency_ms")
+    overlap = raw.get("overlap_count")
+    return {
+        "ts": parse_timestamp(raw.get("timestamp")),
+        "latency_ms": int(latency) if isinstance(latency, (int, float)) else MISSING,
+        "overlap_count": int(overlap) if isinstance(overlap, (int, float)) else MISSING,
+        "mode": str(raw.get("mode") or ""),
+        "primary_source": str(raw.get("primary_source") or ""),
+        "error_class": error_class(str(raw.get("error") or "")),
+        "reply_type": str(context.get("reply_type") or ""),
+        "intent": str(context.get("intent") or ""),
+        "cache": str(meta.get("cache") or ""),
+    }
+
+
+def expand_inputs(paths: list[str], with_rotated: bool) -> list[Path]:
+    """Rotated files (`<log>.<UTC stamp>[.gz]`) sort before the live log they were cut from."""
+    out: list[Path] = []
+    for raw in paths:
+        path = Path(raw)
+        if with_rotated:
+            out.extend(sorted(p for p in path.parent.glob(path.name + ".*") if p.is_file()))
+        if path.exists():
+            out.append(path)
+    return out
+
+
+def iter_rows(paths: Iterable[Path]) -> Iterator[dict[str, Any]]:
+    for path in paths:
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rt", encoding="utf-8", errors="replace") as handle:
+            for line in handle:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    raw = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(raw, dict):
+                    yield flatten_row(raw)
+
+
+def nearest_rank(ordered: Any, count: int, q: float) -> float:
+    return float(ordered[min(count - 1, int(math.ceil(q * count)) - 1)])
+
+
+def counter_percentile(counts: Counter, total: int, q: float) -> float:
+    rank = min(total, max(1, int(math.ceil(q * total))))
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen >= rank:
+            return float(value)
+    return float(max(counts))
+
+
+class Summary:
+    """Streaming aggregates; memory grows with distinct values, not rows."""
+
+    def __init__(self) -> None:
+        self.rows = 0
+        self.first_ts = MISSING
+        self.last_ts = MISSING
+        self.modes: Counter = Counter()
+        self.sources: Counter = Counter()
+        self.latency: Counter = Counter()
+        self.model_rows = 0
+        self.fallback_errors: Counter = Counter()
+        self.overlap: dict[str, Counter] = defaultdict(Counter)
+
+    def add(self, row: dict[str, Any]) -> None:
+        self.rows += 1
+        ts = row["ts"]
+        if ts != MISSING:
+            self.first_ts = ts if self.first_ts == MISSING else min(self.first_ts, ts)
+            self.last_ts = max(self.last_ts, ts)
+        self.modes[row["mode"]] += 1
+        if row["primary_source"]:
+            self.sources[row["primary_source"]] += 1
+        if row["latency_ms"] != MISSING:
+            self.latency[row["latency_ms"]] += 1
+        if row["primary_source"] in MODEL_SOURCES:
+            self.model_rows += 1
+            if row["primary_source"] == "rules_fallback":
+                self.fallback_errors[row["error_class"]] += 1
+        if row["overlap_count"] != MISSING and row["mode"] in {"shadow_rules_baseline", "shadow_openai_compare"}:
+            self.overlap[f"{row['reply_type'] or '-'}/{row['intent'] or '-'}"][row["overlap_count"]] += 1
+
+    def report(self) -> dict[str, Any]:
+        latency_total = sum(self.latency.values())
+        latency: dict[str, Any] = {"count": latency_total}
+        if latency_total:
+            latency.update(
+                {
+                    "p50": counter_percentile(self.latency, latency_total, 0.50),
+                    "p95": counter_percentile(self.latency, latency_total, 0.95),
+                    "p99": counter_percentile(self.latency, latency_total, 0.99),
+                    "max": float(max(self.latency)),
+                    "mean": round(sum(v * c for v, c in self.latency.items()) / latency_total, 2),
+                }
+            )
+        fallbacks = sum(self.fallback_errors.values())
+        overlap: dict[str, Any] = {}
+        for key in sorted(self.overlap):
+            counts = self.overlap[key]
+            total = sum(counts.values())
+            overlap[key] = {
+                "rows": total,
+                "mean": round(sum(v * c for v, c in counts.items()) / total, 3),
+                "distribution": {str(v): counts[v] for v in sorted(counts)},
+            }
+        return {
+            "rows": self.rows,
+            "first_timestamp": format_timestamp(self.first_ts),
+            "last_timestamp": format_timestamp(self.last_ts),
+            "modes": dict(sorted(self.modes.items())),
+            "sources": dict(sorted(self.sources.items())),
+            "latency_ms": latency,
+            "fallback": {
+                "model_rows": self.model_rows,
+                "fallbacks": fallbacks,
+                "rate": round(fallbacks / self.model_rows, 4) if self.model_rows else None,
+                "by_error_class": dict(self.fallback_errors.most_common()),
+            },
+            "overlap_by_reply_type_intent": overlap,
+        }
+
+
+class ColumnarWriter:
+    """Appends rows to a columnar directory in fixed-size chunks."""
+
+    def __init__(self, out_dir: Path):
+        self.out_dir = out_dir
+        out_dir.mkdir(parents=True, exist_ok=True)
+        meta = read_meta(out_dir) if (out_dir / "meta.json").exists() else None
+        self.rows = meta["rows"] if meta else 0
+        self.dictionaries: dict[str, dict[str, int]] = {
+            name: {value: code for code, value in enumerate(meta["columns"][name]["values"])} if meta else {}
+            for name in CATEGORY_COLUMNS
+        }
+        self._buffers = self._new_buffers()
+
+    def add(self, row: dict[str, Any]) -> None:
+        for name in NUMERIC_COLUMNS:
+            self._buffers[name].append(row[name])
+        for name in CATEGORY_COLUMNS:
+            codes = self.dictionaries[name]
+            code = codes.get(row[name])
+            if code is None:
+                if len(codes) >= 65535:
+                    raise ValueError(f"Column {name} has too many distinct values for uint16 codes")
+                code = codes[row[name]] = len(codes)
+            self._buffers[name].append(code)
+        if len(self._buffers["ts"]) >= CHUNK_ROWS:
+            self.flush()
+
+    def flush(self) -> None:
+        count = len(self._buffers["ts"])
+        if not count:
+            return
+        for name, values in self._buffers.items():
+            if sys.byteorder != "little":
+                values.byteswap()
+            with open(self.out_dir / f"{name}.bin", "ab") as handle:
+                values.tofile(handle)
+        self.rows += count
+        self._buffers = self._new_buffers()
+
+    def close(self) -> None:
+        self.flush()
+        columns: dict[str, Any] = {name: {"dtype": dtype} for name, (_, dtype) in NUMERIC_COLUMNS.items()}
+        for name in CATEGORY_COLUMNS:
+            values = sorted(self.dictionaries[name], key=self.dictionaries[name].__getitem__)
+            columns[name] = {"dtype": CATEGORY_TYPECODE[1], "values": values}
+        meta = {"version": FORMAT_VERSION, "rows": self.rows, "missing": MISSING, "columns": columns}
+        tmp = self.out_dir / "meta.json.tmp"
+        tmp.write_text(json.dumps(meta, ensure_ascii=False, indent=2), encoding="utf-8")
+        tmp.replace(self.out_dir / "meta.json")
+
+    def _new_buffers(self) -> dict[str, array]:
+        buffers = {name: array(typecode) for name, (typecode, _) in NUMERIC_COLUMNS.items()}
+        buffers.update({name: array(CATEGORY_TYPECODE[0]) for name in CATEGORY_COLUMNS})
+        return buffers
+
+
+def read_meta(columnar_dir: Path) -> dict[str, Any]:
+    meta = json.loads((columnar_dir / "meta.json").read_text(encoding="utf-8"))
+    if meta.get("version") != FORMAT_VERSION:
+        raise SystemExit(f"Unsupported columnar format version: {meta.get('version')}")
+    return meta
+
+
+def map_column(columnar_dir: Path, name: str, rows: int) -> Any:
+    """Memory-maps one column file (numpy array when available, else a memoryview)."""
+    path = columnar_dir / f"{name}.bin"
+    dtype = NUMERIC_COLUMNS[name][1] if name in NUMERIC_COLUMNS else CATEGORY_TYPECODE[1]
+    typecode = NUMERIC_COLUMNS[name][0] if name in NUMERIC_COLUMNS else CATEGORY_TYPECODE[0]
+    if rows == 0:
+        return np.zeros(0, dtype=dtype) if np is not None else memoryview(array(typecode))
+    if np is not None:
+        return np.memmap(path, dtype=dtype, mode="r", shape=(rows,))
+    if sys.byteorder != "little":
+        values = array(typecode, path.read_bytes()[: rows * array(typecode).itemsize])
+        values.byteswap()
+        return memoryview(values)
+    with open(path, "rb") as handle:
+        mapped = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    return memoryview(mapped).cast(typecode)[:rows]
+
+
+def summarize_columnar(columnar_dir: Path) -> dict[str, Any]:
+    meta = read_meta(columnar_dir)
+    rows = meta["rows"]
+    columns = {name: map_column(columnar_dir, name, rows) for name in (*NUMERIC_COLUMNS, *CATEGORY_COLUMNS)}
+    values = {name: meta["columns"][name]["values"] for name in CATEGORY_COLUMNS}
+    if np is None:
+        summary = Summary()
+        for index in range(rows):
+            row = {name: columns[name][index] for name in NUMERIC_COLUMNS}
+            row.update({name: values[name][columns[name][index]] for name in CATEGORY_COLUMNS})
+            summary.add(row)
+        return summary.report()
+    return _summarize_numpy(rows, columns, values)
+
+
+def _summarize_numpy(rows: int, columns: dict[str, Any], values: dict[str, list[str]]) -> dict[str, Any]:
+    """Vectorized equivalent of Summary over memory-mapped columns."""
+
+    def code_counts(name: str, mask: Any = None) -> dict[str, int]:
+        codes = columns[name] if mask is None else columns[name][mask]
+        counts = np.bincount(codes, minlength=len(values[name]))
+        return {values[name][code]: int(count) for code, count in enumerate(counts) if count}
+
+    def codes_for(name: str, wanted: set[str]) -> Any:
+        return np.array([code for code, value in enumerate(values[name]) if value in wanted], dtype=np.uint16)
+
+    summary = Summary()
+    summary.rows = rows
+    ts = columns["ts"][columns["ts"] != MISSING]
+    if ts.size:
+        summary.first_ts, summary.last_ts = int(ts.min()), int(ts.max())
+    summary.modes.update(code_counts("mode"))
+    summary.sources.update({k: v for k, v in code_counts("primary_source").items() if k})
+
+    latency = np.sort(columns["latency_ms"][columns["latency_ms"] != MISSING])
+    source_codes = columns["primary_source"]
+    model_mask = np.isin(source_codes, codes_for("primary_source", MODEL_SOURCES))
+    summary.model_rows = int(model_mask.sum())
+    fallback_mask = np.isin(source_codes, codes_for("primary_source", {"rules_fallback"}))
+    summary.fallback_errors.update(code_counts("error_class", fallback_mask))
+
+    overlap_mask = (columns["overlap_count"] != MISSING) & np.isin(
+        columns["mode"], codes_for("mode", {"shadow_rules_baseline", "shadow_openai_compare"})
+    )
+    if overlap_mask.any():
+        group_width = len(values["intent"])
+        groups = columns["reply_type"][overlap_mask].astype(np.int64) * group_width + columns["intent"][overlap_mask]
+        overlap = columns["overlap_count"][overlap_mask].astype(np.int64)
+        pairs, counts = np.unique(np.stack([groups, overlap]), axis=1, return_counts=True)
+        for (group, value), count in zip(pairs.T.tolist(), counts.tolist()):
+            reply_type = values["reply_type"][group // group_width] or "-"
+            intent = values["intent"][group % group_width] or "-"
+            summary.overlap[f"{reply_type}/{intent}"][value] += count
+
+    report = summary.report()
+    report["latency_ms"] = {"count": int(latency.size)}
+    if latency.size:
+        report["latency_ms"].update(
+            {
+                "p50": nearest_rank(latency, latency.size, 0.50),
+                "p95": nearest_rank(latency, latency.size, 0.95),
+                "p99": nearest_rank(latency, latency.size, 0.99),
+                "max": float(latency[-1]),
+                "mean": round(float(latency.mean()), 2),
+            }
+        )
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    summary_cmd = sub.add_parser("summary", help="aggregate JSONL logs or a columnar directory")
+    summary_cmd.add_argument("paths", nargs="*", help="shadow log files")
+    summary_cmd.add_argument("--with-rotated", action="store_true", help="include rotated siblings of each path")
+    summary_cmd.add_argument("--columnar", help="read a directory written by `compact` instead")
+
+    compact_cmd = sub.add_parser("compact", help="append JSONL logs to a columnar directory")
+    compact_cmd.add_argument("paths", nargs="+", help="shadow log files")
+    compact_cmd.add_argument("--with-rotated", action="store_true", help="include rotated siblings of each path")
+    compact_cmd.add_argument("--out", required=True, help="columnar directory (created or appended to)")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    if args.command == "compact":
+        inputs = expand_inputs(args.paths, args.with_rotated)
+        writer = ColumnarWriter(Path(args.out))
+        before = writer.rows
+        for row in iter_rows(inputs):
+            writer.add(row)
+        writer.close()
+        report: dict[str, Any] = {
+            "inputs": [str(p) for p in inputs],
+            "rows_added": writer.rows - before,
+            "rows": writer.rows,
+        }
+    elif args.columnar:
+        report = summarize_columnar(Path(args.columnar))
+    else:
+        summary = Summary()
+        for row in iter_rows(expand_inputs(args.paths, args.with_rotated)):
+            summary.add(row)
+        report = summary.report()
+    report["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,338 @@
+"""Checks for the in-process caches, single-flight and the prefetch and suggestion stores.
+
+    python -m pytest backend
+"""
+
+import os
+import tempfile
+import threading
+import time
+import unittest
+from typing import Any
+
+from reply_cache import NearDuplicateIndex, PrefetchStore, ResponseCache, SingleFlight, SuggestionStore
+from reply_config import Config
+
+
+def blocked_call(single_flight: SingleFlight, key: str, release: threading.Event, result: Any = "ok") -> Any:
+    def fn() -> Any:
+        release.wait(2.0)
+        return result
+
+    return single_flight.submit(key, fn, count_waiter=False)
+
+
+SUGGESTIONS = [{"text": "first"}, {"text": "second"}]
+
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.config = Config()
+        self.config.response_cache_enabled = True
+        self.config.response_cache_ttl_sec = 60.0
+        self.config.response_cache_max_entries = 2
+        self.config.response_cache_max_bytes = 1024 * 1024
+        self.cache = ResponseCache(self.config)
+
+    def test_hit_returns_a_copy(self) -> None:
+        self.cache.put("a", SUGGESTIONS)
+        hit = self.cache.get("a") or []
+        self.assertEqual(hit, SUGGESTIONS)
+        hit[0]["text"] = "changed"
+        self.assertEqual(self.cache.get("a"), SUGGESTIONS)
+        self.assertIsNone(self.cache.get("b"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (2, 1))
+
+    def test_expired_entry_is_a_miss(self) -> None:
+        self.config.response_cache_ttl_sec = 0.05
+        self.cache.put("a", SUGGESTIONS)
+        self.assertTrue(self.cache.contains("a"))
+        time.sleep(0.1)
+        self.assertFalse(self.cache.contains("a"))
+        self.assertIsNone(self.cache.get("a"))
+        stats = self.cache.stats()
+        self.assertEqual((stats["entries"], stats["bytes"], stats["expirations"]), (0, 0, 1))
+
+    def test_least_recently_used_entry_is_evicted(self) -> None:
+        self.cache.put("a", SUGGESTIONS)
+        self.cache.put("b", SUGGESTIONS)
+        self.cache.get("a")
+        self.cache.put("c", SUGGESTIONS)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertIsNotNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("c"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_byte_budget_evicts_and_skips_oversized_values(self) -> None:
+        self.config.response_cache_max_entries = 100
+        self.cache.put("a", SUGGESTIONS)
+        entry_bytes = self.cache.stats()["bytes"]
+        self.config.response_cache_max_bytes = entry_bytes * 2
+        self.cache.put("b", SUGGESTIONS)
+        self.cache.put("c", SUGGESTIONS)
+        self.assertEqual((self.cache.stats()["entries"], self.cache.contains("a")), (2, False))
+        self.cache.put("big", [{"text": "x" * entry_bytes * 2}])
+        self.assertFalse(self.cache.contains("big"))
+
+
+POST_TEXT = "Just watched the sunrise over the harbor after a long night shift, totally worth staying up for it"
+
+
+def comment_payload(primary_text: str, tone_bias: str = "funny", reply_type: str = "comment") -> dict[str, Any]:
+    return {
+        "context": {"reply_type": reply_type, "primary_text": primary_text, "intent": "joking"},
+        "controls": {"tone_bias": tone_bias, "length": "short"},
+        "desired_count": 2,
+    }
+
+
+class NearDuplicateIndexTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.config = Config()
+        self.config.near_dup_enabled = True
+        self.config.near_dup_threshold = 0.85
+        self.index = NearDuplicateIndex(self.config)
+        self.index.add(comment_payload(POST_TEXT), SUGGESTIONS)
+
+    def test_normalized_repost_is_reused(self) -> None:
+        output, score = self.index.lookup(comment_payload(f"@someone {POST_TEXT.upper()}   #sunrise"))
+        self.assertEqual((output, score), (SUGGESTIONS, 1.0))
+        self.assertEqual(self.index.stats()["reuses"], 1)
+
+    def test_similarity_must_reach_threshold(self) -> None:
+        edited = comment_payload(POST_TEXT.replace("long night shift", "double night shift"))
+        _, score = self.index.lookup(edited)
+        self.assertTrue(0.0 < score < 1.0)
+        self.config.near_dup_threshold = score
+        self.assertEqual(self.index.lookup(edited), (SUGGESTIONS, score))
+        self.config.near_dup_threshold = score + 0.01
+        self.assertEqual(self.index.lookup(edited), (None, score))
+        self.assertGreaterEqual(self.index.stats()["below_threshold"], 1)
+
+    def test_unrelated_text_and_other_variants_miss(self) -> None:
+        self.assertIsNone(self.index.lookup(comment_payload("Quarterly earnings beat every analyst estimate"))[0])
+        self.assertEqual(self.index.lookup(comment_payload(POST_TEXT, tone_bias="serious")), (None, 0.0))
+
+    def test_only_comment_replies_apply(self) -> None:
+        self.assertTrue(self.index.applies_to(comment_payload(POST_TEXT)))
+        self.assertFalse(self.index.applies_to(comment_payload(POST_TEXT, reply_type="chat")))
+
+    def test_newer_add_replaces_same_text(self) -> None:
+        newer = [{"text": "newer"}]
+        self.index.add(comment_payload(POST_TEXT.lower()), newer)
+        self.assertEqual(self.index.lookup(comment_payload(POST_TEXT))[0], newer)
+        stats = self.index.stats()
+        self.assertEqual((stats["entries"], stats["replaced"]), (1, 1))
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.config = Config()
+        self.config.single_flight_enabled = True
+        self.single_flight = SingleFlight(self.config)
+        self.release = threading.Event()
+        self.calls = 0
+        self.results: dict[str, Any] = {}
+        self.threads: list[threading.Thread] = []
+
+    def fn(self) -> str:
+        self.calls += 1
+        self.release.wait(2.0)
+        return f"call {self.calls}"
+
+    def fail(self) -> str:
+        self.release.wait(2.0)
+        raise TimeoutError("upstream timed out")
+
+    def start(self, name: str, fn: Any, **kwargs: Any) -> None:
+        """Runs `do` on a thread; its result or error lands in `self.results[name]`."""
+
+        def run() -> None:
+            try:
+                self.results[name] = self.single_flight.do("key", fn, 2.0, **kwargs)
+            except Exception as exc:
+                self.results[name] = exc
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        time.sleep(0.02)
+
+    def finish(self) -> None:
+        self.release.set()
+        for thread in self.threads:
+            thread.join(2.0)
+
+    def test_waiters_share_one_call(self) -> None:
+        for name in ("leader", "first", "second"):
+            self.start(name, self.fn)
+        self.assertEqual(self.single_flight.waiters("key"), 2)
+        self.finish()
+        self.assertEqual(set(self.results.values()), {("call 1", 2)})
+        self.assertEqual(self.single_flight.waiters("key"), 0)
+        stats = self.single_flight.stats()
+        self.assertEqual((stats["leaders"], stats["coalesced"], stats["in_flight"]), (1, 2, 0))
+
+    def test_leader_error_reaches_every_waiter(self) -> None:
+        self.start("leader", self.fail)
+        self.start("waiter", self.fn)
+        self.finish()
+        self.assertIsInstance(self.results["leader"], TimeoutError)
+        self.assertIs(self.results["waiter"], self.results["leader"])
+        self.assertEqual(self.calls, 0)
+
+    def test_waiter_leads_again_after_leader_only_error(self) -> None:
+        self.start("leader", self.fail)
+        self.start("waiter", self.fn, rejoin_on=(TimeoutError,))
+        self.finish()
+        self.assertIsInstance(self.results["leader"], TimeoutError)
+        self.assertEqual(self.results["waiter"], ("call 1", 0))
+        self.assertEqual(self.single_flight.stats()["rejoined"], 1)
+
+    def test_disabled_runs_every_call(self) -> None:
+        self.config.single_flight_enabled = False
+        self.release.set()
+        self.assertEqual([self.single_flight.do("key", self.fn, 2.0) for _ in range(2)], [("call 1", 0), ("call 2", 0)])
+
+
+class PrefetchStoreTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.config = Config()
+        self.config.prefetch_ttl_sec = 60.0
+        self.config.prefetch_max_entries = 2
+        self.store = PrefetchStore(self.config)
+        self.single_flight = SingleFlight(self.config)
+        self.release = threading.Event()
+
+    def tearDown(self) -> None:
+        self.release.set()
+
+    def test_claim_by_token_or_key(self) -> None:
+        call = blocked_call(self.single_flight, "a", self.release)
+        token = self.store.add("a", call)
+        self.assertEqual(self.store.find("a"), token)
+        self.assertEqual(self.store.claim(token, "a"), (call, "pending"))
+        # A token for other inputs falls back to the key, and an unknown token is a miss.
+        self.assertIsNone(self.store.claim(token, "b"))
+        self.assertEqual(self.store.claim("", "a"), (call, "pending"))
+        self.assertIsNone(self.store.claim("unknown", "b"))
+        self.release.set()
+        self.assertTrue(call.done.wait(2.0))
+        self.assertEqual(self.store.claim(token, "a"), (call, "ready"))
+        stats = self.store.stats()
+        self.assertEqual((stats["pending"], stats["ready"], stats["miss"]), (2, 1, 2))
+
+    def test_first_claim_takes_over_the_entry_waiter(self) -> None:
+        call = blocked_call(self.single_flight, "a", self.release)
+        token = self.store.add("a", call)
+        self.assertEqual(call.waiters, 1)
+        self.store.claim(token, "a")
+        self.assertEqual(call.waiters, 1)
+        self.store.claim(token, "a")
+        self.assertEqual(call.waiters, 2)
+
+    def test_hit_rate_counts_each_entry_once(self) -> None:
+        used = self.store.add("a", blocked_call(self.single_flight, "a", self.release))
+        self.store.add("b", blocked_call(self.single_flight, "b", self.release))
+        for _ in range(3):
+            self.store.claim(used, "a")
+        stats = self.store.stats()
+        self.assertEqual((stats["started"], stats["used"], stats["pending"]), (2, 1, 3))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_expired_entry_is_dropped(self) -> None:
+        self.config.prefetch_ttl_sec = 0.05
+        call = blocked_call(self.single_flight, "a", self.release)
+        token = self.store.add("a", call)
+        time.sleep(0.1)
+        self.assertIsNone(self.store.claim(token, "a"))
+        self.assertEqual(call.waiters, 0)
+        stats = self.store.stats()
+        self.assertEqual((stats["entries"], stats["expired"], stats["miss"]), (0, 1, 1))
+
+    def test_oldest_entry_is_evicted_when_full(self) -> None:
+        tokens = [self.store.add(key, blocked_call(self.single_flight, key, self.release)) for key in "abc"]
+        self.assertIsNone(self.store.claim(tokens[0], "a"))
+        self.assertIsNotNone(self.store.claim(tokens[2], "c"))
+        stats = self.store.stats()
+        self.assertEqual((stats["entries"], stats["evicted"], stats["wasted_rate"]), (2, 1, round(1 / 3, 3)))
+
+    def test_failed_prefetch_is_dropped(self) -> None:
+        def fail() -> Any:
+            raise RuntimeError("upstream down")
+
+        call = self.single_flight.submit("a", fail, count_waiter=False)
+        token = self.store.add("a", call)
+        self.assertTrue(call.done.wait(2.0))
+        self.assertIsNone(self.store.claim(token, "a"))
+        self.assertIsNone(self.store.find("a"))
+        self.assertEqual(self.store.stats()["failed"], 1)
+
+
+
+class SuggestionStoreTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.tmp = tempfile.TemporaryDirectory(prefix="test_cache_")
+        self.path = os.path.join(self.tmp.name, "suggestions.sqlite3")
+
+    def tearDown(self) -> None:
+        self.tmp.cleanup()
+
+    def store(self, model_key: str = "model-a@v1", max_entries: int = 100) -> SuggestionStore:
+        config = Config()
+        config.persistent_cache_enabled = True
+        config.persistent_cache_path = self.path
+        config.persistent_cache_max_entries = max_entries
+        store = SuggestionStore(config)
+        store.model_key = model_key
+        return store
+
+    def wait_for_compaction(self, store: SuggestionStore) -> dict[str, Any]:
+        deadline = time.monotonic() + 5.0
+        while store.stats()["compactions"] == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return store.stats()
+
+    def test_entries_survive_a_restart(self) -> None:
+        first = self.store()
+        first.put("a", SUGGESTIONS)
+        first.flush()
+        restarted = self.store()
+        self.assertEqual(restarted.get("a"), SUGGESTIONS)
+        self.assertIsNone(restarted.get("b"))
+        cache = ResponseCache(restarted.config)
+        self.assertEqual(restarted.warm(cache), 1)
+        self.assertEqual(cache.get("a"), SUGGESTIONS)
+
+    def test_other_model_key_starts_cold_and_is_evicted_first(self) -> None:
+        old = self.store("model-a@v1")
+        for key in ("a", "b", "c"):
+            old.put(key, SUGGESTIONS)
+        old.flush()
+        current = self.store("model-b@v2", max_entries=2)
+        self.assertIsNone(current.get("a"))
+        current.put("a", SUGGESTIONS)
+        current.flush()
+        stats = self.wait_for_compaction(current)
+        self.assertEqual((stats["entries"], stats["compacted"]), (2, 2))
+        self.assertEqual(current.get("a"), SUGGESTIONS)
+        self.assertEqual(sum(self.store("model-a@v1").get(key) is not None for key in "abc"), 1)
+
+    def test_unreadable_file_degrades_to_miss(self) -> None:
+        with open(self.path, "wb") as file:
+            file.write(b"not a sqlite database" * 100)
+        store = self.store()
+        self.assertIsNone(store.get("a"))
+        store.put("a", SUGGESTIONS)
+        store.flush()
+        stats = store.stats()
+        self.assertEqual((stats["misses"], stats["hits"], stats["paused"]), (1, 0, True))
+        self.assertGreaterEqual(stats["errors"], 1)
+        # While paused the store does not touch the file again.
+        self.assertIsNone(store.get("a"))
+        self.assertEqual(store.stats()["errors"], stats["errors"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+"""End-to-end checks of requests coalesced onto one upstream call (single-flight) against the mock upstream.
+
+    python -m pytest backend
+"""
+
+import http.client
+import json
+import tempfile
+import threading
+import time
+import unittest
+from typing import Any
+
+from mock_openai import MockSettings, start_mock_server
+from test_streaming import free_port, start_backend
+
+
+def suggestions_payload(primary_text: str, reply_type: str = "chat") -> dict[str, Any]:
+    return {
+        "context": {"reply_type": reply_type, "primary_text": primary_text, "intent": "joking"},
+        "controls": {"tone_bias": "funny", "length": "short"},
+        "desired_count": 3,
+    }
+
+
+class CoalescedCallTest(unittest.TestCase):
+    server_mode = "threading"
+    backend_port = 0
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.settings = MockSettings(latency="fixed", latency_ms=400.0, seed=1)
+        cls.mock = start_mock_server("127.0.0.1", 0, cls.settings)
+        cls.log_dir = tempfile.TemporaryDirectory(prefix="test_coalescing_")
+        cls.backend_port = free_port()
+        # One model call at a time, so later leaders queue for a slot.
+        cls.backend = start_backend(
+            cls.backend_port,
+            cls.mock.server_address[1],
+            cls.log_dir.name,
+            SERVER_MODE=cls.server_mode,
+            MODEL_MAX_CONCURRENCY="1",
+            ASYNC_MAX_CONCURRENCY="1",
+        )
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.backend.terminate()
+        cls.backend.wait(timeout=10)
+        cls.mock.shutdown()
+        cls.mock.server_close()
+        cls.log_dir.cleanup()
+
+    def setUp(self) -> None:
+        self.settings.latency_ms = 400.0
+        self.responses: dict[str, tuple[int, dict[str, str], dict[str, Any]]] = {}
+        self.threads: list[threading.Thread] = []
+
+    def post(self, name: str, install_id: str, payload: dict[str, Any], headers: dict[str, str] | None = None) -> None:
+        """Sends the request on a background thread; the response lands in `self.responses[name]`."""
+
+        def send() -> None:
+            conn = http.client.HTTPConnection("127.0.0.1", self.backend_port, timeout=10)
+            conn.request(
+                "POST",
+                "/v1/reply-suggestions",
+                body=json.dumps(payload),
+                headers={"Content-Type": "application/json", "X-Install-Id": install_id, **(headers or {})},
+            )
+            resp = conn.getresponse()
+            self.responses[name] = (resp.status, dict(resp.getheaders()), json.loads(resp.read()))
+            conn.close()
+
+        thread = threading.Thread(target=send)
+        thread.start()
+        self.threads.append(thread)
+        time.sleep(0.1)
+
+    def join(self) -> None:
+        for thread in self.threads:
+            thread.join(10)
+
+    def test_superseded_leader_keeps_shared_call_for_follower(self) -> None:
+        shared = suggestions_payload(f"{self.server_mode} shared by two installs")
+        self.post("busy", "install-c", suggestions_payload(f"{self.server_mode} holds the only slot", "comment"))
+        self.post("leader", "install-a", shared)
+        self.post("follower", "install-b", shared)
+        # install-a moves on while its first request still waits for a slot.
+        self.post("newer", "install-a", suggestions_payload(f"{self.server_mode} newer chat text"))
+        self.join()
+        status, headers, body = self.responses["follower"]
+        self.assertEqual(status, 200)
+        self.assertEqual(body["source"], "openai")
+        self.assertEqual(headers["X-Coalesced-Waiters"], "1")
+        self.assertEqual(self.responses["newer"][2]["source"], "openai")
+
+    def test_follower_outlives_leader_deadline(self) -> None:
+        shared = suggestions_payload(f"{self.server_mode} leader in a hurry")
+        self.post("leader", "install-a", shared, {"X-Deadline-Ms": "300"})
+        self.post("follower", "install-b", shared)
+        self.join()
+        self.assertEqual(self.responses["leader"][2]["source"], "rules_fallback")
+        status, _, body = self.responses["follower"]
+        self.assertEqual(status, 200)
+        self.assertEqual(body["source"], "openai")
+
+
+class AsyncCoalescedCallTest(CoalescedCallTest):
+    server_mode = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
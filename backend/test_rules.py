@@ -0,0 +1,20 @@
+"""Rules engine regression: the memoized path matches the reference builder byte for byte.
+
+    python -m pytest backend
+"""
+
+import unittest
+
+from bench_rules import run_regression
+from reply_backend import all_rules_keys
+
+
+class RulesRegressionTest(unittest.TestCase):
+    def test_memoized_output_matches_reference(self) -> None:
+        report = run_regression(fuzz=2000, seed=7)
+        self.assertEqual(report["checked"], sum(1 for _ in all_rules_keys()) + 2000)
+        self.assertEqual(report["mismatches"], 0, report["first_mismatches"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,315 @@
+"""Checks for the circuit breaker, admission control, the priority gate and supersession.
+
+    python -m pytest backend
+"""
+
+import threading
+import time
+import unittest
+from typing import Any
+
+from reply_backend import (
+    SINGLE_FLIGHT,
+    AdmissionController,
+    CircuitBreaker,
+    CircuitOpenError,
+    DeadlineExpiredError,
+    PriorityGate,
+    QueueFullError,
+    SuggestionJob,
+    SupersededError,
+    SupersessionRegistry,
+    TokenBucket,
+    TokenBucketMap,
+    cancel_unshared_call,
+    parse_priority,
+    retry_after_header,
+)
+from reply_config import Config
+from reply_prompts import generation_key
+from reply_upstream import UpstreamCancel
+
+
+def breaker_config(**overrides: Any) -> Config:
+    config = Config()
+    config.circuit_breaker_enabled = True
+    config.circuit_window = 4
+    config.circuit_min_calls = 4
+    config.circuit_failure_rate = 0.5
+    config.circuit_slow_call_ms = 0
+    config.circuit_open_sec = 0.1
+    config.circuit_half_open_probes = 1
+    config.adaptive_timeout_enabled = False
+    for name, value in overrides.items():
+        setattr(config, name, value)
+    return config
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.transitions: list[tuple[str, str]] = []
+        self.breaker = CircuitBreaker(breaker_config(), lambda t: self.transitions.append((t["from"], t["to"])))
+
+    def succeed(self) -> None:
+        with self.breaker.call():
+            pass
+
+    def fail(self) -> None:
+        try:
+            with self.breaker.call():
+                raise TimeoutError("upstream timed out")
+        except TimeoutError:
+            pass
+
+    def open_circuit(self) -> None:
+        self.succeed()
+        self.succeed()
+        self.fail()
+        self.assertEqual(self.breaker.state, "closed")
+        self.fail()
+        self.assertEqual(self.breaker.state, "open")
+
+    def test_opens_at_failure_rate_and_rejects(self) -> None:
+        self.open_circuit()
+        with self.assertRaises(CircuitOpenError):
+            self.breaker.allow()
+        with self.assertRaises(CircuitOpenError):
+            self.succeed()
+        self.assertEqual(self.breaker.stats()["rejected"], 2)
+
+    def test_successful_probe_closes(self) -> None:
+        self.open_circuit()
+        time.sleep(0.15)
+        with self.breaker.call():
+            self.assertEqual(self.breaker.state, "half_open")
+            # The single probe slot is taken.
+            with self.assertRaises(CircuitOpenError):
+                self.breaker.allow()
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertEqual(self.transitions, [("closed", "open"), ("open", "half_open"), ("half_open", "closed")])
+
+    def test_failed_probe_reopens(self) -> None:
+        self.open_circuit()
+        time.sleep(0.15)
+        self.fail()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.stats()["opened"], 2)
+
+    def test_deadline_and_supersession_are_not_failures(self) -> None:
+        for _ in range(4):
+            try:
+                with self.breaker.call():
+                    raise DeadlineExpiredError("client budget spent")
+            except DeadlineExpiredError:
+                pass
+        stats = self.breaker.stats()
+        self.assertEqual((stats["state"], stats["window_calls"]), ("closed", 0))
+
+    def test_slow_calls_count_as_failures(self) -> None:
+        self.breaker.config.circuit_slow_call_ms = 10
+        for _ in range(4):
+            with self.breaker.call():
+                time.sleep(0.02)
+        self.assertEqual(self.breaker.state, "open")
+
+    def test_adaptive_timeout_follows_latency(self) -> None:
+        config = breaker_config(
+            adaptive_timeout_enabled=True,
+            adaptive_timeout_quantile=0.99,
+            adaptive_timeout_multiplier=2.0,
+            adaptive_timeout_min_ms=100,
+            primary_timeout_sec=12,
+        )
+        breaker = CircuitBreaker(config)
+        self.assertEqual(breaker.timeout_sec(), 12.0)
+        for _ in range(config.circuit_min_calls):
+            with breaker.call():
+                time.sleep(0.06)
+        self.assertTrue(0.12 <= breaker.timeout_sec() < 0.2, breaker.timeout_sec())
+        config.adaptive_timeout_min_ms = 1000
+        self.assertEqual(breaker.timeout_sec(), 1.0)
+        config.adaptive_timeout_multiplier = 1000.0
+        self.assertEqual(breaker.timeout_sec(), 12.0)
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_refills_at_rate_up_to_burst(self) -> None:
+        bucket = TokenBucket(rate=2.0, burst=2.0)
+        now = bucket.updated
+        self.assertEqual([bucket.try_take(now) for _ in range(3)], [True, True, False])
+        self.assertAlmostEqual(bucket.retry_after(), 0.5)
+        self.assertFalse(bucket.try_take(now + 0.25))
+        self.assertTrue(bucket.try_take(now + 0.5))
+        # A long idle period refills to the burst size, not beyond.
+        bucket.try_take(now + 60.0, 0.0)
+        self.assertEqual(bucket.tokens, 2.0)
+
+    def test_map_limits_keys_independently(self) -> None:
+        buckets = TokenBucketMap(rate=1.0, burst=2.0, max_keys=2, idle_ttl_sec=60.0)
+        self.assertEqual([buckets.try_take("a")[0] for _ in range(3)], [True, True, False])
+        self.assertTrue(buckets.try_take("b")[0])
+        # Costs above the burst are charged as a full burst instead of never passing.
+        self.assertTrue(buckets.try_take("c", 5)[0])
+        self.assertEqual(buckets.stats()["evicted"], 1)
+        # The evicted key starts again with a full bucket.
+        self.assertTrue(buckets.try_take("a")[0])
+
+    def test_admission_rejects_with_retry_after(self) -> None:
+        config = Config()
+        config.rate_limit_enabled = True
+        config.rate_limit_action = "reject"
+        config.rate_limit_install_rps = 0.5
+        config.rate_limit_install_burst = 1.0
+        config.rate_limit_global_rps = 0.0
+        admission = AdmissionController(config)
+        self.assertEqual(admission.check("install-a"), ("allow", 0.0))
+        decision, retry_after = admission.check("install-a")
+        self.assertEqual(decision, "reject")
+        self.assertEqual(retry_after_header(retry_after), {"Retry-After": "2"})
+        self.assertEqual(admission.check("install-b")[0], "allow")
+        self.assertEqual(admission.stats()["limited_install"], 1)
+        config.rate_limit_action = "downgrade"
+        downgrading = AdmissionController(config)
+        self.assertEqual([downgrading.check("install-a")[0] for _ in range(2)], ["allow", "downgrade"])
+
+
+class PriorityGateTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.gate = PriorityGate(max_active=1, max_queued=4)
+        self.assertIsNone(self.gate.enter(1, None, lambda: None))
+        self.admitted: list[str] = []
+
+    def queue(self, name: str, priority: int, deadline: float | None) -> Any:
+        return self.gate.enter(priority, deadline, lambda: self.admitted.append(name))
+
+    def test_admits_by_priority_then_deadline(self) -> None:
+        now = time.monotonic()
+        self.queue("low", 2, None)
+        self.queue("high, later deadline", 0, now + 5.0)
+        self.queue("normal", 1, now + 1.0)
+        self.queue("high, earlier deadline", 0, now + 2.0)
+        for _ in range(4):
+            self.gate.release()
+        self.assertEqual(self.admitted, ["high, earlier deadline", "high, later deadline", "normal", "low"])
+        stats = self.gate.stats()
+        self.assertEqual((stats["active"], stats["queued"], stats["admitted"]), (1, 0, 5))
+
+    def test_priority_header_values(self) -> None:
+        parsed = [parse_priority(raw) for raw in ("high", " Low ", "1", "7", "urgent", None)]
+        self.assertEqual(parsed, [0, 2, 1, 2, None, None])
+
+    def test_full_queue_rejects(self) -> None:
+        for index in range(4):
+            self.queue(str(index), 1, None)
+        self.assertFalse(self.gate.has_capacity())
+        with self.assertRaises(QueueFullError):
+            self.queue("one too many", 1, None)
+        self.assertEqual(self.gate.stats()["rejected"], 1)
+
+    def test_expired_waiter_is_dropped(self) -> None:
+        started = time.monotonic()
+        with self.assertRaises(DeadlineExpiredError):
+            with self.gate.slot(0, started + 0.05):
+                pass
+        self.assertLess(time.monotonic() - started, 1.0)
+        self.assertEqual(self.gate.stats()["expired"], 1)
+        # The abandoned waiter is skipped; the slot goes to the next one in line.
+        self.queue("next", 1, None)
+        self.gate.release()
+        self.assertEqual(self.admitted, ["next"])
+
+    def test_cancelled_waiter_is_superseded(self) -> None:
+        cancel = UpstreamCancel()
+        threading.Timer(0.05, cancel.cancel).start()
+        with self.assertRaises(SupersededError):
+            with self.gate.slot(0, None, cancel):
+                pass
+        stats = self.gate.stats()
+        self.assertEqual((stats["queued"], stats["expired"]), (0, 0))
+
+    def test_granted_waiter_runs_and_frees_its_slot(self) -> None:
+        entered = threading.Event()
+
+        def wait_for_slot() -> None:
+            with self.gate.slot(0, time.monotonic() + 2.0):
+                entered.set()
+
+        thread = threading.Thread(target=wait_for_slot)
+        thread.start()
+        time.sleep(0.05)
+        self.assertFalse(entered.is_set())
+        self.gate.release()
+        thread.join(2.0)
+        self.assertTrue(entered.is_set())
+        self.assertEqual(self.gate.stats()["active"], 0)
+
+
+def chat_job(text: str, install_id: str = "install-a", reply_type: str = "chat") -> SuggestionJob:
+    payload = {
+        "context": {"reply_type": reply_type, "primary_text": text, "intent": "joking"},
+        "controls": {"tone_bias": "funny", "length": "short"},
+        "desired_count": 3,
+    }
+    job = SuggestionJob(payload, install_id=install_id)
+    job.cache_key = generation_key(payload)
+    return job
+
+
+class SupersessionTest(unittest.TestCase):
+    def setUp(self) -> None:
+        config = Config()
+        config.supersede_enabled = True
+        config.supersede_reply_types = "chat"
+        self.registry = SupersessionRegistry(config)
+        self.superseded: list[str] = []
+
+    def register(self, job: SuggestionJob) -> SuggestionJob:
+        self.registry.register(job, lambda: self.superseded.append(job.request_id))
+        return job
+
+    def test_newer_inputs_supersede_older_request(self) -> None:
+        old = self.register(chat_job("hey are you coming"))
+        same = self.register(chat_job("hey are you coming"))
+        newer = self.register(chat_job("hey are you coming tonight"))
+        self.assertEqual((old.superseded, same.superseded, newer.superseded), (True, True, False))
+        self.assertEqual(len(self.superseded), 2)
+        self.registry.release(newer)
+        self.assertEqual(self.registry.stats()["pending_keys"], 0)
+
+    def test_identical_inputs_share_instead(self) -> None:
+        first = self.register(chat_job("see you at eight"))
+        self.register(chat_job("see you at eight"))
+        self.assertFalse(first.superseded)
+        self.assertEqual(self.superseded, [])
+
+    def test_other_installs_and_reply_types_are_left_alone(self) -> None:
+        first = self.register(chat_job("lunch tomorrow?"))
+        self.register(chat_job("something else", install_id="install-b"))
+        comment = self.register(chat_job("nice photo", reply_type="comment"))
+        self.register(chat_job("very nice photo", reply_type="comment"))
+        self.assertEqual((first.superseded, comment.superseded), (False, False))
+
+    def test_unshared_call_is_cancelled_and_shared_call_detached(self) -> None:
+        alone = chat_job("running late")
+        cancel_unshared_call(alone)
+        self.assertTrue(alone.cancel.cancelled)
+        alone.superseded = True
+        alone.resolve_superseded()
+        self.assertEqual((alone.primary_source, alone.request_meta["superseded"]), ("superseded", "before_upstream"))
+
+        shared = chat_job("running late, order for me")
+        release = threading.Event()
+        SINGLE_FLIGHT.submit(shared.cache_key, lambda: release.wait(2.0))
+        SINGLE_FLIGHT.submit(shared.cache_key, lambda: None)
+        try:
+            cancel_unshared_call(shared)
+            self.assertFalse(shared.cancel.cancelled)
+        finally:
+            release.set()
+        shared.superseded = True
+        shared.resolve_superseded()
+        self.assertEqual(shared.request_meta["superseded"], "detached")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,266 @@
+"""End-to-end checks of the suggestion endpoints' wire behavior against the mock upstream.
+
+    python -m pytest backend
+"""
+
+import gzip
+import http.client
+import json
+import tempfile
+import time
+import unittest
+import zlib
+from typing import Any
+
+from mock_openai import MockSettings, start_mock_server
+from reply_backend import (
+    BodyRejectedError,
+    RequestBodyDecoder,
+    check_content_length,
+    encode_response,
+    negotiate_encoding,
+)
+from reply_config import CONFIG
+from test_streaming import free_port, start_backend
+
+
+def suggestions_payload(primary_text: str, desired_count: int = 3) -> dict[str, Any]:
+    return {
+        "context": {"reply_type": "comment", "primary_text": primary_text, "intent": "joking"},
+        "controls": {"tone_bias": "funny", "length": "short"},
+        "desired_count": desired_count,
+    }
+
+
+class BackendTestCase(unittest.TestCase):
+    """Starts the mock upstream and one backend per class; subclasses set `env`."""
+
+    server_mode = "threading"
+    env: dict[str, str] = {}
+    latency_ms = 20.0
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.settings = MockSettings(latency="fixed", latency_ms=cls.latency_ms, seed=1)
+        cls.mock = start_mock_server("127.0.0.1", 0, cls.settings)
+        cls.log_dir = tempfile.TemporaryDirectory(prefix="test_serving_")
+        cls.backend_port = free_port()
+        cls.backend = start_backend(
+            cls.backend_port, cls.mock.server_address[1], cls.log_dir.name, SERVER_MODE=cls.server_mode, **cls.env
+        )
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.backend.terminate()
+        cls.backend.wait(timeout=10)
+        cls.mock.shutdown()
+        cls.mock.server_close()
+        cls.log_dir.cleanup()
+
+    def request(
+        self, path: str, body: bytes, headers: dict[str, str] | None = None
+    ) -> tuple[int, dict[str, str], bytes]:
+        conn = http.client.HTTPConnection("127.0.0.1", self.backend_port, timeout=10)
+        conn.request("POST", path, body=body, headers={"Content-Type": "application/json", **(headers or {})})
+        resp = conn.getresponse()
+        result = resp.status, dict(resp.getheaders()), resp.read()
+        conn.close()
+        return result
+
+    def suggest(
+        self, payload: dict[str, Any], headers: dict[str, str] | None = None
+    ) -> tuple[int, dict[str, str], dict[str, Any]]:
+        status, response_headers, raw = self.request("/v1/reply-suggestions", json.dumps(payload).encode(), headers)
+        return status, response_headers, json.loads(raw)
+
+    def batch(self, items: list[Any]) -> tuple[int, dict[str, Any]]:
+        status, _, raw = self.request("/v1/reply-suggestions:batch", json.dumps({"requests": items}).encode())
+        return status, json.loads(raw)
+
+
+class RateLimitTest(BackendTestCase):
+    env = {
+        "RATE_LIMIT_ENABLED": "true",
+        "RATE_LIMIT_ACTION": "reject",
+        "RATE_LIMIT_INSTALL_RPS": "0.5",
+        "RATE_LIMIT_INSTALL_BURST": "1",
+    }
+
+    def test_over_limit_install_gets_429_with_retry_after(self) -> None:
+        payload = suggestions_payload(f"{self.server_mode} rate limited post")
+        self.assertEqual(self.suggest(payload, {"X-Install-Id": "install-a"})[0], 200)
+        status, headers, body = self.suggest(payload, {"X-Install-Id": "install-a"})
+        self.assertEqual((status, body), (429, {"error": "Rate limited"}))
+        self.assertEqual(headers["Retry-After"], "2")
+        self.assertEqual(self.suggest(payload, {"X-Install-Id": "install-b"})[0], 200)
+
+
+class AsyncRateLimitTest(RateLimitTest):
+    server_mode = "asyncio"
+
+
+class RaceModeTest(BackendTestCase):
+    env = {"PRIMARY_MODE": "race", "RACE_SOFT_DEADLINE_MS": "100"}
+    latency_ms = 400.0
+
+    def test_rules_at_soft_deadline_then_cached_model_result(self) -> None:
+        payload = suggestions_payload(f"{self.server_mode} slow model post")
+        started = time.monotonic()
+        status, _, body = self.suggest(payload)
+        self.assertLess(time.monotonic() - started, 0.35)
+        self.assertEqual((status, body["source"], len(body["suggestions"])), (200, "rules_deadline", 3))
+        # The model call kept running and its result answers the repeat from the response cache.
+        time.sleep(0.5)
+        status, headers, body = self.suggest(payload)
+        self.assertEqual((status, body["source"], headers["X-Cache"]), (200, "openai", "hit"))
+
+    def test_fast_model_wins_the_race(self) -> None:
+        self.settings.latency_ms = 10.0
+        try:
+            _, _, body = self.suggest(suggestions_payload(f"{self.server_mode} fast model post"))
+        finally:
+            self.settings.latency_ms = self.latency_ms
+        self.assertEqual(body["source"], "openai")
+
+
+class AsyncRaceModeTest(RaceModeTest):
+    server_mode = "asyncio"
+
+
+class BatchEndpointTest(BackendTestCase):
+    env = {"BATCH_MAX_ITEMS": "4"}
+
+    def test_results_keep_input_order_with_per_item_status(self) -> None:
+        items = [
+            suggestions_payload(f"{self.server_mode} first batch post", 3),
+            "not a request",
+            suggestions_payload(f"{self.server_mode} second batch post", 2),
+        ]
+        status, body = self.batch(items)
+        self.assertEqual(status, 200)
+        first, invalid, second = body["results"]
+        self.assertEqual(invalid, {"status": 400, "error": "Invalid request"})
+        self.assertEqual((first["status"], first["source"], len(first["suggestions"])), (200, "openai", 3))
+        self.assertEqual((second["status"], second["source"], len(second["suggestions"])), (200, "openai", 2))
+
+    def test_rejects_empty_and_oversized_batches(self) -> None:
+        self.assertEqual(self.batch([]), (400, {"error": "Invalid request"}))
+        status, body = self.batch([suggestions_payload("too many")] * 5)
+        self.assertEqual((status, body), (400, {"error": "Too many requests in batch (max 4)"}))
+
+
+class AsyncBatchEndpointTest(BatchEndpointTest):
+    server_mode = "asyncio"
+
+
+class MicroBatchTest(BackendTestCase):
+    env = {"MICRO_BATCH_ENABLED": "true", "MICRO_BATCH_WINDOW_MS": "100"}
+
+    def test_concurrent_items_share_one_upstream_call(self) -> None:
+        batched = self.settings.stats()["batched"]
+        items = [suggestions_payload("micro batch one", 3), suggestions_payload("micro batch two", 2)]
+        status, body = self.batch(items)
+        self.assertEqual(status, 200)
+        self.assertEqual(self.settings.stats()["batched"], batched + 1)
+        # Each item gets its own slice of the multi-item answer.
+        results = [(result["source"], len(result["suggestions"])) for result in body["results"]]
+        self.assertEqual(results, [("openai", 3), ("openai", 2)])
+        self.assertNotEqual(body["results"][0]["suggestions"], body["results"][1]["suggestions"])
+
+    def test_failed_batch_falls_back_to_rules(self) -> None:
+        self.settings.error_rate = 1.0
+        try:
+            status, body = self.batch([suggestions_payload("micro batch fails"), suggestions_payload("so does this")])
+        finally:
+            self.settings.error_rate = 0.0
+        self.assertEqual(status, 200)
+        self.assertEqual([r["source"] for r in body["results"]], ["rules_fallback", "rules_fallback"])
+
+
+
+class WireEncodingTest(unittest.TestCase):
+    def test_negotiates_by_quality_then_header_order(self) -> None:
+        self.assertEqual(negotiate_encoding(None), "identity")
+        self.assertEqual(negotiate_encoding("br"), "identity")
+        self.assertEqual(negotiate_encoding("deflate, gzip"), "deflate")
+        self.assertEqual(negotiate_encoding("gzip;q=0.5, deflate;q=0.8"), "deflate")
+        self.assertEqual(negotiate_encoding("gzip;q=0, *"), "gzip")
+        self.assertEqual(negotiate_encoding("gzip;q=0"), "identity")
+
+    def test_compresses_only_above_min_size(self) -> None:
+        raw = json.dumps({"suggestions": ["same reply"] * 50}).encode()
+        body, headers = encode_response(raw, "gzip")
+        self.assertEqual((gzip.decompress(body), headers["Content-Encoding"]), (raw, "gzip"))
+        body, headers = encode_response(raw, "deflate")
+        self.assertEqual(zlib.decompress(body), raw)
+        self.assertEqual(encode_response(b"{}", "gzip"), (b"{}", {"Vary": "Accept-Encoding"}))
+
+    def test_decoder_reassembles_chunked_compressed_body(self) -> None:
+        raw = json.dumps(suggestions_payload("decoded in pieces")).encode()
+        compressed = gzip.compress(raw)
+        decoder = RequestBodyDecoder("GZIP")
+        for start in range(0, len(compressed), 7):
+            decoder.feed(compressed[start : start + 7])
+        self.assertEqual(decoder.finish(), raw)
+
+    def test_decoder_rejections(self) -> None:
+        with self.assertRaises(BodyRejectedError) as caught:
+            RequestBodyDecoder("br")
+        self.assertEqual(caught.exception.status, 415)
+        bomb = RequestBodyDecoder("deflate")
+        with self.assertRaises(BodyRejectedError) as caught:
+            bomb.feed(zlib.compress(b"0" * (CONFIG.max_request_bytes + 1)))
+        self.assertEqual(caught.exception.status, 413)
+        truncated = RequestBodyDecoder("gzip")
+        truncated.feed(gzip.compress(b"{}")[:-4])
+        with self.assertRaises(BodyRejectedError) as caught:
+            truncated.finish()
+        self.assertEqual(caught.exception.status, 400)
+        for raw, status in (("-1", 400), ("12x", 400), (str(CONFIG.max_request_bytes + 1), 413)):
+            with self.assertRaises(BodyRejectedError) as caught:
+                check_content_length(raw)
+            self.assertEqual(caught.exception.status, status)
+
+
+class CompressionTest(BackendTestCase):
+    env = {"MAX_REQUEST_BYTES": "4096", "COMPRESSION_MIN_BYTES": "64"}
+
+    def test_gzip_request_and_response(self) -> None:
+        payload = suggestions_payload(f"{self.server_mode} compressed both ways")
+        body = gzip.compress(json.dumps(payload).encode())
+        status, headers, raw = self.request(
+            "/v1/reply-suggestions", body, {"Content-Encoding": "gzip", "Accept-Encoding": "gzip"}
+        )
+        self.assertEqual((status, headers["Content-Encoding"], headers["Vary"]), (200, "gzip", "Accept-Encoding"))
+        self.assertEqual(json.loads(gzip.decompress(raw))["source"], "openai")
+        status, headers, raw = self.request("/v1/reply-suggestions", json.dumps(payload).encode())
+        self.assertNotIn("Content-Encoding", headers)
+        self.assertEqual(json.loads(raw)["source"], "openai")
+
+    def test_declared_oversized_body_gets_413_unread(self) -> None:
+        conn = http.client.HTTPConnection("127.0.0.1", self.backend_port, timeout=10)
+        conn.putrequest("POST", "/v1/reply-suggestions")
+        conn.putheader("Content-Type", "application/json")
+        conn.putheader("Content-Length", "1000000")
+        conn.endheaders()
+        resp = conn.getresponse()
+        status, body = resp.status, json.loads(resp.read())
+        conn.close()
+        self.assertEqual((status, body), (413, {"error": "Request body too large (max 4096 bytes)"}))
+
+    def test_decompression_bomb_gets_413(self) -> None:
+        bomb = gzip.compress(b" " * 100_000)
+        self.assertLess(len(bomb), 4096)
+        status, _, raw = self.request("/v1/reply-suggestions", bomb, {"Content-Encoding": "gzip"})
+        self.assertEqual((status, json.loads(raw)), (413, {"error": "Request body too large (max 4096 bytes)"}))
+        status, _, _ = self.request("/v1/reply-suggestions", b"{}", {"Content-Encoding": "br"})
+        self.assertEqual(status, 415)
+
+
+class AsyncCompressionTest(CompressionTest):
+    server_mode = "asyncio"
+
+
+
+if __name__ == "__main__":
+    unittest.main()
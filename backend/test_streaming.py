@@ -0,0 +1,157 @@
+"""End-to-end checks of POST /v1/reply-suggestions:stream against the mock upstream.
+
+    python -m pytest backend
+"""
+
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+from typing import Any
+
+from mock_openai import MockSettings, start_mock_server
+
+BACKEND_SCRIPT = Path(__file__).with_name("reply_backend.py")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_backend(port: int, upstream_port: int, log_dir: str, **env: str) -> subprocess.Popen:
+    """Runs reply_backend.py against the mock and waits until /health answers."""
+    proc = subprocess.Popen(
+        [sys.executable, str(BACKEND_SCRIPT)],
+        env={
+            **os.environ,
+            "BACKEND_HOST": "127.0.0.1",
+            "BACKEND_PORT": str(port),
+            "OPENAI_API_KEY": "test",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{upstream_port}",
+            "SHADOW_LOG_PATH": os.path.join(log_dir, "shadow.jsonl"),
+            "TRACE_PATH": os.path.join(log_dir, "traces.json"),
+            **env,
+        },
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f"reply_backend exited early with status {proc.returncode}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/health")
+            conn.getresponse().read()
+            conn.close()
+            return proc
+        except OSError:
+            time.sleep(0.1)
+    proc.terminate()
+    raise RuntimeError("reply_backend did not become healthy")
+
+
+def read_events(raw: bytes) -> list[tuple[str, dict[str, Any]]]:
+    events = []
+    for block in raw.decode("utf-8").split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines() if ": " in line)
+        if "event" in fields:
+            events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+class StreamEndpointTest(unittest.TestCase):
+    server_mode = "threading"
+    backend_port = 0
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.settings = MockSettings(latency="fixed", latency_ms=20.0, seed=1)
+        cls.mock = start_mock_server("127.0.0.1", 0, cls.settings)
+        cls.log_dir = tempfile.TemporaryDirectory(prefix="test_streaming_")
+        cls.backend_port = free_port()
+        cls.backend = start_backend(
+            cls.backend_port, cls.mock.server_address[1], cls.log_dir.name, SERVER_MODE=cls.server_mode
+        )
+
+    @classmethod
+    def tearDownClass(cls) -> None:
+        cls.backend.terminate()
+        cls.backend.wait(timeout=10)
+        cls.mock.shutdown()
+        cls.mock.server_close()
+        cls.log_dir.cleanup()
+
+    def setUp(self) -> None:
+        self.settings.stream_chunk_chars = 16
+        self.settings.extra_items = 0
+        self.settings.malformed_rate = 0.0
+
+    def stream(self, primary_text: str) -> list[tuple[str, dict[str, Any]]]:
+        # A distinct primary_text per test keeps the response cache out of the way.
+        payload = {
+            "context": {"reply_type": "comment", "primary_text": primary_text, "intent": "joking"},
+            "controls": {"tone_bias": "funny", "length": "short"},
+            "desired_count": 3,
+        }
+        conn = http.client.HTTPConnection("127.0.0.1", self.backend_port, timeout=10)
+        conn.request(
+            "POST",
+            "/v1/reply-suggestions:stream",
+            body=json.dumps(payload),
+            headers={"Content-Type": "application/json"},
+        )
+        resp = conn.getresponse()
+        self.assertEqual(resp.status, 200)
+        self.assertTrue(resp.getheader("Content-Type", "").startswith("text/event-stream"))
+        events = read_events(resp.read())
+        conn.close()
+        return events
+
+    def test_items_split_across_chunks(self) -> None:
+        self.settings.stream_chunk_chars = 1
+        events = self.stream("one character per upstream chunk")
+        streamed = [data["suggestion"] for name, data in events if name == "suggestion"]
+        self.assertEqual([name for name, _ in events][0], "rules")
+        self.assertEqual(events[-1][0], "done")
+        done = events[-1][1]
+        self.assertEqual(done["source"], "openai")
+        self.assertEqual(len(streamed), 3)
+        self.assertEqual(done["suggestions"], streamed)
+        self.assertEqual([data["index"] for name, data in events if name == "suggestion"], [0, 1, 2])
+
+    def test_extra_items_fall_back_like_one_shot(self) -> None:
+        self.settings.extra_items = 2
+        events = self.stream("model answers too many items")
+        streamed = [data for name, data in events if name == "suggestion"]
+        done = events[-1][1]
+        self.assertLessEqual(len(streamed), 3)
+        self.assertEqual(events[-1][0], "done")
+        self.assertEqual(done["source"], "rules_fallback")
+        self.assertEqual(len(done["suggestions"]), 3)
+
+    def test_truncated_stream_falls_back(self) -> None:
+        self.settings.malformed_rate = 1.0
+        events = self.stream("upstream json cut in half")
+        streamed = [data for name, data in events if name == "suggestion"]
+        done = events[-1][1]
+        self.assertLess(len(streamed), 3)
+        self.assertEqual(events[-1][0], "done")
+        self.assertEqual(done["source"], "rules_fallback")
+        self.assertEqual(len(done["suggestions"]), 3)
+
+
+class AsyncStreamEndpointTest(StreamEndpointTest):
+    server_mode = "asyncio"
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,173 @@
+"""Upstream connection pool and endpoint router checks against the mock upstream.
+
+    python -m pytest backend
+"""
+
+import json
+import threading
+import time
+import unittest
+from typing import Any
+
+from mock_openai import MockSettings, start_mock_server
+from reply_config import Config
+from reply_upstream import EndpointRouter, UpstreamCancel, UpstreamConnectionPool, UpstreamEndpoint
+
+COMPLETION_BODY = json.dumps(
+    {
+        "model": "mock",
+        "messages": [
+            {"role": "system", "content": "Return exactly desired_count suggestions."},
+            {"role": "user", "content": json.dumps({"desired_count": 3})},
+        ],
+    }
+).encode("utf-8")
+
+
+def start_mock(**settings: Any) -> tuple[Any, MockSettings, str]:
+    mock_settings = MockSettings(latency="fixed", seed=1, **settings)
+    server = start_mock_server("127.0.0.1", 0, mock_settings)
+    return server, mock_settings, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def stop_mock(server: Any) -> None:
+    server.shutdown()
+    server.server_close()
+
+
+def complete(pool: UpstreamConnectionPool, timeout_sec: float, cancel: UpstreamCancel | None = None) -> int:
+    status, _, _ = pool.request(
+        "POST",
+        "/v1/chat/completions",
+        COMPLETION_BODY,
+        {"Content-Type": "application/json"},
+        timeout_sec,
+        cancel,
+    )
+    return status
+
+
+class UpstreamConnectionPoolTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.mock, self.settings, base_url = start_mock(latency_ms=20.0)
+        self.pool = UpstreamConnectionPool(base_url, max_idle=4, idle_timeout_sec=30.0)
+
+    def tearDown(self) -> None:
+        self.pool.close()
+        stop_mock(self.mock)
+
+    def test_connection_reused_after_error_status(self) -> None:
+        self.settings.error_rate = 1.0
+        self.assertEqual(complete(self.pool, 2.0), 500)
+        self.settings.error_rate = 0.0
+        self.assertEqual(complete(self.pool, 2.0), 200)
+        stats = self.pool.stats()
+        self.assertEqual((stats["created"], stats["reused"]), (1, 1))
+        self.assertEqual((stats["idle"], stats["in_use"]), (1, 0))
+
+    def test_timed_out_connection_is_replaced(self) -> None:
+        self.assertEqual(complete(self.pool, 2.0), 200)
+        self.settings.latency_ms = 300.0
+        with self.assertRaises(TimeoutError):
+            complete(self.pool, 0.05)
+        # The timed-out connection may still get the late response, so it must not go back to the pool.
+        stats = self.pool.stats()
+        self.assertEqual((stats["idle"], stats["in_use"]), (0, 0))
+        self.settings.latency_ms = 20.0
+        self.assertEqual(complete(self.pool, 2.0), 200)
+        stats = self.pool.stats()
+        self.assertEqual((stats["created"], stats["reused"]), (2, 1))
+
+    def test_cancel_aborts_request(self) -> None:
+        self.settings.latency_ms = 500.0
+        cancel = UpstreamCancel()
+        started = time.monotonic()
+        timer = threading.Timer(0.05, cancel.cancel)
+        timer.start()
+        with self.assertRaises(OSError):
+            complete(self.pool, 2.0, cancel)
+        timer.join()
+        self.assertLess(time.monotonic() - started, 0.4)
+        self.assertEqual(self.pool.stats()["in_use"], 0)
+
+
+class EndpointRouterTest(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fast, _, fast_url = start_mock(latency_ms=10.0)
+        self.slow, self.slow_settings, slow_url = start_mock(latency_ms=80.0)
+        self.config = Config()
+        self.config.openai_endpoints = f"{slow_url}|slow|1,{fast_url}|fast|1"
+        self.config.router_explore_rate = 0.0
+        self.config.hedge_enabled = False
+        self.pools = {
+            url: UpstreamConnectionPool(url, max_idle=4, idle_timeout_sec=30.0) for url in (fast_url, slow_url)
+        }
+
+    def tearDown(self) -> None:
+        for pool in self.pools.values():
+            pool.close()
+        stop_mock(self.fast)
+        stop_mock(self.slow)
+
+    def attempt(self, endpoint: UpstreamEndpoint, timeout_sec: float, cancel: UpstreamCancel) -> str:
+        status = complete(self.pools[endpoint.base_url], timeout_sec, cancel)
+        if status != 200:
+            raise RuntimeError(f"upstream status {status}")
+        return endpoint.model
+
+    def test_routes_to_lowest_ewma_latency(self) -> None:
+        router = EndpointRouter(self.config)
+        # Never-measured endpoints go first, so each is tried once before the EWMA decides.
+        self.assertEqual(sorted(router.call(self.attempt, 2.0) for _ in range(2)), ["fast", "slow"])
+        self.assertEqual([router.call(self.attempt, 2.0) for _ in range(5)], ["fast"] * 5)
+        slow, fast = router.endpoints
+        self.assertGreater(slow.ewma_latency_ms, fast.ewma_latency_ms)
+
+    def test_failing_endpoint_is_avoided(self) -> None:
+        router = EndpointRouter(self.config)
+        slow, fast = router.endpoints
+        slow.ewma_latency_ms, fast.ewma_latency_ms = 1.0, 50.0
+        self.slow_settings.error_rate = 1.0
+        for _ in range(4):
+            try:
+                router.call(self.attempt, 2.0)
+            except RuntimeError:
+                pass
+        self.assertGreaterEqual(slow.error_score, self.config.router_max_error_score)
+        self.assertEqual([router.call(self.attempt, 2.0) for _ in range(3)], ["fast"] * 3)
+
+    def test_cancelled_attempt_never_lowers_latency_estimate(self) -> None:
+        router = EndpointRouter(self.config)
+        slow, _ = router.endpoints
+        slow.ewma_latency_ms = 80.0
+        router.record(slow, 0.01, "cancelled")
+        self.assertEqual(slow.ewma_latency_ms, 80.0)
+        router.record(slow, 0.5, "cancelled")
+        self.assertGreater(slow.ewma_latency_ms, 80.0)
+        self.assertEqual((slow.cancelled, slow.calls), (2, 0))
+
+    def test_hedge_wins_and_cancels_slow_attempt(self) -> None:
+        self.config.hedge_enabled = True
+        self.config.hedge_min_samples = 1
+        self.config.hedge_min_ms = 30
+        self.config.hedge_max_ratio = 1.0
+        self.slow_settings.latency_ms = 1000.0
+        router = EndpointRouter(self.config)
+        slow, fast = router.endpoints
+        # The slow endpoint looks fastest, so it is the primary and the fast one answers the hedge.
+        slow.ewma_latency_ms, fast.ewma_latency_ms = 1.0, 50.0
+        slow.latency.add(30.0)
+        route: dict[str, Any] = {}
+        started = time.monotonic()
+        self.assertEqual(router.call(self.attempt, 5.0, route), "fast")
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual(route["hedged"], {"primary": slow.name, "hedge": fast.name, "winner": "hedge"})
+        deadline = time.monotonic() + 2.0
+        while slow.cancelled == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual((slow.cancelled, fast.hedge_wins), (1, 1))
+        self.assertEqual(self.pools[slow.base_url].stats()["in_use"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()